@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Benchmarks the core S3Repo operations against a synthetic repository.
+
+The repository metadata (files, paths, date tags) is generated directly in
+Postgres so that large repos can be built in minutes.  Operations which touch S3
+run against whatever endpoint the configuration points at, normally a local
+stand-in started by run_benchmarks.sh.  Results are written as JSON so that runs
+can be compared between releases:
+
+    python benchmarks/bench_repo.py --files 1000000 --paths 50000 --tags 10000 --output after.json
+    python benchmarks/bench_repo.py --small --baseline before.json
+"""
+import os, sys, json, time, socket, argparse, subprocess
+import s3repo.common
+import s3repo.file
+import s3repo.host
+from s3repo import S3Repo
+from pyutil.pghelper import execute, fetch_results
+from pyutil.dateutil import *
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.args    = args
+        self.results = {}
+
+    @property
+    def conn(self):
+        return S3Repo.conn
+
+    def measure(self, name, func, inputs):
+        """
+        Calls func once per input and records throughput and latency percentiles.
+        """
+        latencies = []
+        start = time.time()
+        for value in inputs:
+            call_start = time.time()
+            func(value)
+            latencies.append(time.time() - call_start)
+        S3Repo.commit()
+        elapsed = time.time() - start
+
+        latencies.sort()
+        self.results[name] = {
+            'count'      : len(latencies),
+            'elapsed'    : elapsed,
+            'throughput' : len(latencies) / elapsed if elapsed else 0.0,
+            'mean'       : sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50'        : percentile(latencies, 0.50),
+            'p99'        : percentile(latencies, 0.99),
+            'max'        : latencies[-1] if latencies else 0.0,
+        }
+        print("{:<24} {:>8} ops {:>10.1f} ops/s  p50 {:>8.2f}ms  p99 {:>8.2f}ms".format(
+            name,
+            len(latencies),
+            self.results[name]['throughput'],
+            self.results[name]['p50'] * 1000,
+            self.results[name]['p99'] * 1000,
+        ))
+
+    def generate(self):
+        """
+        Builds a repository of args.files files spread over args.paths paths, each
+        path date tagged at an hour within args.days days.  Only the latest version
+        of each path is current; earlier versions are expired.  Extra non-date tags
+        are added until there are args.tags tags in total.
+        """
+        args = self.args
+        start = time.time()
+
+        host_id   = s3repo.host.RepoHost.current_host_id()
+        bucket_id = s3repo.file.S3Bucket.find_or_create(args.bucket).s3_bucket_id
+
+        execute(self.conn, """
+            INSERT INTO s3_repo.paths (local_path)
+            SELECT %(root)s || '/synthetic/' || g || '.dat'
+            FROM generate_series(1, %(paths)s) g
+        """, root = args.local_root, paths = args.paths)
+
+        execute(self.conn, """
+            CREATE TEMPORARY TABLE bench_path_dates AS
+            SELECT
+                path_id,
+                date_trunc('hour', %(start)s::timestamp + (row_number() OVER (ORDER BY path_id) * %(days)s * interval '1 day' / %(paths)s)) AS dt
+            FROM s3_repo.paths
+            WHERE local_path LIKE %(root)s || '/synthetic/%%'
+        """, start = args.start, days = args.days, paths = args.paths, root = args.local_root)
+
+        execute(self.conn, """
+            CREATE TEMPORARY TABLE bench_path_tag_names AS
+            SELECT path_id, 'hour='  || to_char(dt, 'YYYY-MM-DD HH24:00:00') AS tag_name FROM bench_path_dates
+            UNION ALL
+            SELECT path_id, 'day='   || to_char(dt, 'YYYY-MM-DD') FROM bench_path_dates
+            UNION ALL
+            SELECT path_id, 'week='  || to_char(date_trunc('week', dt), 'YYYY-MM-DD') FROM bench_path_dates
+            UNION ALL
+            SELECT path_id, 'month=' || to_char(date_trunc('month', dt), 'YYYY-MM-DD') FROM bench_path_dates
+            UNION ALL
+            SELECT path_id, 'dataset=' || mod(path_id, 100) FROM bench_path_dates
+        """)
+
+        execute(self.conn, """
+            INSERT INTO s3_repo.tags (tag_name)
+            SELECT DISTINCT tag_name FROM bench_path_tag_names
+        """)
+
+        execute(self.conn, """
+            INSERT INTO s3_repo.tags (tag_name)
+            SELECT 'extra=' || g
+            FROM generate_series(1, greatest(0, %(tags)s - (SELECT count(*) FROM s3_repo.tags))) g
+        """, tags = args.tags)
+
+        execute(self.conn, """
+            INSERT INTO s3_repo.path_tags (path_id, tag_id, date_tagged)
+            SELECT path_id, tag_id, now()
+            FROM bench_path_tag_names
+                INNER JOIN s3_repo.tags USING (tag_name)
+        """)
+
+        versions = max(1, args.files // args.paths)
+        execute(self.conn, """
+            INSERT INTO s3_repo.files (
+                s3_bucket_id, path_id, origin, s3_key, md5, guid, file_size,
+                date_created, date_uploaded, date_published, date_expired, published
+            )
+            SELECT
+                %(bucket_id)s,
+                path_id,
+                %(host_id)s,
+                'synthetic/' || path_id || '/' || v,
+                md5(path_id || '/' || v),
+                md5(path_id || '/' || v)::uuid,
+                1024 + mod(path_id * v, 1048576),
+                dt + v * interval '1 minute',
+                dt + v * interval '1 minute',
+                dt + v * interval '1 minute',
+                CASE WHEN v < %(versions)s THEN dt + (v + 1) * interval '1 minute' END,
+                v = %(versions)s
+            FROM bench_path_dates, generate_series(1, %(versions)s) v
+        """, bucket_id = bucket_id, host_id = host_id, versions = versions)
+
+        execute(self.conn, "DROP TABLE bench_path_dates, bench_path_tag_names")
+        execute(self.conn, "ANALYZE")
+        S3Repo.commit()
+
+        self.results['generate'] = {
+            'count'   : versions * args.paths,
+            'elapsed' : time.time() - start,
+        }
+        print("generated {} files over {} paths in {:.1f}s".format(versions * args.paths, args.paths, time.time() - start))
+
+    def sample_paths(self, count):
+        return [ row['local_path'] for row in fetch_results(self.conn, """
+            SELECT local_path
+            FROM s3_repo.paths
+            WHERE local_path LIKE %(root)s || '/synthetic/%%'
+            ORDER BY random()
+            LIMIT %(count)s
+        """, root = self.args.local_root, count = count) ]
+
+    def sample_tags(self, prefix, count):
+        return [ row['tag_name'] for row in fetch_results(self.conn, """
+            SELECT tag_name
+            FROM s3_repo.tags
+            WHERE tag_name LIKE %(prefix)s || '%%'
+            ORDER BY random()
+            LIMIT %(count)s
+        """, prefix = prefix, count = count) ]
+
+    def run(self):
+        args = self.args
+        if not args.skip_generate:
+            self.generate()
+
+        execute(self.conn, "SELECT setseed(%(seed)s)", seed = (args.seed % 1000) / 1000.0)
+
+        new_paths = [ os.path.join(args.local_root, 'bench', str(i) + '.dat') for i in range(args.samples) ]
+        new_files = []
+        self.measure('add_file', lambda path: new_files.append(S3Repo.add_file(path)), new_paths)
+
+        for rf in new_files:
+            rf.touch(os.urandom(args.file_size))
+        self.measure('publish', lambda rf: rf.publish(), new_files)
+
+        days   = self.sample_tags('day=', args.samples)
+        months = self.sample_tags('month=', args.samples)
+        sets   = self.sample_tags('dataset=', args.samples)
+        self.measure('find_tagged.all', lambda day: S3Repo.find_tagged(all = [ day ]), days)
+        self.measure('find_tagged.any', lambda tags: S3Repo.find_tagged(any = list(tags)), zip(days, sets))
+        self.measure('find_tagged.exclude', lambda tags: S3Repo.find_tagged(all = [ tags[0] ], exclude = [ tags[1] ]), zip(months, sets))
+
+        self.measure('get_file', S3Repo.get_file, self.sample_paths(args.samples))
+
+        for rf in new_files:
+            rf.unlink()
+        self.measure('open.miss', lambda path: S3Repo.get_file(path).open().close(), new_paths)
+        self.measure('open.hit', lambda path: S3Repo.get_file(path).open().close(), new_paths)
+
+        self.measure('maintain_current_host', lambda _: S3Repo.maintain_current_host(), [ None ])
+        self.measure('maintain_database', lambda _: S3Repo.maintain_database(), [ None ])
+
+    def report(self):
+        try:
+            revision = subprocess.check_output([ 'git', 'rev-parse', 'HEAD' ]).strip()
+        except (OSError, subprocess.CalledProcessError):
+            revision = None
+
+        data = {
+            'revision'  : revision,
+            'hostname'  : socket.gethostname(),
+            'timestamp' : time.time(),
+            'params'    : dict(vars(self.args)),
+            'results'   : self.results,
+        }
+
+        with open(self.args.output, 'w') as fp:
+            json.dump(data, fp, indent = 4, sort_keys = True)
+
+        return data
+
+def compare(baseline_file, data, threshold):
+    """
+    Prints operations whose p50, p99 or throughput regressed by more than threshold.
+    Returns the number of regressions.
+    """
+    with open(baseline_file) as fp:
+        baseline = json.load(fp)['results']
+
+    regressions = 0
+    for name, result in sorted(data['results'].items()):
+        if name not in baseline or 'p50' not in result:
+            continue
+
+        old = baseline[name]
+        for metric, worse in [ ('p50', 1), ('p99', 1), ('throughput', -1) ]:
+            if not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            if change * worse > threshold:
+                regressions += 1
+                print("REGRESSION {} {}: {:.4f} -> {:.4f} ({:+.0%})".format(name, metric, old[metric], result[metric], change))
+
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files',         type = int, default = 1000000)
+    parser.add_argument('--paths',         type = int, default = 50000)
+    parser.add_argument('--tags',          type = int, default = 10000)
+    parser.add_argument('--days',          type = int, default = 365)
+    parser.add_argument('--start',         default = '2014-01-01')
+    parser.add_argument('--samples',       type = int, default = 1000, help = 'calls measured per operation')
+    parser.add_argument('--file-size',     type = int, default = 4096)
+    parser.add_argument('--bucket',        default = None, help = "defaults to config['s3.default_bucket']")
+    parser.add_argument('--local-root',    default = '/tmp/s3repo-bench')
+    parser.add_argument('--seed',          type = int, default = 42)
+    parser.add_argument('--small',         action = 'store_true', help = 'quick run: 20k files, 1k paths, 100 samples')
+    parser.add_argument('--skip-generate', action = 'store_true', help = 'reuse a previously generated repository')
+    parser.add_argument('--output',        default = 'bench_results.json')
+    parser.add_argument('--baseline',      help = 'results file to compare against')
+    parser.add_argument('--threshold',     type = float, default = 0.2, help = 'relative change reported as a regression')
+    args = parser.parse_args(argv)
+
+    if args.small:
+        args.files, args.paths, args.tags, args.samples = 20000, 1000, 1000, 100
+    if not args.bucket:
+        args.bucket = S3Repo.config['s3.default_bucket']
+
+    return args
+
+def main(argv):
+    args = parse_args(argv)
+    bench = Benchmark(args)
+    bench.run()
+    data = bench.report()
+
+    if args.baseline:
+        return 1 if compare(args.baseline, data, args.threshold) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
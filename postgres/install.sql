@@ -22,6 +22,8 @@ CREATE TABLE s3_repo.paths (
     local_path   TEXT
 );
 
+CREATE INDEX ON s3_repo.paths (local_path);
+
 CREATE TABLE s3_repo.files (
     file_id          SERIAL PRIMARY KEY,
     s3_bucket_id     INTEGER NOT NULL REFERENCES s3_repo.s3_buckets(s3_bucket_id),
@@ -38,6 +40,8 @@ CREATE TABLE s3_repo.files (
     date_archived    TIMESTAMP,
     date_expired     TIMESTAMP,
     published        BOOLEAN DEFAULT FALSE,
+    storage_tier     TEXT NOT NULL DEFAULT 'standard',
+    date_tiered      TIMESTAMP,
     --
     UNIQUE (s3_bucket_id, s3_key)
 );
@@ -66,10 +70,147 @@ CREATE TABLE s3_repo.downloads (
     host_id        INTEGER NOT NULL REFERENCES s3_repo.hosts(host_id),
     downloaded_utc TIMESTAMP NOT NULL,
     last_access    TIMESTAMP NOT NULL,
+    access_count   INTEGER NOT NULL DEFAULT 1,
+    last_verified  TIMESTAMP,
     --
     PRIMARY KEY (file_id, host_id)
 );
 
+-- Expired history moved out of s3_repo.files by S3Repo.archive_files.  Rows
+-- keep their file_id, and their S3 objects are retained.
+CREATE TABLE s3_repo.archived_files (
+    LIKE s3_repo.files INCLUDING DEFAULTS,
+    --
+    PRIMARY KEY (file_id)
+);
+
+CREATE INDEX ON s3_repo.archived_files (path_id);
+CREATE INDEX ON s3_repo.archived_files (s3_bucket_id, s3_key);
+
+CREATE TABLE s3_repo.archived_file_tags (
+    LIKE s3_repo.file_tags,
+    --
+    PRIMARY KEY (file_id, tag_id)
+);
+
+-- Advanced by every transaction which publishes, expires or deletes files, or
+-- changes tags.  Used to invalidate cached find_tagged results.  Sequences are
+-- neither transactional nor locked, so concurrent writers never wait on each
+-- other, and a rolled back transaction's version is never handed out again.
+-- Writers also hold the shared advisory lock s3_repo.repo_version until they
+-- commit, which lets readers tell whether a version may still be uncommitted.
+CREATE SEQUENCE s3_repo.repo_version;
+
+CREATE OR REPLACE FUNCTION s3_repo.bump_repo_version() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock_shared(hashtext('s3_repo.repo_version'));
+    PERFORM nextval('s3_repo.repo_version');
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER files_insert_repo_version
+    AFTER INSERT ON s3_repo.files
+    FOR EACH ROW WHEN (NEW.published)
+    EXECUTE PROCEDURE s3_repo.bump_repo_version();
+
+CREATE TRIGGER files_update_repo_version
+    AFTER UPDATE ON s3_repo.files
+    FOR EACH ROW WHEN (
+        OLD.published IS DISTINCT FROM NEW.published
+        OR OLD.date_published IS DISTINCT FROM NEW.date_published
+        OR OLD.date_expired IS DISTINCT FROM NEW.date_expired
+        OR OLD.path_id IS DISTINCT FROM NEW.path_id
+    )
+    EXECUTE PROCEDURE s3_repo.bump_repo_version();
+
+CREATE TRIGGER files_delete_repo_version
+    AFTER DELETE ON s3_repo.files
+    FOR EACH ROW WHEN (OLD.published)
+    EXECUTE PROCEDURE s3_repo.bump_repo_version();
+
+CREATE TRIGGER file_tags_repo_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON s3_repo.file_tags
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE s3_repo.bump_repo_version();
+
+CREATE TRIGGER path_tags_repo_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON s3_repo.path_tags
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE s3_repo.bump_repo_version();
+
+-- Publishes "table:id" on s3_repo_changes when a row is updated or deleted, so
+-- that other processes can evict it from their caches.  TG_ARGV[0] names the id column.
+CREATE OR REPLACE FUNCTION s3_repo.notify_change() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('s3_repo_changes', TG_TABLE_NAME || ':' || (row_to_json(OLD)->>TG_ARGV[0]));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER s3_buckets_notify_change
+    AFTER UPDATE OR DELETE ON s3_repo.s3_buckets
+    FOR EACH ROW EXECUTE PROCEDURE s3_repo.notify_change('s3_bucket_id');
+
+CREATE TRIGGER paths_notify_change
+    AFTER UPDATE OR DELETE ON s3_repo.paths
+    FOR EACH ROW EXECUTE PROCEDURE s3_repo.notify_change('path_id');
+
+CREATE TRIGGER hosts_notify_change
+    AFTER UPDATE OR DELETE ON s3_repo.hosts
+    FOR EACH ROW EXECUTE PROCEDURE s3_repo.notify_change('host_id');
+
+CREATE TRIGGER tags_notify_change
+    AFTER UPDATE OR DELETE ON s3_repo.tags
+    FOR EACH ROW EXECUTE PROCEDURE s3_repo.notify_change('tag_id');
+
+-- Publishes "file_id:path_id" on s3_repo_published when a file becomes current
+-- or is tagged, and ":path_id" when a path is tagged, for S3Repo.subscribe.
+CREATE OR REPLACE FUNCTION s3_repo.notify_publish() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'path_tags' THEN
+        PERFORM pg_notify('s3_repo_published', ':' || NEW.path_id);
+    ELSIF TG_TABLE_NAME = 'file_tags' THEN
+        PERFORM pg_notify('s3_repo_published', NEW.file_id || ':' || (
+            SELECT path_id
+            FROM s3_repo.files
+            WHERE file_id = NEW.file_id
+        ));
+    ELSE
+        PERFORM pg_notify('s3_repo_published', NEW.file_id || ':' || NEW.path_id);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER files_insert_notify_publish
+    AFTER INSERT ON s3_repo.files
+    FOR EACH ROW WHEN (NEW.published AND NEW.date_expired IS NULL)
+    EXECUTE PROCEDURE s3_repo.notify_publish();
+
+CREATE TRIGGER files_update_notify_publish
+    AFTER UPDATE ON s3_repo.files
+    FOR EACH ROW WHEN (
+        NEW.published
+        AND NEW.date_expired IS NULL
+        AND (
+            NOT OLD.published
+            OR OLD.date_expired IS NOT NULL
+            OR OLD.date_published IS DISTINCT FROM NEW.date_published
+        )
+    )
+    EXECUTE PROCEDURE s3_repo.notify_publish();
+
+CREATE TRIGGER file_tags_notify_publish
+    AFTER INSERT ON s3_repo.file_tags
+    FOR EACH ROW EXECUTE PROCEDURE s3_repo.notify_publish();
+
+CREATE TRIGGER path_tags_notify_publish
+    AFTER INSERT ON s3_repo.path_tags
+    FOR EACH ROW EXECUTE PROCEDURE s3_repo.notify_publish();
+
 CREATE OR REPLACE VIEW s3_repo.current_files AS
 SELECT DISTINCT ON (path_id) *
 FROM s3_repo.files
@@ -102,6 +243,18 @@ FROM s3_repo.files
     INNER JOIN s3_repo.tags USING (tag_id)
 ;
 
+CREATE OR REPLACE VIEW s3_repo.all_archived_file_tags AS
+SELECT s3_repo.archived_files.*, s3_repo.path_tags.tag_id, s3_repo.tags.tag_name
+FROM s3_repo.archived_files
+    INNER JOIN s3_repo.path_tags USING (path_id)
+    INNER JOIN s3_repo.tags USING (tag_id)
+UNION ALL
+SELECT s3_repo.archived_files.*, s3_repo.archived_file_tags.tag_id, s3_repo.tags.tag_name
+FROM s3_repo.archived_files
+    INNER JOIN s3_repo.archived_file_tags USING (file_id)
+    INNER JOIN s3_repo.tags USING (tag_id)
+;
+
 CREATE OR REPLACE VIEW s3_repo.host_cache_stats AS
 SELECT
     host_id                                   AS host_id,
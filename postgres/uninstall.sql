@@ -1,6 +1,13 @@
 DROP VIEW s3_repo.current_files;
 DROP VIEW s3_repo.current_file_tags;
 DROP VIEW s3_repo.all_file_tags;
+DROP VIEW s3_repo.all_archived_file_tags;
+
+DROP SEQUENCE s3_repo.repo_version;
+DROP TABLE s3_repo.archived_files, s3_repo.archived_file_tags;
+DROP FUNCTION s3_repo.bump_repo_version() CASCADE;
+DROP FUNCTION s3_repo.notify_change() CASCADE;
+DROP FUNCTION s3_repo.notify_publish() CASCADE;
 
 DROP TABLE s3_repo.hosts, s3_repo.tags, s3_repo.files, s3_repo.file_tags, s3_repo.path_tags, s3_repo.downloads;
 
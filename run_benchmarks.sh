@@ -0,0 +1,40 @@
+#!/bin/bash
+# Runs benchmarks/bench_repo.py against a scratch database and a local S3
+# stand-in (moto_server, "pip install moto[server]").  Arguments are passed
+# through, eg: ./run_benchmarks.sh --small --baseline bench_before.json
+find . -name '*pyc' | xargs rm -f
+export BENCHDB=s3repo_benchdb
+export BENCH_S3_PORT=${BENCH_S3_PORT:-5055}
+export S3_REPO_CFG=/tmp/s3repo_bench.cfg
+export PYTHONPATH=$PWD:$PYTHONPATH
+
+cat > $S3_REPO_CFG <<CFG
+{
+    "s3_access_key" : "bench",
+    "s3_secret_key" : "bench",
+    "s3.host" : "localhost",
+    "s3.port" : $BENCH_S3_PORT,
+    "s3.is_secure" : false,
+    "s3.default_bucket" : "s3repo-bench",
+    "backup.s3_bucket" : "s3repo-bench",
+    "fs.published_stale_seconds" : 86400,
+    "fs.unpublished_stale_seconds" : 86400,
+    "database" : {
+        "host"     : "localhost",
+        "port"     : 5432,
+        "database" : "$BENCHDB"
+    }
+}
+CFG
+
+dropdb $BENCHDB 2> /dev/null
+createdb $BENCHDB
+psql -Xq -d $BENCHDB -v ON_ERROR_STOP=1 -f postgres/install.sql
+
+moto_server s3 -p $BENCH_S3_PORT > /dev/null 2>&1 &
+MOTO_PID=$!
+trap "kill $MOTO_PID" EXIT
+sleep 2
+
+python -c "import s3repo.common; s3repo.common.s3_conn().create_bucket('s3repo-bench')"
+python benchmarks/bench_repo.py "$@"
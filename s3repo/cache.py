@@ -0,0 +1,85 @@
+import threading, collections
+import s3repo.common
+import s3repo.stats
+
+__all__ = [
+    'RowCache',
+    'evict',
+    'clear_all',
+]
+
+class RowCache(object):
+    """
+    Thread safe cache of one value per row id of table_name, filled by calling
+    loader(row_id) on a miss.  Entries are evicted individually when the row
+    changes (see s3repo.notify), and the least recently used are dropped once
+    there are more than max_size (default config['row_cache.size']).
+
+    Every eviction advances the cache's generation.  A value read from the
+    database is only primed if the generation is still the one taken before
+    the read, so a value read before a change can never be cached after the
+    change evicted it.
+    """
+    registry = {}
+
+    def __init__(self, table_name, loader, max_size = None):
+        self.table_name = table_name
+        self.loader     = loader
+        self.max_size   = max_size
+        self.values     = collections.OrderedDict()
+        self.generation = 0
+        self.lock       = threading.Lock()
+        RowCache.registry.setdefault(table_name, []).append(self)
+
+    def get(self, row_id):
+        with self.lock:
+            try:
+                value = self.values.pop(row_id)
+                self.values[row_id] = value
+                s3repo.stats.incr('row_cache.hit')
+                return value
+            except KeyError:
+                s3repo.stats.incr('row_cache.miss')
+                generation = self.generation
+
+        value = self.loader(row_id)
+        self.prime(row_id, value, generation)
+        return value
+
+    def prime(self, row_id, value, generation = None):
+        """
+        Caches value for row_id, unless generation is given and rows have been
+        evicted since it was taken.
+        """
+        max_size = self.max_size or s3repo.common.load_cfg().get('row_cache.size', 100000)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                s3repo.stats.incr('row_cache.stale')
+                return
+            self.values.pop(row_id, None)
+            self.values[row_id] = value
+            while len(self.values) > max_size:
+                self.values.popitem(last = False)
+
+    def evict(self, row_id):
+        with self.lock:
+            self.generation += 1
+            self.values.pop(row_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.values.clear()
+
+
+def evict(table_name, row_id):
+    """
+    Evicts row_id from every cache of table_name
+    """
+    for cache in RowCache.registry.get(table_name, []):
+        cache.evict(row_id)
+
+def clear_all():
+    for caches in RowCache.registry.values():
+        for cache in caches:
+            cache.clear()
@@ -1,11 +1,16 @@
-import os
-import boto
-import pyutil.pghelper
+import os, threading, contextlib
+import Queue
+import psycopg2.pool
 import pyutil.util
+import s3repo.stats
 
 __all__ = [
     'db_conn',
     's3_conn',
+    'release_conns',
+    'pooled_conns',
+    'ThreadConn',
+    'LazyConfig',
     'S3RepoTable'
 ]
 
@@ -14,6 +19,11 @@ __all__ = [
     "backup.s3_bucket" : "some-bucket",
     "s3_access_key" : "abc",
     "s3_secret_key" : "def",
+    "db.max_conns" : 32,
+    "s3.max_conns" : 32,
+    "s3.host" : "localhost",
+    "s3.port" : 5000,
+    "s3.is_secure" : false,
     "database" : {
         "host"     : "localhost",
         "port"     : 5432,
@@ -24,30 +34,222 @@ __all__ = [
 }
 """
 
-def load_cfg():
-    return pyutil.util.load_json_paths(
+def cfg_paths():
+    return [
         os.environ.get('S3_REPO_CFG', None),
         '~/.s3repo.cfg',
-    )
+    ]
+
+def cfg_stamp(paths):
+    stamp = []
+    for path in paths:
+        try:
+            stamp.append((path, os.stat(os.path.expanduser(path)).st_mtime))
+        except (OSError, TypeError, AttributeError):
+            stamp.append((path, None))
+
+    return tuple(stamp)
+
+_cfg = (None, None)
+def load_cfg():
+    """
+    Returns the parsed configuration.  The files are only re-read when the
+    configured paths or their modification times change.
+    """
+    global _cfg
+    paths = cfg_paths()
+    stamp = cfg_stamp(paths)
+    if _cfg[0] != stamp:
+        _cfg = (stamp, pyutil.util.load_json_paths(*paths))
+
+    return _cfg[1]
+
+
+class ThreadedConnMgr(object):
+    """
+    Hands each thread its own named Postgres connections, checked out of a pool
+    of at most max_conns connections.  A thread keeps its connections until it
+    calls release(), which rolls them back and returns them to the pool.  Threads
+    block while the pool is exhausted.
+    """
+    def __init__(self, max_conns, **conn_info):
+        self.pool  = psycopg2.pool.ThreadedConnectionPool(0, max_conns,
+            connection_factory = s3repo.stats.InstrumentedConnection,
+            **conn_info
+        )
+        self.slots = threading.BoundedSemaphore(max_conns)
+        self.local = threading.local()
+
+    def thread_conns(self):
+        if not hasattr(self.local, 'conns'):
+            self.local.conns = {}
+        return self.local.conns
+
+    def getconn(self, name = 'conn'):
+        conns = self.thread_conns()
+        if name not in conns:
+            self.slots.acquire()
+            try:
+                conns[name] = self.pool.getconn()
+            except:
+                self.slots.release()
+                raise
+
+        return conns[name]
+
+    def commit(self):
+        for conn in self.thread_conns().values():
+            conn.commit()
+
+    def rollback(self):
+        for conn in self.thread_conns().values():
+            conn.rollback()
+
+    def release(self):
+        conns = self.thread_conns()
+        while conns:
+            name, conn = conns.popitem()
+            try:
+                conn.rollback()
+            finally:
+                self.pool.putconn(conn)
+                self.slots.release()
+
+
+class S3ConnPool(object):
+    """
+    A bounded pool of boto S3 connections, which are not safe to share between
+    threads.  Each thread checks out a connection on first use and keeps it until
+    release() is called.  Threads block while all max_conns are checked out.
+    """
+    def __init__(self, max_conns, factory):
+        self.factory = factory
+        self.idle    = Queue.Queue()
+        self.slots   = threading.BoundedSemaphore(max_conns)
+        self.local   = threading.local()
+
+    def getconn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            self.slots.acquire()
+            try:
+                conn = self.idle.get_nowait()
+            except Queue.Empty:
+                try:
+                    conn = self.factory()
+                except:
+                    self.slots.release()
+                    raise
+
+            self.local.conn = conn
+
+        return conn
+
+    def release(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.conn = None
+            self.idle.put(conn)
+            self.slots.release()
+
+
+_init_lock = threading.Lock()
 
 db_mgr = None
 def db_conn(name = 'conn'):
     global db_mgr
-    app_cfg = load_cfg()
     if not db_mgr:
-        db_mgr = pyutil.pghelper.ConnMgr.default_from_info(**app_cfg['database'])
+        with _init_lock:
+            if not db_mgr:
+                app_cfg = load_cfg()
+                db_mgr = ThreadedConnMgr(app_cfg.get('db.max_conns', 32), **app_cfg['database'])
 
     return db_mgr.getconn(name)
 
 
-_s3_conn = None
+_s3_pool = None
 def s3_conn():
-    global _s3_conn
-    app_cfg = load_cfg()
-    if not _s3_conn:
-        _s3_conn = boto.connect_s3(
-            app_cfg['s3_access_key'],
-            app_cfg['s3_secret_key'],
-        )
+    global _s3_pool
+    if not _s3_pool:
+        with _init_lock:
+            if not _s3_pool:
+                app_cfg = load_cfg()
+                _s3_pool = S3ConnPool(app_cfg.get('s3.max_conns', 32), lambda: connect_s3(app_cfg))
+
+    return _s3_pool.getconn()
+
+def connect_s3(app_cfg):
+    """
+    Opens a boto S3 connection.  Setting s3.host (and optionally s3.port and
+    s3.is_secure) points it at an S3 compatible endpoint such as a local stand-in.
+    boto's own retries are disabled, unless the boto config sets num_retries.
+    """
+    import boto, boto.s3.connection
+
+    kwargs = {}
+    if app_cfg.get('s3.host'):
+        kwargs = {
+            'host'           : app_cfg['s3.host'],
+            'port'           : app_cfg.get('s3.port'),
+            'is_secure'      : app_cfg.get('s3.is_secure', True),
+            'calling_format' : boto.s3.connection.OrdinaryCallingFormat(),
+        }
+
+    conn = boto.connect_s3(
+        app_cfg['s3_access_key'],
+        app_cfg['s3_secret_key'],
+        **kwargs
+    )
+
+    # Requests are retried by s3repo.throttle, which must see each failure
+    conn.num_retries = 0
+
+    return conn
+
+
+def release_conns():
+    """
+    Returns the calling thread's Postgres and S3 connections to their pools.
+    Uncommitted work is rolled back.  Worker threads should call this when done.
+    """
+    if db_mgr:
+        db_mgr.release()
+    if _s3_pool:
+        _s3_pool.release()
+
+
+@contextlib.contextmanager
+def pooled_conns():
+    """
+    Releases the calling thread's connections on exit:
+
+        with s3repo.common.pooled_conns():
+            rf = S3Repo.get_file(path)
+            rf.download()
+            S3Repo.commit()
+    """
+    try:
+        yield
+    finally:
+        release_conns()
+
+
+class ThreadConn(object):
+    """
+    Class attribute which resolves to the calling thread's database connection,
+    so that DBTable subclasses can be used safely from many threads at once.
+    """
+    def __init__(self, name = 'conn'):
+        self.name = name
+
+    def __get__(self, obj, cls):
+        return db_conn(self.name)
+
 
-    return _s3_conn
+class LazyConfig(object):
+    """
+    Class attribute which resolves to the current configuration on access, so
+    that importing s3repo does not read it.
+    """
+    def __get__(self, obj, cls):
+        return load_cfg()
@@ -0,0 +1,210 @@
+"""
+Local cache spread over several disks.  With "cache.roots" configured, the
+cached copy of each file lives at <root>/<local_path> on the root chosen by
+weighted rendezvous hashing of its local_path, so adding or removing a disk only
+moves the files which must move.  Each root has its own capacity in bytes,
+enforced by maintain_current_host.  Transfers for each root run on that root's
+own worker threads, so throughput scales with the number of disks:
+
+    "cache.roots" : [
+        { "path" : "/mnt/nvme0", "max_size" : 1800000000000 },
+        { "path" : "/mnt/nvme1", "max_size" : 1800000000000 }
+    ],
+    "cache.threads_per_root" : 4
+
+Without "cache.roots", files are cached at their local_path, and transfers share
+a single set of workers.
+"""
+import os, math, Queue, shutil, hashlib, logging, threading
+import multiprocessing.pool
+import s3repo.common
+import s3repo.exceptions
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+__all__ = [
+    'CacheRoot',
+    'roots',
+    'root_for',
+    'cache_path',
+    'scan_trees',
+    'quarantine',
+    'submit',
+    'Task',
+]
+
+logger = logging.getLogger('s3repo.disks')
+
+# Downloads are written to <filename>.s3repo-partial and renamed once complete.
+# S3Repo.reconcile_host moves leftover partial files, and cached files matching
+# no version of their path, into a quarantine directory at the top of each root.
+PARTIAL_SUFFIX = '.s3repo-partial'
+QUARANTINE_DIR = '.s3repo-quarantine'
+
+class CacheRoot(object):
+    def __init__(self, path, max_size = None):
+        self.path     = path
+        self.max_size = max_size
+
+    def score(self, local_path):
+        """
+        Weighted rendezvous score of local_path on this root; the highest wins.
+        """
+        digest = hashlib.md5((self.path + '\0' + local_path).encode('utf-8')).hexdigest()
+        h = (int(digest[:13], 16) + 1) / float(16 ** 13 + 1)
+        return -(self.max_size or 1) / math.log(h)
+
+    def __repr__(self):
+        return "CacheRoot({}, {})".format(self.path, self.max_size)
+
+
+_roots = (None, [])
+def roots():
+    """
+    Returns the configured CacheRoots, which are rebuilt when the configuration changes.
+    """
+    global _roots
+    app_cfg = s3repo.common.load_cfg()
+    if _roots[0] is not app_cfg:
+        _roots = (app_cfg, [ CacheRoot(**x) for x in app_cfg.get('cache.roots', []) ])
+
+    return _roots[1]
+
+def root_for(local_path):
+    configured = roots()
+    if not configured:
+        return None
+    return max(configured, key = lambda root: root.score(local_path))
+
+def cache_path(local_path):
+    """
+    Returns where the cached copy of local_path is kept.
+    """
+    root = root_for(local_path)
+    if root is None:
+        return local_path
+    return os.path.join(root.path, local_path.lstrip('/'))
+
+def partial_path(filename):
+    """
+    Returns where a download to filename is written until it is complete.
+    """
+    return filename + PARTIAL_SUFFIX
+
+
+def scan_tree(top):
+    """
+    Returns the (filename, stat) of every regular file under top, skipping
+    quarantined files.
+    """
+    found = []
+    dirs = [ top ]
+    while dirs:
+        for entry in scandir(dirs.pop()):
+            if entry.is_dir(follow_symlinks = False):
+                if entry.name != QUARANTINE_DIR:
+                    dirs.append(entry.path)
+            elif entry.is_file(follow_symlinks = False):
+                found.append((entry.path, entry.stat()))
+
+    return found
+
+def scan_trees(tops, threads = 8):
+    """
+    Scans each of tops, in parallel over their top level directories.  Returns
+    a dict of top to the (filename, stat) of the files under it.
+    """
+    results = dict((top, []) for top in tops)
+    subdirs = []
+    for top in tops:
+        if not os.path.isdir(top):
+            continue
+
+        for entry in scandir(top):
+            if entry.is_dir(follow_symlinks = False):
+                if entry.name != QUARANTINE_DIR:
+                    subdirs.append((top, entry.path))
+            elif entry.is_file(follow_symlinks = False):
+                results[top].append((entry.path, entry.stat()))
+
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        for (top, _), found in zip(subdirs, pool.map(scan_tree, [ path for _, path in subdirs ])):
+            results[top].extend(found)
+    finally:
+        pool.close()
+
+    return results
+
+def quarantine(top, filename):
+    """
+    Moves filename, which is under top, into top's quarantine directory and
+    returns its new name.
+    """
+    target = os.path.join(top, QUARANTINE_DIR, os.path.relpath(filename, top))
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+
+    shutil.move(filename, target)
+    return target
+
+
+class Task(object):
+    """
+    A function queued on a root's workers.  wait() blocks until it has run and
+    returns its result, or raises its exception, or RepoTaskTimeoutError if it
+    has not run within timeout seconds.
+    """
+    def __init__(self, func):
+        self.func      = func
+        self.done      = threading.Event()
+        self.result    = None
+        self.exception = None
+
+    def run(self):
+        try:
+            with s3repo.common.pooled_conns():
+                self.result = self.func()
+                s3repo.common.db_mgr.commit()
+        except Exception as e:
+            logger.exception("cache task failed")
+            self.exception = e
+        finally:
+            self.done.set()
+
+    def wait(self, timeout = None):
+        if not self.done.wait(timeout):
+            raise s3repo.exceptions.RepoTaskTimeoutError(timeout)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+def submit(root, func):
+    """
+    Queues func on the workers of root (a CacheRoot, or None without cache
+    roots), starting them if needed.  Each task runs with its own pooled
+    connections and is committed on success.  Returns a Task.
+    """
+    key = root.path if root is not None else None
+    with _queues_lock:
+        if key not in _queues:
+            _queues[key] = Queue.Queue()
+            for i in range(s3repo.common.load_cfg().get('cache.threads_per_root', 4)):
+                thread = threading.Thread(target = worker, args = (_queues[key],), name = 's3repo-cache-{}'.format(key))
+                thread.daemon = True
+                thread.start()
+
+    task = Task(func)
+    _queues[key].put(task)
+    return task
+
+def worker(queue):
+    while True:
+        queue.get().run()
@@ -4,9 +4,13 @@ class RepoInternalError(RepoError): pass
 
 class RepoExternalError(RepoError): pass
 class RepoAPIError(RepoError): pass
+class RepoArchivedFileError(RepoAPIError): pass
 
 class RepoNoBackupsError(RepoExternalError): pass
 class RepoFileNotUploadedError(RepoExternalError): pass
+class RepoRestoreRequiredError(RepoExternalError): pass
+class RepoRestoreTimeoutError(RepoExternalError): pass
+class RepoTaskTimeoutError(RepoExternalError): pass
 
 class RepoAlreadyExistsError(RepoError): pass
 class RepoNoBackupsError(RepoError): pass
@@ -14,6 +18,7 @@ class RepoFileAlreadyExistsError(RepoError): pass
 class RepoFileDoesNotExistLocallyError(RepoError): pass
 class RepoUploadError(RepoError): pass
 class RepoDownloadError(RepoError): pass
+class RepoPurgeError(RepoError): pass
 class PurgingPublishedRecordError(RepoError): pass
 class NoConfigurationError(RepoError): pass
 class RepoConcurrentInsertionError(RepoError): pass
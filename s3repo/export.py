@@ -0,0 +1,260 @@
+"""
+Exports repo metadata as Arrow or Parquet files for analytics, so that jobs
+computing bytes per tag, host or day can run against a columnar snapshot rather
+than the database:
+
+    python -m s3repo.export --output /data/s3repo-snapshot --format parquet
+
+Each table is read with a single binary COPY, decoded incrementally into column
+lists, and written out in record batches of batch_rows, so memory is bounded by
+the batch size rather than the table.  Decoding is pure Python, one value at a
+time, so it still does work per value; what it avoids is text parsing and a
+RepoFile per row.  All tables are read in one REPEATABLE READ transaction, so
+the snapshot is consistent.  Requires pyarrow.
+"""
+import os, sys, time, struct, argparse, collections
+import s3repo.common
+import s3repo.stats
+
+__all__ = [
+    'tables',
+    'CopyDecoder',
+    'export_table',
+    'export_tables',
+]
+
+# Columns of each exported table, with the postgres type each is read as
+tables = collections.OrderedDict([
+    ('files', [
+        ('file_id',        'int4'),
+        ('s3_bucket_id',   'int4'),
+        ('path_id',        'int4'),
+        ('origin',         'int4'),
+        ('s3_key',         'text'),
+        ('md5',            'text'),
+        ('guid',           'text'),
+        ('file_size',      'int8'),
+        ('published',      'bool'),
+        ('storage_tier',   'text'),
+        ('date_created',   'timestamp'),
+        ('date_uploaded',  'timestamp'),
+        ('date_published', 'timestamp'),
+        ('date_archived',  'timestamp'),
+        ('date_expired',   'timestamp'),
+        ('date_tiered',    'timestamp'),
+    ]),
+    ('file_tags', [
+        ('file_id',     'int4'),
+        ('tag_id',      'int4'),
+        ('date_tagged', 'timestamp'),
+    ]),
+    ('path_tags', [
+        ('path_id',     'int4'),
+        ('tag_id',      'int4'),
+        ('date_tagged', 'timestamp'),
+    ]),
+    ('downloads', [
+        ('file_id',        'int4'),
+        ('host_id',        'int4'),
+        ('downloaded_utc', 'timestamp'),
+        ('last_access',    'timestamp'),
+        ('access_count',   'int4'),
+        ('last_verified',  'timestamp'),
+    ]),
+    ('paths', [
+        ('path_id',    'int4'),
+        ('local_path', 'text'),
+    ]),
+    ('s3_buckets', [
+        ('s3_bucket_id', 'int4'),
+        ('s3_bucket',    'text'),
+    ]),
+    ('tags', [
+        ('tag_id',   'int4'),
+        ('tag_name', 'text'),
+    ]),
+    ('hosts', [
+        ('host_id',        'int4'),
+        ('hostname',       'text'),
+        ('max_cache_size', 'int8'),
+        ('active',         'bool'),
+    ]),
+])
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+PG_EPOCH_MICROS = 946684800 * 1000000 # 2000-01-01, the zero of postgres timestamps
+
+decoders = {
+    'int4'      : lambda data: struct.unpack('>i', data)[0],
+    'int8'      : lambda data: struct.unpack('>q', data)[0],
+    'bool'      : lambda data: data != b'\x00',
+    'text'      : lambda data: data.decode('utf-8'),
+    'timestamp' : lambda data: struct.unpack('>q', data)[0] + PG_EPOCH_MICROS,
+}
+
+class CopyDecoder(object):
+    """
+    File-like target for cursor.copy_expert which decodes a binary COPY stream
+    of columns as it arrives.  on_batch(values) is called with a list of values
+    per column for every batch_rows rows, and for the remainder on close().
+    Timestamps are decoded as microseconds since the unix epoch.
+    """
+    def __init__(self, columns, on_batch, batch_rows = 65536):
+        self.decoders   = [ decoders[type_name] for _, type_name in columns ]
+        self.on_batch   = on_batch
+        self.batch_rows = batch_rows
+        self.buf        = b''
+        self.in_header  = True
+        self.rows       = 0
+        self.values     = [ [] for _ in columns ]
+
+    def write(self, data):
+        buf = self.buf + data
+        pos = 0
+        size = len(buf)
+
+        if self.in_header:
+            if size < 19:
+                self.buf = buf
+                return
+            if buf[:11] != COPY_SIGNATURE:
+                raise ValueError("not a binary COPY stream")
+            header_size = 19 + struct.unpack_from('>i', buf, 15)[0]
+            if size < header_size:
+                self.buf = buf
+                return
+            pos = header_size
+            self.in_header = False
+
+        while size - pos >= 2:
+            num_fields = struct.unpack_from('>h', buf, pos)[0]
+            if num_fields == -1:
+                pos += 2
+                break
+
+            end = pos + 2
+            row = []
+            for decode in self.decoders:
+                if size - end < 4:
+                    break
+                length = struct.unpack_from('>i', buf, end)[0]
+                end += 4
+                if length == -1:
+                    row.append(None)
+                    continue
+                if size - end < length:
+                    break
+                row.append(decode(buf[end:end + length]))
+                end += length
+
+            if len(row) < num_fields:
+                break
+
+            for values, value in zip(self.values, row):
+                values.append(value)
+            pos = end
+            self.rows += 1
+
+            if len(self.values[0]) >= self.batch_rows:
+                self.flush()
+
+        self.buf = buf[pos:]
+
+    def flush(self):
+        if self.values[0]:
+            self.on_batch(self.values)
+            self.values = [ [] for _ in self.values ]
+
+    def close(self):
+        self.flush()
+
+
+def arrow_schema(columns):
+    import pyarrow
+    arrow_types = {
+        'int4'      : pyarrow.int32(),
+        'int8'      : pyarrow.int64(),
+        'bool'      : pyarrow.bool_(),
+        'text'      : pyarrow.string(),
+        'timestamp' : pyarrow.timestamp('us'),
+    }
+
+    return pyarrow.schema([ (name, arrow_types[type_name]) for name, type_name in columns ])
+
+def export_table(conn, table_name, writer_factory, batch_rows = 65536):
+    """
+    Streams s3_repo.table_name into record batches, which are written to the
+    writer writer_factory(schema) returns.  Returns the number of rows exported.
+    """
+    import pyarrow
+    columns = tables[table_name]
+    schema = arrow_schema(columns)
+    writer = writer_factory(schema)
+
+    def on_batch(values):
+        writer.write_batch(pyarrow.RecordBatch.from_arrays(
+            [ pyarrow.array(column, type = field.type) for column, field in zip(values, schema) ],
+            schema.names,
+        ))
+
+    decoder = CopyDecoder(columns, on_batch, batch_rows)
+    try:
+        with s3repo.stats.timer('export.' + table_name):
+            conn.cursor().copy_expert("COPY (SELECT {} FROM s3_repo.{}) TO STDOUT WITH (FORMAT binary)".format(
+                ', '.join('{}::{}'.format(name, type_name) for name, type_name in columns),
+                table_name,
+            ), decoder)
+        decoder.close()
+    finally:
+        writer.close()
+
+    s3repo.stats.incr('export.rows', decoder.rows)
+    return decoder.rows
+
+def export_tables(output_dir, table_names = None, format = 'parquet', batch_rows = 65536, conn = None):
+    """
+    Writes each table (by default, all of them) to output_dir/table_name.parquet
+    or .arrow.  Returns a dict of rows exported per table.
+    """
+    import pyarrow
+    if format == 'parquet':
+        import pyarrow.parquet
+        factory = lambda filename: lambda schema: pyarrow.parquet.ParquetWriter(filename, schema)
+    elif format == 'arrow':
+        factory = lambda filename: lambda schema: pyarrow.RecordBatchFileWriter(filename, schema)
+    else:
+        raise ValueError("unknown format: {}".format(format))
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    conn = conn or s3repo.common.db_conn('export')
+    conn.rollback()
+    conn.cursor().execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+
+    try:
+        results = collections.OrderedDict()
+        for table_name in table_names or tables.keys():
+            filename = os.path.join(output_dir, '{}.{}'.format(table_name, format))
+            results[table_name] = export_table(conn, table_name, factory(filename), batch_rows)
+        return results
+    finally:
+        conn.rollback()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Export repo metadata as Parquet or Arrow files.')
+    parser.add_argument('--output',     required = True, help = 'directory to write to')
+    parser.add_argument('--format',     default = 'parquet', choices = [ 'parquet', 'arrow' ])
+    parser.add_argument('--table',      action = 'append', choices = list(tables), help = 'defaults to all tables')
+    parser.add_argument('--batch-rows', type = int, default = 65536)
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    for table_name, rows in export_tables(args.output, args.table, args.format, args.batch_rows).items():
+        print("{:<12} {:>12} rows".format(table_name, rows))
+    print("exported in {:.1f}s".format(time.time() - start))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
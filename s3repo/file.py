@@ -1,20 +1,38 @@
-import os, subprocess
+import os, time, base64, hashlib
 import s3repo.common
+import s3repo.stats
+import s3repo.cache
+import s3repo.storage
+import s3repo.transfers
+import s3repo.prepared
+import s3repo.disks
+import s3repo.writer
 import s3repo.exceptions
 import s3repo.tag
 import pyutil.pghelper
 import pyutil.dbtable
-from boto.s3.key import Key, compute_md5
-from pyutil.decorators import memoize
 from pyutil.dateutil import *
 from pyutil.util import *
 from pyutil.util import is_online, assert_online
 
+# Queries over s3_repo.files (as rf) can also select the bucket and path names
+# of each file by adding these, and pass preload = True to RepoFile.find_by_sql.
+PRELOAD_COLUMNS = """
+    b.s3_bucket  AS bucket_name,
+    p.local_path AS path_name
+"""
+PRELOAD_JOINS = """
+    INNER JOIN s3_repo.s3_buckets b
+        USING (s3_bucket_id)
+    INNER JOIN s3_repo.paths p
+        USING (path_id)
+"""
+
 
 class S3Bucket(pyutil.dbtable.DBTable):
     table_name = 's3_repo.s3_buckets'
     memoize    = True
-    conn       = s3repo.common.db_conn()
+    conn       = s3repo.common.ThreadConn()
 
     id_field = 's3_bucket_id'
     key_fields = [
@@ -28,7 +46,7 @@ class S3Bucket(pyutil.dbtable.DBTable):
 
 class LocalPath(pyutil.dbtable.DBTable):
     table_name = 's3_repo.paths'
-    conn       = s3repo.common.db_conn()
+    conn       = s3repo.common.ThreadConn()
 
     id_field   = 'path_id'
     key_fields = [
@@ -40,11 +58,7 @@ class LocalPath(pyutil.dbtable.DBTable):
     ]
 
     def find_current(self):
-        results = RepoFile.find_by_sql("""
-            select *
-            from s3_repo.current_files
-            where path_id = %(path_id)s
-        """, path_id = self.path_id)
+        results = RepoFile.find_by_sql(self.find_current_sql.sql(RepoFile.conn), preload = True, path_id = self.path_id)
 
         if not results:
             return None
@@ -52,9 +66,13 @@ class LocalPath(pyutil.dbtable.DBTable):
             return results[0]
 
 
+S3Bucket.names = s3repo.cache.RowCache('s3_buckets', lambda s3_bucket_id: S3Bucket.find_by_id(s3_bucket_id).s3_bucket)
+LocalPath.local_paths = s3repo.cache.RowCache('paths', lambda path_id: LocalPath.find_by_id(path_id).local_path)
+
+
 class RepoFile(pyutil.dbtable.DBTable):
     table_name = 's3_repo.files'
-    conn       = s3repo.common.db_conn()
+    conn       = s3repo.common.ThreadConn()
 
     id_field   = 'file_id'
     key_fields = [
@@ -78,18 +96,40 @@ class RepoFile(pyutil.dbtable.DBTable):
         'date_published',
         'date_archived',
         'date_expired',
+        'storage_tier',
+        'date_tiered',
     ]
 
+    bucket_name = None
+    path_name   = None
+
+    @classmethod
+    def find_by_sql(cls, sql, preload = False, **bind_params):
+        """
+        With preload, sql must select PRELOAD_COLUMNS, which are kept on each file
+        and fill the bucket and path name caches, so s3_bucket() and local_path()
+        need no queries of their own.  Names which were not selected are left
+        to be looked up as usual, rather than cached as None.
+        """
+        # Taken before the query, so names evicted while it runs are not primed
+        generations = (S3Bucket.names.generation, LocalPath.local_paths.generation)
+        files = super(RepoFile, cls).find_by_sql(sql, **bind_params)
+        if preload:
+            for rf in files:
+                if rf.bucket_name is not None:
+                    S3Bucket.names.prime(rf.s3_bucket_id, rf.bucket_name, generations[0])
+                if rf.path_name is not None:
+                    LocalPath.local_paths.prime(rf.path_id, rf.path_name, generations[1])
+        return files
+
     def s3_path(self):
         return "s3://{}/{}".format(self.s3_bucket(), self.s3_key)
 
-    @memoize(obj=True)
     def s3_bucket(self):
-        return S3Bucket.find_by_id(self.s3_bucket_id).s3_bucket
+        return self.bucket_name or S3Bucket.names.get(self.s3_bucket_id)
 
-    @memoize(obj=True)
     def local_path(self):
-        return LocalPath.find_by_id(self.path_id).local_path
+        return self.path_name or LocalPath.local_paths.get(self.path_id)
 
     def after_insert(self):
         super(RepoFile, self).after_insert()
@@ -109,21 +149,33 @@ class RepoFile(pyutil.dbtable.DBTable):
             self.date_expired = now()
         self.update()
 
+    def storage(self):
+        return s3repo.storage.backend(self.s3_bucket())
+
+    def cache_path(self):
+        """
+        Where the local copy of the file is kept: local_path, or with cache roots
+        configured, local_path under the root it hashes to (see s3repo.disks).
+        """
+        return s3repo.disks.cache_path(self.local_path())
+
     def upload(self):
         if self.date_uploaded:
             return
 
-        if not os.path.exists(self.local_path()):
+        # Files written directly to local_path rather than through open() are uploaded from there
+        filename = self.cache_path()
+        if not os.path.exists(filename):
+            filename = self.local_path()
+        if not os.path.exists(filename):
             raise s3repo.exceptions.RepoFileDoesNotExistLocallyError()
 
         if not self.file_size:
-            with open(self.local_path(), 'r') as fp:
+            with s3repo.stats.timer('file.md5'), open(filename, 'rb') as fp:
                 self.md5, self.b64, self.file_size = compute_md5(fp)
 
         if is_online():
-            remote_bucket = s3repo.common.s3_conn().get_bucket(self.s3_bucket())
-            remote_key = Key(remote_bucket, self.s3_key)
-            remote_key.set_contents_from_filename(self.local_path(), md5=(self.md5, self.b64, self.file_size))
+            self.storage().put(self.s3_bucket(), self.s3_key, filename, md5=(self.md5, self.b64, self.file_size))
 
         self.date_uploaded = now()
 
@@ -132,12 +184,22 @@ class RepoFile(pyutil.dbtable.DBTable):
             raise s3repo.exceptions.PurgingPublishedRecordError()
 
         if is_online():
-            remote_bucket = s3repo.common.s3_conn().get_bucket(self.s3_bucket())
-            remote_key = Key(remote_bucket, self.s3_key)
-            remote_bucket.delete_key(remote_key)
+            self.storage().delete(self.s3_bucket(), [ self.s3_key ])
 
         self.unlink()
 
+    @classmethod
+    def purge_keys(cls, s3_bucket, s3_keys):
+        """
+        Removes s3_keys from s3_bucket in bulk (for S3, with the multi-object delete API).
+        Returns the number of keys submitted for deletion.
+        """
+        s3_keys = list(s3_keys)
+        if not s3_keys or not is_online():
+            return 0
+
+        return s3repo.storage.backend(s3_bucket).delete(s3_bucket, s3_keys)
+
     def download(self):
         """
         Download the file to the local cache
@@ -145,51 +207,110 @@ class RepoFile(pyutil.dbtable.DBTable):
         if not self.date_uploaded:
             raise s3repo.exceptions.RepoFileNotUploadedError()
 
-        if os.path.exists(self.local_path()):
+        filename = self.cache_path()
+        if os.path.exists(filename):
+            s3repo.stats.incr('cache.hit')
             return
 
+        s3repo.stats.incr('cache.miss')
         assert_online()
 
-        remote_key = Key(s3repo.common.s3_conn().get_bucket(self.s3_bucket()), self.s3_key)
-        remote_key.get_contents_to_filename(self.local_path())
+        self.restore()
+        mkdirp(os.path.dirname(filename))
 
-        if self.md5:
-            real_md5 = subprocess.check_output([ "md5", "-q", self.local_path() ])[:-1]
-            if real_md5 != self.md5:
-                raise s3repo.exceptions.RepoDownloadError()
+        # Written aside and renamed, so an interrupted download never looks cached
+        partial = s3repo.disks.partial_path(filename)
+        try:
+            self.storage().get(self.s3_bucket(), self.s3_key, partial)
+
+            if self.md5:
+                with s3repo.stats.timer('file.md5'), open(partial, 'rb') as fp:
+                    real_md5 = compute_md5(fp)[0]
+                if real_md5 != self.md5:
+                    raise s3repo.exceptions.RepoDownloadError()
+
+            os.rename(partial, filename)
+        finally:
+            if os.path.exists(partial):
+                os.unlink(partial)
 
         s3repo.host.RepoFileDownload.flag_download(self)
 
+    def restore(self, timeout = None):
+        """
+        Makes a file in a cold storage tier readable, waiting up to timeout seconds
+        (default config['tiering.restore_timeout_seconds'], forever if unset) for
+        the restore to complete.
+        """
+        storage = self.storage()
+        if self.storage_tier not in storage.cold_tiers or storage.is_restored(self.s3_bucket(), self.s3_key):
+            return
+
+        app_cfg = s3repo.common.load_cfg()
+        if timeout is None:
+            timeout = app_cfg.get('tiering.restore_timeout_seconds')
+        poll_seconds = app_cfg.get('tiering.restore_poll_seconds', 60)
+        deadline = None if timeout is None else time.time() + timeout
+
+        s3repo.stats.incr('file.restores')
+        storage.restore(self.s3_bucket(), self.s3_key, app_cfg.get('tiering.restore_days', 1))
+
+        with s3repo.stats.timer('file.restore'):
+            while not storage.is_restored(self.s3_bucket(), self.s3_key):
+                if deadline is not None and time.time() >= deadline:
+                    raise s3repo.exceptions.RepoRestoreTimeoutError(self.s3_path())
+                time.sleep(poll_seconds if deadline is None else max(0, min(poll_seconds, deadline - time.time())))
+
+    def prefetch(self):
+        """
+        Queues the file for download to the local cache on the workers of its
+        cache root, as a background transfer.  Returns the s3repo.disks.Task.
+        """
+        def download():
+            with s3repo.transfers.priority('background'):
+                return self.download()
+
+        return s3repo.disks.submit(s3repo.disks.root_for(self.local_path()), download)
+
     def unlink(self):
         """
         Remove the file from the local cache
         """
         s3repo.host.RepoFileDownload.remove_download(self)
-        if os.path.exists(self.local_path()):
-            os.unlink(self.local_path())
+        if os.path.exists(self.cache_path()):
+            os.unlink(self.cache_path())
 
+    @s3repo.stats.timed('file.open')
     def open(self, mode='r'):
         """
         Returns a file pointer to the current file.
         """
         if mode == 'r' and self.date_uploaded:
-            self.download()
+            with s3repo.transfers.priority('foreground'):
+                self.download()
         elif mode == 'w':
-            mkdirp(os.path.dirname(self.local_path()))
+            mkdirp(os.path.dirname(self.cache_path()))
 
         s3repo.host.RepoFileDownload.update_access_time(self)
 
         if self.s3_key.endswith(".gz"):
-            return gzip.open(self.local_path(), mode)
+            return gzip.open(self.cache_path(), mode)
         else:
-            return open(self.local_path(), mode)
+            return open(self.cache_path(), mode)
+
+    def writer(self, cache = True):
+        """
+        Returns a RepoFileWriter, which uploads the file as it is written, and
+        with cache also writes it to the local cache (see s3repo.writer).
+        """
+        return s3repo.writer.RepoFileWriter(self, cache = cache, part_size = s3repo.common.load_cfg().get('s3.part_size', 16 * 1024 * 1024))
 
     def touch(self, contents = ""):
         """
         Ensures the repo file exists.
         """
-        mkdirp(os.path.dirname(self.local_path()))
-        with open(self.local_path(), 'a') as fp:
+        mkdirp(os.path.dirname(self.cache_path()))
+        with open(self.cache_path(), 'a') as fp:
             if contents:
                 fp.write(contents)
             fp.flush()
@@ -231,3 +352,67 @@ class RepoFile(pyutil.dbtable.DBTable):
             origin     = self.origin,
         )
 
+
+# Columns are listed rather than rf.*, as a prepared statement's result type is
+# fixed, and adding a column to s3_repo.files would break it in open sessions.
+LocalPath.find_current_sql = s3repo.prepared.register('find_current_file', """
+    select {}, {}
+    from s3_repo.current_files rf
+        {}
+    where path_id = %(path_id)s
+""".format(', '.join('rf.' + x for x in RepoFile.fields), PRELOAD_COLUMNS, PRELOAD_JOINS), [ ('path_id', 'INTEGER') ])
+
+
+class ArchivedFile(RepoFile):
+    """
+    A file moved to s3_repo.archived_files by S3Repo.archive_files.  Archived
+    files are read only, and their contents are fetched to an explicit
+    filename because the local path belongs to the current version.
+    """
+    table_name = 's3_repo.archived_files'
+
+    def fetch(self, filename):
+        if not self.date_uploaded:
+            raise s3repo.exceptions.RepoFileNotUploadedError()
+
+        assert_online()
+        mkdirp(os.path.dirname(filename))
+        self.restore()
+        self.storage().get(self.s3_bucket(), self.s3_key, filename)
+
+    def read_only(self, *args, **kwargs):
+        raise s3repo.exceptions.RepoArchivedFileError(self.file_id)
+
+    publish    = read_only
+    expire     = read_only
+    purge      = read_only
+    download   = read_only
+    open       = read_only
+    writer     = read_only
+    touch      = read_only
+    update     = read_only
+    delete     = read_only
+    tag_file   = read_only
+    untag_file = read_only
+
+    def __repr__(self):
+        return "ArchivedFile({s3_path} ( {local_path} )".format(
+            s3_path    = self.s3_path(),
+            local_path = self.local_path(),
+        )
+
+
+def compute_md5(fp, buf_size = 1024 * 1024, limiter = None):
+    """
+    Returns the (hexdigest, b64digest, size) of the rest of fp, reading within
+    the budget of limiter (an s3repo.transfers.RateLimiter) if given.
+    """
+    md5 = hashlib.md5()
+    size = 0
+    for chunk in iter(lambda: fp.read(buf_size), b''):
+        if limiter is not None:
+            limiter.consume(len(chunk))
+        md5.update(chunk)
+        size += len(chunk)
+
+    return md5.hexdigest(), base64.b64encode(md5.digest()), size
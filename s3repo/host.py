@@ -1,5 +1,7 @@
 import socket
 import s3repo.common
+import s3repo.stats
+import s3repo.prepared
 import pyutil.pghelper
 import pyutil.dbtable
 from pyutil.decorators import *
@@ -8,7 +10,7 @@ from pyutil.dateutil import *
 class RepoHost(pyutil.dbtable.DBTable):
     table_name = 's3_repo.hosts'
     memoize    = True
-    conn       = s3repo.common.db_conn()
+    conn       = s3repo.common.ThreadConn()
 
     id_field   = 'host_id'
     key_fields = [
@@ -36,7 +38,7 @@ class RepoHost(pyutil.dbtable.DBTable):
 
 class RepoFileDownload(pyutil.dbtable.DBTable):
     table_name = 's3_repo.downloads'
-    conn       = s3repo.common.db_conn()
+    conn       = s3repo.common.ThreadConn()
 
     key_fields = [
         'file_id',
@@ -48,24 +50,58 @@ class RepoFileDownload(pyutil.dbtable.DBTable):
         'host_id',
         'downloaded_utc',
         'last_access',
+        'access_count',
+        'last_verified',
     ]
 
+    touch_download_sql = s3repo.prepared.register('touch_download', """
+        UPDATE s3_repo.downloads
+        SET last_access = %(now)s,
+            access_count = access_count + 1
+        WHERE file_id = %(file_id)s
+            AND host_id = %(host_id)s
+    """, [ ('file_id', 'INTEGER'), ('host_id', 'INTEGER'), ('now', 'TIMESTAMP') ])
+
+    flag_download_sql = s3repo.prepared.register('flag_download', """
+        INSERT INTO s3_repo.downloads (
+            file_id,
+            host_id,
+            downloaded_utc,
+            last_access
+        )
+        SELECT %(file_id)s, %(host_id)s, %(now)s, %(now)s
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM s3_repo.downloads
+            WHERE file_id = %(file_id)s
+                AND host_id = %(host_id)s
+        )
+    """, [ ('file_id', 'INTEGER'), ('host_id', 'INTEGER'), ('now', 'TIMESTAMP') ])
+
     @classmethod
+    @s3repo.stats.timed('host.update_access_time')
     def update_access_time(cls, rf):
-        rf = cls.find_or_create(rf.file_id, RepoHost.current_host_id(),
-            last_access    = now(),
-        )
-        rf.last_access = now()
-        rf.update()
+        cur = cls.conn.cursor()
+        cur.execute(cls.touch_download_sql.sql(cls.conn), {
+            'file_id' : rf.file_id,
+            'host_id' : RepoHost.current_host_id(),
+            'now'     : now(),
+        })
+
+        if cur.rowcount == 0:
+            cls.flag_download(rf)
 
     @classmethod
+    @s3repo.stats.timed('host.flag_download')
     def flag_download(cls, rf):
-        cls.find_or_create(rf.file_id, RepoHost.current_host_id(),
-            downloaded_utc = now(),
-            last_access    = now(),
-        )
+        cls.conn.cursor().execute(cls.flag_download_sql.sql(cls.conn), {
+            'file_id' : rf.file_id,
+            'host_id' : RepoHost.current_host_id(),
+            'now'     : now(),
+        })
 
     @classmethod
+    @s3repo.stats.timed('host.remove_download')
     def remove_download(cls, rf):
         rf = cls.find_by_key(rf.file_id, RepoHost.current_host_id())
         if rf:
@@ -0,0 +1,161 @@
+"""
+S3 key layouts.  add_file names each new file's key with the layout of its
+bucket, chosen by "keys.layouts", or "keys.layout" for buckets without an entry:
+
+    "keys.layout"  : "flat",
+    "keys.layouts" : {
+        "hot-bucket"  : { "type" : "hash_prefix", "chars" : 4 },
+        "logs-bucket" : "date_first"
+    }
+
+- flat:        <local_path>/<version>, the original layout
+- hash_prefix: <first chars of md5(local_path)>/<local_path>/<version>, which
+               spreads paths over many prefixes, as S3 limits request rates
+               per prefix
+- date_first:  <YYYY/MM/DD/HH>/<local_path>/<version>
+
+A layout may also be given as "module.name" of a KeyLayout subclass, which
+must be able to find a path's keys again as well as name them.  Keys are
+stored with each file, so changing a bucket's layout only affects new files.
+
+Versions (see version()) are unique across hosts and processes, so any number
+of versions of a path can be added per second without colliding.
+"""
+import os, time, hashlib, importlib, threading
+import s3repo.common
+
+__all__ = [
+    'KeyLayout',
+    'FlatLayout',
+    'HashPrefixLayout',
+    'DateFirstLayout',
+    'version',
+    'layout',
+    'reset',
+]
+
+_last_ns = 0
+_version_lock = threading.Lock()
+
+def version(host_id, guid):
+    """
+    Returns the version for a new key: <nanoseconds since the epoch>-<host_id>-<8
+    characters of guid>.  Timestamps are zero padded to sort by time, and never
+    repeat within a process; the host id and guid separate processes and hosts.
+    """
+    global _last_ns
+    with _version_lock:
+        _last_ns = max(_last_ns + 1, int(time.time() * 1000000000))
+        ns = _last_ns
+
+    return '{:019d}-{}-{}'.format(ns, host_id, guid.replace('-', '')[:8])
+
+
+class KeyLayout(object):
+    """
+    Every layout ends keys with <local_path>/<version>.
+    """
+    def key(self, local_path, version, when):
+        raise NotImplementedError()
+
+    def prefix(self, local_path):
+        """
+        Returns a key prefix shared by every key of local_path, for listing.
+        """
+        return ''
+
+    def owns(self, key, local_path):
+        """
+        Returns whether key is a version of local_path, and not of any other path.
+        """
+        raise NotImplementedError()
+
+
+class FlatLayout(KeyLayout):
+    def key(self, local_path, version, when):
+        return os.path.join(local_path, version)
+
+    def prefix(self, local_path):
+        return os.path.join(local_path, '')
+
+    def owns(self, key, local_path):
+        head, _, version = key.rpartition('/')
+        return bool(version) and head == local_path.rstrip('/')
+
+
+class HashPrefixLayout(KeyLayout):
+    def __init__(self, chars = 4):
+        self.chars = chars
+
+    def shard(self, local_path):
+        return hashlib.md5(local_path.encode('utf-8')).hexdigest()[:self.chars]
+
+    def key(self, local_path, version, when):
+        return '/'.join([ self.shard(local_path), local_path.strip('/'), version ])
+
+    def prefix(self, local_path):
+        return '/'.join([ self.shard(local_path), local_path.strip('/'), '' ])
+
+    def owns(self, key, local_path):
+        head, _, version = key.rpartition('/')
+        return bool(version) and head == '/'.join([ self.shard(local_path), local_path.strip('/') ])
+
+
+class DateFirstLayout(KeyLayout):
+    """
+    Keys share no prefix per path, so listing a path's keys scans the bucket.
+    """
+    def key(self, local_path, version, when):
+        return '/'.join([ when.strftime('%Y/%m/%d/%H'), local_path.strip('/'), version ])
+
+    def owns(self, key, local_path):
+        head, _, version = key.rpartition('/')
+        segments = head.split('/', 4)
+        return (
+            bool(version)
+            and len(segments) == 5
+            and all(x.isdigit() for x in segments[:4])
+            and segments[4] == local_path.strip('/')
+        )
+
+
+layout_types = {
+    'flat'        : FlatLayout,
+    'hash_prefix' : HashPrefixLayout,
+    'date_first'  : DateFirstLayout,
+}
+
+def load_layout(info):
+    info = dict(info) if isinstance(info, dict) else { 'type' : info }
+    layout_type = info.pop('type')
+    if layout_type not in layout_types:
+        module_name, _, attr = layout_type.rpartition('.')
+        obj = getattr(importlib.import_module(module_name), attr)
+        if not (isinstance(obj, type) and issubclass(obj, KeyLayout)):
+            raise ValueError("{} is not a KeyLayout subclass".format(layout_type))
+        return obj(**info)
+
+    return layout_types[layout_type](**info)
+
+_layouts = (None, {})
+def layout(bucket):
+    """
+    Returns the KeyLayout of bucket.  Layouts are rebuilt when the configuration changes.
+    """
+    global _layouts
+    app_cfg = s3repo.common.load_cfg()
+    if _layouts[0] is not app_cfg:
+        _layouts = (app_cfg, {})
+
+    layouts = _layouts[1]
+    if bucket not in layouts:
+        layouts[bucket] = load_layout(app_cfg.get('keys.layouts', {}).get(bucket) or app_cfg.get('keys.layout') or 'flat')
+
+    return layouts[bucket]
+
+def reset():
+    """
+    Forgets bucket layouts so that they are rebuilt from the configuration.
+    """
+    global _layouts
+    _layouts = (None, {})
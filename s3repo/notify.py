@@ -0,0 +1,172 @@
+"""
+Cross process cache invalidation over Postgres LISTEN/NOTIFY.
+
+Triggers on s3_repo.s3_buckets, paths, hosts and tags publish "table:id" on
+the s3_repo_changes channel whenever a row is updated or deleted.  Notifications
+are delivered when the writing transaction commits.  A Listener evicts exactly
+those rows from the library's RowCaches.  The DBTable memoize caches of
+S3Bucket, RepoHost and Tag cannot be addressed by row, so a change to one of
+those tables clears that class's cache only.
+
+Newly current and newly tagged files are announced on s3_repo_published, which
+S3Repo.subscribe and S3Repo.wait_for listen to.
+
+    s3repo.notify.start_listener()
+"""
+import time, select, logging, threading
+import psycopg2, psycopg2.extensions
+import pyutil.dbtable
+import s3repo.common
+import s3repo.stats
+import s3repo.cache
+
+__all__ = [
+    'CHANGES_CHANNEL',
+    'PUBLISH_CHANNEL',
+    'Listener',
+    'start_listener',
+    'stop_listener',
+]
+
+CHANGES_CHANNEL = 's3_repo_changes'
+PUBLISH_CHANNEL = 's3_repo_published'
+
+logger = logging.getLogger('s3repo.notify')
+
+class Listener(object):
+    """
+    Holds a dedicated autocommit connection LISTENing on a set of channels and
+    calls handler(payload) for each notification on a channel.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.conn     = None
+        self.running  = False
+        self.thread   = None
+
+    def add_handler(self, channel, handler):
+        self.handlers.setdefault(channel, []).append(handler)
+        if self.conn:
+            self.listen(channel)
+
+    def remove_handler(self, channel, handler):
+        self.handlers.get(channel, []).remove(handler)
+
+    def listen(self, channel):
+        self.conn.cursor().execute('LISTEN "{}"'.format(channel))
+
+    def connect(self):
+        self.conn = psycopg2.connect(**s3repo.common.load_cfg()['database'])
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        for channel in self.handlers:
+            self.listen(channel)
+
+    def close(self):
+        if self.conn:
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
+
+    def poll(self, timeout = 1.0):
+        """
+        Waits up to timeout seconds for notifications and dispatches them.
+        Returns the number dispatched.
+        """
+        if not self.conn:
+            self.connect()
+
+        if not self.conn.notifies:
+            if select.select([ self.conn ], [], [], timeout) == ([], [], []):
+                return 0
+            self.conn.poll()
+
+        count = 0
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            s3repo.stats.incr('notify.received')
+            for handler in list(self.handlers.get(notify.channel, [])):
+                handler(notify.payload)
+            count += 1
+
+        return count
+
+    def run(self, on_reconnect = None):
+        """
+        Polls until stop() is called.  If the connection is lost, notifications may
+        have been missed, so on_reconnect is called once listening resumes.
+        """
+        self.running = True
+        while self.running:
+            try:
+                self.poll()
+            except psycopg2.Error:
+                logger.exception("lost notification connection, reconnecting")
+                s3repo.stats.incr('notify.reconnects')
+                self.close()
+                time.sleep(1)
+                try:
+                    self.connect()
+                except psycopg2.Error:
+                    continue
+                if on_reconnect:
+                    on_reconnect()
+
+        self.close()
+
+    def start(self, on_reconnect = None):
+        self.connect()
+        self.thread = threading.Thread(target = self.run, args = (on_reconnect,), name = 's3repo-notify')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+
+def memoized_tables():
+    return dict(
+        (cls.table_name, cls)
+        for cls in pyutil.dbtable.DBTable.__subclasses__()
+        if getattr(cls, 'memoize', False)
+    )
+
+def handle_change(payload):
+    """
+    Evicts the row named by a "table:id" payload
+    """
+    table_name, _, row_id = payload.partition(':')
+    s3repo.cache.evict(table_name, int(row_id))
+
+    memoized = memoized_tables().get('s3_repo.' + table_name)
+    if memoized:
+        memoized.clear_cache()
+
+def clear_caches():
+    s3repo.cache.clear_all()
+    for cls in memoized_tables().values():
+        cls.clear_cache()
+
+
+_listener = None
+def start_listener():
+    """
+    Starts the process wide invalidation listener, if it is not already running.
+    """
+    global _listener
+    if _listener is None:
+        _listener = Listener()
+        _listener.add_handler(CHANGES_CHANNEL, handle_change)
+        _listener.start(on_reconnect = clear_caches)
+
+    return _listener
+
+def stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
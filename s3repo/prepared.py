@@ -0,0 +1,96 @@
+"""
+Registry of the library's hot SQL statements.  Each is PREPAREd once per
+connection, the first time it is used there, and then run by name with EXECUTE,
+so Postgres parses and plans it once per session rather than once per call:
+
+    find_current = s3repo.prepared.register('find_current_file', '''
+        SELECT file_id, path_id, s3_key
+        FROM s3_repo.current_files
+        WHERE path_id = %(path_id)s
+    ''', [ ('path_id', 'INTEGER') ])
+
+    RepoFile.find_by_sql(find_current.sql(conn), path_id = path_id)
+
+A prepared statement's result type is fixed when it is prepared, so statements
+list their columns rather than selecting *: otherwise adding a column to a
+table fails them with "cached plan must not change result type" until the
+session reconnects.
+
+With s3repo.stats enabled, each statement is timed as sql.execute.<name>, and
+report() returns the call counts and latencies of every registered statement.
+"""
+import s3repo.stats
+
+__all__ = [
+    'Statement',
+    'register',
+    'report',
+]
+
+class Statement(object):
+    """
+    A statement written with %(name)s placeholders, like any other query in the
+    library.  params lists the (name, postgres type) of each placeholder.
+    """
+    def __init__(self, name, query, params = ()):
+        self.name   = 's3repo_' + name
+        self.params = list(params)
+
+        placeholders = dict((param, '${}'.format(i + 1)) for i, (param, _) in enumerate(self.params))
+        self.prepare_sql = "PREPARE {}{} AS {}".format(
+            self.name,
+            self.arg_list(type_name for _, type_name in self.params),
+            query % placeholders,
+        )
+        self.execute_sql = "EXECUTE {}{}".format(
+            self.name,
+            self.arg_list('%({})s'.format(param) for param, _ in self.params),
+        )
+
+    @staticmethod
+    def arg_list(args):
+        args = ', '.join(args)
+        return '({})'.format(args) if args else ''
+
+    def sql(self, conn):
+        """
+        Prepares the statement on conn if it has not been already, and returns the
+        EXECUTE statement to run, with the same %(name)s placeholders.
+
+        Prepared statements belong to the session and survive rollbacks, so the
+        set of statements prepared is kept on the connection object itself
+        (which must be an s3repo.stats.InstrumentedConnection, as pooled
+        connections are).
+        """
+        prepared = getattr(conn, 'prepared_statements', None)
+        if prepared is None:
+            prepared = conn.prepared_statements = set()
+
+        if self.name not in prepared:
+            conn.cursor().execute(self.prepare_sql)
+            prepared.add(self.name)
+            s3repo.stats.incr('sql.prepared')
+
+        return self.execute_sql
+
+
+statements = {}
+def register(name, query, params = ()):
+    """
+    Adds a statement to the registry and returns it.
+    """
+    statement = Statement(name, query, params)
+    statements[statement.name] = statement
+    return statement
+
+def report():
+    """
+    Returns the call count and latency summary of every registered statement
+    that has run since stats were enabled, keyed by statement name.
+    """
+    timers = s3repo.stats.snapshot()['timers']
+    return dict(
+        (name, timers['sql.execute.' + name])
+        for name in statements
+        if 'sql.execute.' + name in timers
+    )
@@ -0,0 +1,156 @@
+"""
+Compact results for large listings.  Rather than a RepoFile per row, queries
+can return slotted records holding only the requested columns, or a FileColumns
+batch holding each column in a single array:
+
+    for rec in S3Repo.find_tagged(all = [ 'month=2014-01-01' ], columns = [ 'local_path', 'file_size' ]):
+        process(rec.local_path, rec.file_size)
+
+    batch = S3Repo.find_tagged(all = [ 'month=2014-01-01' ], columns = [ 'file_size' ], as_arrays = True)
+    total_size = sum(batch['file_size'])
+
+file_id is always included, so that records can be upgraded to full RepoFiles
+on demand with repo_file() or repo_files().
+"""
+import array, collections
+import psycopg2.extensions
+import s3repo.exceptions
+
+__all__ = [
+    'normalize_columns',
+    'select_list',
+    'record_type',
+    'fetch',
+    'FileColumns',
+]
+
+# Columns besides the file's own fields, selected through s3repo.file.PRELOAD_JOINS
+extra_columns = {
+    'local_path' : 'p.local_path',
+    's3_bucket'  : 'b.s3_bucket',
+}
+
+# Typecodes of columns which FileColumns stores in an array.array
+typecodes = {
+    'file_id'      : 'l',
+    's3_bucket_id' : 'l',
+    'path_id'      : 'l',
+    'origin'       : 'l',
+    'file_size'    : 'l',
+    'published'    : 'b',
+}
+
+def normalize_columns(file_cls, columns):
+    """
+    Returns columns, with file_id first, after checking that each can be selected.
+    """
+    columns = [ 'file_id' ] + [ x for x in columns if x != 'file_id' ]
+    for column in columns:
+        if column not in file_cls.fields and column not in extra_columns:
+            raise s3repo.exceptions.RepoAPIError("unknown column: {}".format(column))
+
+    return columns
+
+def select_list(columns):
+    return ', '.join(
+        '{} AS {}'.format(extra_columns[x], x) if x in extra_columns else 'rf.' + x
+        for x in columns
+    )
+
+
+class FileRecordBase(object):
+    __slots__ = ()
+
+    def repo_file(self):
+        return self.file_cls.find_by_id(self.file_id)
+
+_record_types = {}
+def record_type(columns, file_cls):
+    """
+    Returns a tuple class with a slot per column, and a repo_file() method.
+    """
+    key = (tuple(columns), file_cls)
+    if key not in _record_types:
+        _record_types[key] = type('FileRecord', (collections.namedtuple('FileRecord', columns), FileRecordBase), {
+            '__slots__' : (),
+            'file_cls'  : file_cls,
+        })
+
+    return _record_types[key]
+
+
+class FileColumns(object):
+    """
+    Column oriented batch of files.  Integer and boolean columns are held in an
+    array.array, unless they contain NULLs; others are lists.  batch[column]
+    returns a whole column, and iterating the batch yields records.
+    """
+    def __init__(self, columns, file_cls):
+        self.columns  = list(columns)
+        self.file_cls = file_cls
+        self.arrays   = dict(
+            (x, array.array(typecodes[x]) if x in typecodes else [])
+            for x in self.columns
+        )
+
+    def append(self, row):
+        for column, value in zip(self.columns, row):
+            values = self.arrays[column]
+            if value is None and not isinstance(values, list):
+                values = self.arrays[column] = values.tolist()
+            values.append(value)
+
+    def __len__(self):
+        return len(self.arrays['file_id'])
+
+    def __getitem__(self, column):
+        return self.arrays[column]
+
+    def __iter__(self):
+        record_cls = record_type(self.columns, self.file_cls)
+        for row in zip(*[ self.arrays[x] for x in self.columns ]):
+            yield record_cls._make(row)
+
+    def repo_files(self):
+        """
+        Returns the RepoFiles of the whole batch, in one query.
+        """
+        import s3repo.file
+        return self.file_cls.find_by_sql("""
+            SELECT rf.*, {}
+            FROM {} rf
+                {}
+            WHERE file_id = ANY(%(file_ids)s)
+        """.format(s3repo.file.PRELOAD_COLUMNS, self.file_cls.table_name, s3repo.file.PRELOAD_JOINS),
+            preload  = True,
+            file_ids = list(self.arrays['file_id']),
+        )
+
+    def to_numpy(self):
+        """
+        Returns a dict of column name to NumPy array.  Requires numpy.
+        """
+        import numpy
+        return dict((x, numpy.asarray(self.arrays[x])) for x in self.columns)
+
+
+def fetch(conn, query, columns, file_cls, as_arrays = False, fetch_size = 10000, **bind_params):
+    """
+    Runs query, which selects columns, through a server side cursor and returns
+    either a list of records or a FileColumns.
+    """
+    cur = conn.cursor('s3repo_records', cursor_factory = psycopg2.extensions.cursor)
+    cur.itersize = fetch_size
+    cur.execute(query, bind_params)
+
+    try:
+        if as_arrays:
+            batch = FileColumns(columns, file_cls)
+            for row in cur:
+                batch.append(row)
+            return batch
+
+        record_cls = record_type(columns, file_cls)
+        return [ record_cls._make(row) for row in cur ]
+    finally:
+        cur.close()
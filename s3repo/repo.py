@@ -1,33 +1,57 @@
-import os, uuid
+import os, gzip, time, uuid, shutil, logging, datetime, tempfile, threading, collections
+import multiprocessing.pool
 import s3repo.common
+import s3repo.stats
+import s3repo.storage
+import s3repo.transfers
+import s3repo.keys
+import s3repo.prepared
+import s3repo.records
+import s3repo.disks
+import s3repo.scrub
+import s3repo.notify
 import s3repo.host
 import s3repo.file
 import s3repo.tag
 from pyutil.pghelper import *
 from s3repo.exceptions import *
 from pyutil.dateutil import *
-from pyutil.util import set_defaults
+from pyutil.util import set_defaults, is_online, mkdirp
+
+logger = logging.getLogger('s3repo.repo')
 
 class S3Repo(object):
-    config = s3repo.common.load_cfg()
-    conn = s3repo.common.db_conn()
+    config = s3repo.common.LazyConfig()
+    conn = s3repo.common.ThreadConn()
+
+    @classmethod
+    def commit(cls):
+        cls.conn.commit()
 
-    commit = conn.commit
-    rollback = conn.rollback
+    @classmethod
+    def rollback(cls):
+        cls.conn.rollback()
 
     @classmethod
+    @s3repo.stats.timed('repo.add_file')
     def add_file(cls, path, **kwargs):
         local_path = s3repo.file.LocalPath.find_or_create(path)
         s3_bucket  = s3repo.file.S3Bucket.find_or_create(kwargs.pop('s3_bucket', cls.config['s3.default_bucket']))
 
         kwargs = set_defaults(kwargs,
-            s3_key       = os.path.join(path, str(to_epoch(now()))),
             guid         = str(uuid.uuid4()),
             path_id      = local_path.path_id,
             origin       = s3repo.host.RepoHost.current_host_id(),
             date_created = now(),
         )
 
+        if 's3_key' not in kwargs:
+            kwargs['s3_key'] = s3repo.keys.layout(s3_bucket.s3_bucket).key(
+                path,
+                s3repo.keys.version(kwargs['origin'], kwargs['guid']),
+                kwargs['date_created'],
+            )
+
         rf = s3repo.file.RepoFile.find_or_create(s3_bucket.s3_bucket_id, kwargs['s3_key'], **kwargs)
 
         if rf.guid != kwargs['guid']:
@@ -36,6 +60,71 @@ class S3Repo(object):
         return rf
 
     @classmethod
+    @s3repo.stats.timed('repo.add_files')
+    def add_files(cls, paths, s3_bucket = None):
+        """
+        Adds a new version of each of paths, as add_file does, with a single
+        insert.  Returns the new RepoFiles, in the order of paths.
+        """
+        s3_bucket = s3repo.file.S3Bucket.find_or_create(s3_bucket or cls.config['s3.default_bucket'])
+        layout    = s3repo.keys.layout(s3_bucket.s3_bucket)
+        origin    = s3repo.host.RepoHost.current_host_id()
+        created   = now()
+
+        path_ids = []
+        s3_keys  = []
+        guids    = []
+        for path in paths:
+            guid = str(uuid.uuid4())
+            path_ids.append(s3repo.file.LocalPath.find_or_create(path).path_id)
+            s3_keys.append(layout.key(path, s3repo.keys.version(origin, guid), created))
+            guids.append(guid)
+
+        if not s3_keys:
+            return []
+
+        rfs = s3repo.file.RepoFile.find_by_sql("""
+            WITH rf AS (
+                INSERT INTO s3_repo.files (
+                    s3_bucket_id,
+                    path_id,
+                    s3_key,
+                    guid,
+                    origin,
+                    date_created
+                )
+                SELECT %(s3_bucket_id)s, new.path_id, new.s3_key, new.guid::UUID, %(origin)s, %(date_created)s
+                FROM unnest(%(path_ids)s::INTEGER[], %(s3_keys)s::TEXT[], %(guids)s::TEXT[]) new (path_id, s3_key, guid)
+                RETURNING *
+            )
+            SELECT rf.*, {}
+            FROM rf
+                {}
+        """.format(s3repo.file.PRELOAD_COLUMNS, s3repo.file.PRELOAD_JOINS),
+            preload      = True,
+            s3_bucket_id = s3_bucket.s3_bucket_id,
+            origin       = origin,
+            date_created = created,
+            path_ids     = path_ids,
+            s3_keys      = s3_keys,
+            guids        = guids,
+        )
+
+        execute(cls.conn, """
+            INSERT INTO s3_repo.downloads (
+                file_id,
+                host_id,
+                downloaded_utc,
+                last_access
+            )
+            SELECT unnest(%(file_ids)s::INTEGER[]), %(host_id)s, %(now)s, %(now)s
+        """, file_ids = [ rf.file_id for rf in rfs ], host_id = origin, now = created)
+
+        by_key = dict((rf.s3_key, rf) for rf in rfs)
+        return [ by_key[s3_key] for s3_key in s3_keys ]
+
+    @classmethod
+    @s3repo.stats.timed('repo.get_file')
     def get_file(cls, path):
         local_path = s3repo.file.LocalPath.find(path)
         if not local_path:
@@ -43,6 +132,33 @@ class S3Repo(object):
 
         return local_path.find_current()
 
+    @classmethod
+    @s3repo.stats.timed('repo.get_files')
+    def get_files(cls, paths):
+        """
+        Returns a dict of each path to its current file, or None, resolving all of
+        them in a single query.  The bucket and path name caches are filled from
+        the same result.
+        """
+        paths = list(paths)
+        results = dict.fromkeys(paths)
+        if not paths:
+            return results
+
+        for rf in s3repo.file.RepoFile.find_by_sql("""
+            SELECT DISTINCT ON (rf.path_id) rf.*, {}
+            FROM s3_repo.files rf
+                {}
+            WHERE p.local_path = ANY(%(paths)s)
+                AND rf.published = TRUE
+                AND rf.date_published IS NOT NULL
+                AND rf.date_expired IS NULL
+            ORDER BY rf.path_id, rf.date_published DESC
+        """.format(s3repo.file.PRELOAD_COLUMNS, s3repo.file.PRELOAD_JOINS), preload = True, paths = paths):
+            results[rf.path_name] = rf
+
+        return results
+
     @classmethod
     def backup_table(cls, conn, table_obj):
         local_path = os.path.join(
@@ -64,16 +180,20 @@ class S3Repo(object):
         )
         local_path += '.gz'
 
-        backup_bucket = s3repo.common.s3_conn().get_bucket(cls.config['backup.s3_bucket'])
-        remote_backup_files = backup_bucket.list(local_path)
+        backup_bucket = cls.config['backup.s3_bucket']
+        storage = s3repo.storage.backend(backup_bucket)
+        layout = s3repo.keys.layout(backup_bucket)
 
-        try:
-            last_backup = sorted(remote_backup_files, key=lambda x: x.name)[-1]
-        except IndexError:
+        last_backup = None
+        for remote_key in storage.list(backup_bucket, layout.prefix(local_path)):
+            if layout.owns(remote_key.name, local_path):
+                last_backup = remote_key
+
+        if not last_backup:
             raise RepoNoBackupsError()
 
         fp = tempfile.NamedTemporaryFile()
-        last_backup.get_contents_to_filename(fp.name)
+        storage.get(backup_bucket, last_backup.name, fp.name)
 
         with gzip.open(fp.name, 'r') as fp:
             conn.cursor().copy_from(fp, table_obj.table_name, columns = table_obj.fields)
@@ -101,8 +221,9 @@ class S3Repo(object):
         for table_obj in self.backup_objs:
             backup_files.append(cls.backup_table(conn, table_obj))
 
-        for backup_file in backup_files:
-            backup_file.publish()
+        with s3repo.transfers.priority('background', 'backup'):
+            for backup_file in backup_files:
+                backup_file.publish()
 
     @classmethod
     def restore_db(cls):
@@ -113,18 +234,22 @@ class S3Repo(object):
         for table_obj in self.backup_objs:
             cls.restore_table(conn, table_obj)
 
+    host_overflow_sql = s3repo.prepared.register('host_overflow_bytes', """
+        SELECT coalesce(overflow_bytes, 0) AS overflow_bytes
+        FROM s3_repo.host_cache_stats
+        WHERE host_id = %(host_id)s
+    """, [ ('host_id', 'INTEGER') ])
+
     @classmethod
+    @s3repo.stats.timed('repo.maintain_current_host')
     def maintain_current_host(cls):
         current_host = s3repo.host.RepoHost.current_host_id()
-        overflow_bytes = fetch_one(cls.conn, """
-            SELECT coalesce(overflow_bytes, 0) AS overflow_bytes
-            FROM s3_repo.host_cache_stats
-            WHERE host_id = %(host_id)s
-        """, host_id = current_host)['overflow_bytes']
+        overflow_bytes = fetch_one(cls.conn, cls.host_overflow_sql.sql(cls.conn), host_id = current_host)['overflow_bytes']
 
         stale_files = s3repo.file.RepoFile.find_by_sql("""
-            SELECT rf.*
+            SELECT rf.*, {}
             FROM s3_repo.files rf
+                {}
                 LEFT OUTER JOIN (
                     SELECT *
                     FROM s3_repo.downloads
@@ -137,7 +262,8 @@ class S3Repo(object):
                     AND date_published IS NULL
                     AND date_created < %(unpublished_filter)s
                 )
-        """,
+        """.format(s3repo.file.PRELOAD_COLUMNS, s3repo.file.PRELOAD_JOINS),
+            preload            = True,
             host_id            = current_host,
             stale_filter       = now() - seconds(cls.config['fs.published_stale_seconds']),
             unpublished_filter = now() - seconds(cls.config['fs.unpublished_stale_seconds']),
@@ -150,46 +276,969 @@ class S3Repo(object):
             else:
                 rf.purge()
 
-        if overflow_bytes > 0:
+        cache_roots = s3repo.disks.roots()
+        if overflow_bytes > 0 or cache_roots:
             rfs = s3repo.file.RepoFile.find_by_sql("""
-                SELECT rf.*
+                SELECT rf.*, {}
                 FROM s3_repo.files rf
+                    {}
                     LEFT OUTER JOIN s3_repo.downloads
                         USING (file_id)
                 WHERE s3_repo.downloads.host_id = %(host_id)s
                 ORDER BY s3_repo.downloads.last_access
-            """, host_id = current_host)
+            """.format(s3repo.file.PRELOAD_COLUMNS, s3repo.file.PRELOAD_JOINS), preload = True, host_id = current_host)
 
-            while overflow_bytes > 0:
-                rf.unlink()
-                overflow_bytes += rf.file_size
+            if cache_roots:
+                cls.evict_by_root(rfs)
+            else:
+                cls.evict(rfs, overflow_bytes)
 
     @classmethod
-    def maintain_database(cls):
-        files_to_expire = s3repo.file.RepoFile.find_by_sql("""
-            SELECT rf.*
-            FROM s3_repo.files rf
-                LEFT OUTER JOIN s3_repo.current_files cf
-                    USING (file_id)
+    def evict(cls, rfs, overflow_bytes):
+        """
+        Unlinks rfs, in order, until overflow_bytes have been freed.
+        """
+        for rf in rfs:
+            if overflow_bytes <= 0:
+                break
+            rf.unlink()
+            overflow_bytes -= (rf.file_size or 0)
+
+    @classmethod
+    @s3repo.stats.timed('repo.evict_by_root')
+    def evict_by_root(cls, rfs):
+        """
+        Enforces the max_size of each cache root, evicting the least recently
+        accessed of rfs first.  Each root is evicted on its own workers.
+        """
+        by_root = collections.defaultdict(list)
+        for rf in rfs:
+            by_root[s3repo.disks.root_for(rf.local_path())].append(rf)
+
+        tasks = []
+        for root, root_files in by_root.items():
+            if root.max_size is None:
+                continue
+
+            overflow_bytes = sum(rf.file_size or 0 for rf in root_files) - root.max_size
+            if overflow_bytes > 0:
+                tasks.append(s3repo.disks.submit(root, lambda root_files = root_files, overflow_bytes = overflow_bytes: cls.evict(root_files, overflow_bytes)))
+
+        for task in tasks:
+            task.wait()
+
+    @classmethod
+    @s3repo.stats.timed('repo.download_files')
+    def download_files(cls, rfs):
+        """
+        Downloads rfs to the local cache, in parallel on the workers of each
+        file's cache root.  Returns stats: downloaded and failed.
+        """
+        tasks = [ rf.prefetch() for rf in rfs ]
+
+        stats = { 'downloaded' : 0, 'failed' : 0 }
+        for task in tasks:
+            try:
+                task.wait()
+                stats['downloaded'] += 1
+            except Exception:
+                stats['failed'] += 1
+
+        return stats
+
+    @classmethod
+    @s3repo.stats.timed('repo.reconcile_host')
+    def reconcile_host(cls, verify_md5 = False, threads = 8, grace_seconds = 60, batch_size = 1000):
+        """
+        Brings this host's download rows back in line with its local cache, as after
+        a reboot, a disk replacement or a crash mid-download.  Each cache root (or
+        without cache roots, config['local_root']) is scanned in parallel, and each
+        cached file is matched to a version of its path by size, and with
+        verify_md5 by md5:
+
+        - Matched files without a download row get one, dated by the file's mtime
+        - Download rows without a matching file are deleted
+        - Partial downloads, and files matching no version of a known path, are
+          quarantined (see s3repo.disks)
+        - Files on a cache root other than the one they hash to are moved there
+
+        Files modified in the last grace_seconds may still be being written, and
+        are left alone.  Returns stats: scanned, matched, inserted, deleted,
+        quarantined, moved and elapsed.
+        """
+        stats = {
+            'scanned'     : 0,
+            'matched'     : 0,
+            'inserted'    : 0,
+            'deleted'     : 0,
+            'quarantined' : 0,
+            'moved'       : 0,
+            'elapsed'     : 0.0,
+        }
+        start_time = time.time()
+        current_host = s3repo.host.RepoHost.current_host_id()
+
+        cache_roots = s3repo.disks.roots()
+        if cache_roots:
+            tops = [ root.path for root in cache_roots ]
+        elif cls.config.get('local_root'):
+            tops = [ cls.config['local_root'] ]
+        else:
+            raise RepoAPIError("reconcile_host requires cache.roots or local_root to be configured")
+
+        def quarantine(top, filename):
+            logger.warning("quarantining %s", filename)
+            s3repo.disks.quarantine(top, filename)
+            stats['quarantined'] += 1
+
+        # local_path -> (top, filename, stat) of every settled file in the cache
+        cached = {}
+        busy = set()
+        for top, found in s3repo.disks.scan_trees(tops, threads).iteritems():
+            for filename, st in found:
+                stats['scanned'] += 1
+                if st.st_mtime > start_time - grace_seconds:
+                    busy.add(filename)
+                    continue
+
+                if filename.endswith(s3repo.disks.PARTIAL_SUFFIX):
+                    quarantine(top, filename)
+                    continue
+
+                if not cache_roots:
+                    cached[filename] = (top, filename, st)
+                    continue
+
+                local_path = '/' + os.path.relpath(filename, top)
+                expected = s3repo.disks.cache_path(local_path)
+                if expected != filename:
+                    # Left behind when cache roots were added or removed
+                    if os.path.exists(expected):
+                        os.unlink(filename)
+                        continue
+                    mkdirp(os.path.dirname(expected))
+                    shutil.move(filename, expected)
+                    top, filename = s3repo.disks.root_for(local_path).path, expected
+                    stats['moved'] += 1
+
+                cached[local_path] = (top, filename, st)
+
+        md5s = {}
+        def matches(row, filename, st):
+            if row['file_size'] is None:
+                # Written on this host, and not uploaded yet
+                return row['origin'] == current_host and row['date_uploaded'] is None
+            if row['file_size'] != st.st_size:
+                return False
+            if verify_md5 and row['md5']:
+                if filename not in md5s:
+                    with open(filename, 'rb') as fp:
+                        md5s[filename] = s3repo.file.compute_md5(fp)[0]
+                return md5s[filename] == row['md5']
+            return True
+
+        file_columns = """
+            rf.file_id,
+            rf.origin,
+            rf.md5,
+            rf.file_size,
+            rf.date_uploaded,
+            p.local_path
+        """
+
+        # Keep the newest row matching each cached file
+        claimed = set()
+        phantoms = []
+        for row in fetch_results(cls.conn, """
+            SELECT {}
+            FROM s3_repo.downloads dl
+                INNER JOIN s3_repo.files rf USING (file_id)
+                INNER JOIN s3_repo.paths p USING (path_id)
+            WHERE dl.host_id = %(host_id)s
+            ORDER BY dl.downloaded_utc DESC
+        """.format(file_columns), host_id = current_host):
+            local_path = row['local_path']
+            if local_path in cached and local_path not in claimed and matches(row, *cached[local_path][1:]):
+                claimed.add(local_path)
+                stats['matched'] += 1
+            elif s3repo.disks.cache_path(local_path) not in busy:
+                phantoms.append(row['file_id'])
+
+        # Then match the rest against every version of their paths, newest first
+        unclaimed = sorted(set(cached) - claimed)
+        for i in range(0, len(unclaimed), batch_size):
+            versions = {}
+            for row in fetch_results(cls.conn, """
+                SELECT {}
+                FROM s3_repo.files rf
+                    INNER JOIN s3_repo.paths p USING (path_id)
+                WHERE p.local_path = ANY(%(local_paths)s)
+                ORDER BY rf.date_expired IS NULL DESC, rf.published DESC, rf.date_created DESC
+            """.format(file_columns), local_paths = unclaimed[i:i + batch_size]):
+                versions.setdefault(row['local_path'], []).append(row)
+
+            file_ids = []
+            mtimes = []
+            for local_path in unclaimed[i:i + batch_size]:
+                if local_path not in versions:
+                    continue # Not a repo file
+
+                top, filename, st = cached[local_path]
+                for row in versions[local_path]:
+                    if matches(row, filename, st):
+                        file_ids.append(row['file_id'])
+                        mtimes.append(datetime.datetime.utcfromtimestamp(st.st_mtime))
+                        break
+                else:
+                    quarantine(top, filename)
+
+            if file_ids:
+                execute(cls.conn, """
+                    INSERT INTO s3_repo.downloads (
+                        file_id,
+                        host_id,
+                        downloaded_utc,
+                        last_access
+                    )
+                    SELECT cached.file_id, %(host_id)s, cached.mtime, cached.mtime
+                    FROM unnest(%(file_ids)s::INTEGER[], %(mtimes)s::TIMESTAMP[]) cached (file_id, mtime)
+                    WHERE NOT EXISTS (
+                        SELECT 1
+                        FROM s3_repo.downloads dl
+                        WHERE dl.file_id = cached.file_id
+                            AND dl.host_id = %(host_id)s
+                    )
+                """, host_id = current_host, file_ids = file_ids, mtimes = mtimes)
+                stats['inserted'] += len(file_ids)
+
+        for i in range(0, len(phantoms), batch_size):
+            execute(cls.conn, """
+                DELETE FROM s3_repo.downloads
+                WHERE host_id = %(host_id)s
+                    AND file_id = ANY(%(file_ids)s)
+            """, host_id = current_host, file_ids = phantoms[i:i + batch_size])
+        stats['deleted'] = len(phantoms)
+
+        stats['elapsed'] = time.time() - start_time
+        return stats
+
+    @classmethod
+    @s3repo.stats.timed('repo.scrub_cache')
+    def scrub_cache(cls, bytes_per_second = None, threads = None, max_bytes = None, batch_size = 100):
+        """
+        Re-hashes this host's cached files which have not been verified within
+        config['scrub.interval_seconds'] (default a week), most accessed first,
+        on threads threads (default config['scrub.threads'], or 2).  Reads are
+        limited to bytes_per_second (default config['scrub.bytes_per_second'],
+        unlimited if unset).  Files which no longer match their md5 are
+        re-downloaded, or only removed from the cache while offline.  Each batch
+        of batch_size is committed, and the pass stops after max_bytes if given.
+
+        Returns stats: verified, corrupt, redownloaded, missing, bytes and elapsed.
+        """
+        stats = {
+            'verified'     : 0,
+            'corrupt'      : 0,
+            'redownloaded' : 0,
+            'missing'      : 0,
+            'bytes'        : 0,
+            'elapsed'      : 0.0,
+        }
+        start_time = time.time()
+        current_host = s3repo.host.RepoHost.current_host_id()
+        limiter = s3repo.transfers.RateLimiter(bytes_per_second or cls.config.get('scrub.bytes_per_second'))
+        cutoff = now() - seconds(cls.config.get('scrub.interval_seconds', 7 * 86400))
+
+        def check(rf):
+            filename = rf.cache_path()
+            if not os.path.exists(filename):
+                return None
+            try:
+                return s3repo.scrub.hash_file(filename, limiter)
+            except (IOError, OSError):
+                logger.exception("unable to read %s", filename)
+                return ''
+
+        pool = multiprocessing.pool.ThreadPool(threads or cls.config.get('scrub.threads', 2))
+        try:
+            while max_bytes is None or stats['bytes'] < max_bytes:
+                rfs = s3repo.file.RepoFile.find_by_sql("""
+                    SELECT rf.*, {}
+                    FROM s3_repo.files rf
+                        {}
+                        INNER JOIN s3_repo.downloads dl
+                            USING (file_id)
+                    WHERE dl.host_id = %(host_id)s
+                        AND rf.md5 IS NOT NULL
+                        AND (dl.last_verified IS NULL OR dl.last_verified < %(cutoff)s)
+                    ORDER BY dl.access_count DESC, dl.last_access DESC
+                    LIMIT %(batch_size)s
+                """.format(s3repo.file.PRELOAD_COLUMNS, s3repo.file.PRELOAD_JOINS),
+                    preload    = True,
+                    host_id    = current_host,
+                    cutoff     = cutoff,
+                    batch_size = batch_size,
+                )
+
+                if not rfs:
+                    break
+
+                verified = []
+                for rf, md5 in zip(rfs, pool.map(check, rfs)):
+                    if md5 is None:
+                        stats['missing'] += 1
+                        rf.unlink()
+                        continue
+
+                    stats['bytes'] += (rf.file_size or 0)
+                    if md5 == rf.md5:
+                        stats['verified'] += 1
+                        verified.append(rf.file_id)
+                        continue
+
+                    logger.warning("%s does not match md5 %s, removing it from the cache", rf.cache_path(), rf.md5)
+                    stats['corrupt'] += 1
+                    rf.unlink()
+                    if is_online():
+                        try:
+                            with s3repo.transfers.priority('background', 'scrub'):
+                                rf.download()
+                            stats['redownloaded'] += 1
+                            verified.append(rf.file_id)
+                        except Exception:
+                            logger.exception("unable to download %s", rf.s3_path())
+
+                execute(cls.conn, """
+                    UPDATE s3_repo.downloads
+                    SET last_verified = %(now)s
+                    WHERE host_id = %(host_id)s
+                        AND file_id = ANY(%(file_ids)s)
+                """, now = now(), host_id = current_host, file_ids = verified)
+                cls.conn.commit()
+        finally:
+            pool.close()
+
+        stats['elapsed'] = time.time() - start_time
+        return stats
+
+    @classmethod
+    @s3repo.stats.timed('repo.maintain_database')
+    def maintain_database(cls, batch_size = 1000, progress = None, archive = None):
+        """
+        Expires published files which are no longer current, then purges deletable
+        files from S3 and the database in batches of batch_size.  Each batch is committed
+        as soon as its S3 objects are gone, so an interrupted run loses no work.
+
+        If archive is set (default config['archive.enabled']), expired files are
+        archived (see archive_files) rather than purged.
+
+        progress, if given, is called with the running stats after every batch.
+        Returns the final stats: expired, archived, purged, deleted, elapsed and
+        files_per_second.
+        """
+        if archive is None:
+            archive = cls.config.get('archive.enabled', False)
+
+        stats = {
+            'expired'          : 0,
+            'archived'         : 0,
+            'purged'           : 0,
+            'deleted'          : 0,
+            'elapsed'          : 0.0,
+            'files_per_second' : 0.0,
+        }
+        start_time = time.time()
+
+        def report():
+            stats['elapsed'] = time.time() - start_time
+            if stats['elapsed'] > 0:
+                stats['files_per_second'] = (stats['expired'] + stats['archived'] + stats['deleted']) / stats['elapsed']
+            if progress:
+                progress(dict(stats))
+
+        stats['expired'] = len(fetch_results(cls.conn, """
+            UPDATE s3_repo.files rf
+            SET published    = FALSE,
+                date_expired = %(now)s
             WHERE rf.published
                 AND rf.date_expired IS NULL
-                AND cf.file_id IS NULL
-        """)
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM s3_repo.current_files cf
+                    WHERE cf.file_id = rf.file_id
+                )
+            RETURNING rf.file_id
+        """, now = now()))
+        cls.conn.commit()
+        report()
+
+        if archive:
+            def archived(archive_stats):
+                stats['archived'] = archive_stats['archived']
+                report()
+            cls.archive_files(batch_size = batch_size, progress = archived)
+
+        while True:
+            files_to_purge = fetch_results(cls.conn, """
+                SELECT df.file_id, df.s3_key, df.date_uploaded, b.s3_bucket
+                FROM s3_repo.deletable_files df
+                    INNER JOIN s3_repo.s3_buckets b
+                        USING (s3_bucket_id)
+                WHERE {}
+                ORDER BY df.file_id
+                LIMIT %(batch_size)s
+            """.format('df.date_expired IS NULL' if archive else 'true'), batch_size = batch_size)
+
+            if not files_to_purge:
+                break
+
+            keys_by_bucket = {}
+            for row in files_to_purge:
+                if row['date_uploaded']:
+                    keys_by_bucket.setdefault(row['s3_bucket'], []).append(row['s3_key'])
+
+            for s3_bucket, s3_keys in keys_by_bucket.iteritems():
+                stats['purged'] += s3repo.file.RepoFile.purge_keys(s3_bucket, s3_keys)
+
+            file_ids = tuple(row['file_id'] for row in files_to_purge)
+            for table_name in [ 's3_repo.downloads', 's3_repo.file_tags', 's3_repo.files' ]:
+                execute(cls.conn, """
+                    DELETE FROM {}
+                    WHERE file_id IN %(file_ids)s
+                """.format(table_name), file_ids = file_ids)
+
+            cls.conn.commit()
+            stats['deleted'] += len(file_ids)
+            report()
+
+        return stats
+
+    @classmethod
+    @s3repo.stats.timed('repo.archive_files')
+    def archive_files(cls, min_age = None, batch_size = 1000, progress = None):
+        """
+        Moves deletable files which expired over min_age seconds ago (default
+        config['archive.min_age_seconds']), or which have date_archived set, into
+        s3_repo.archived_files along with their file tags.  Their S3 objects are
+        kept, and they remain available through history() and
+        find_tagged(archived = True).  Each batch of batch_size is committed.
+
+        progress, if given, is called with the running stats after every batch.
+        Returns the final stats: archived and elapsed.
+        """
+        if min_age is None:
+            min_age = cls.config.get('archive.min_age_seconds', 0)
+
+        stats = {
+            'archived' : 0,
+            'elapsed'  : 0.0,
+        }
+        start_time = time.time()
+        archive_time = now()
+
+        while True:
+            file_ids = tuple(row['file_id'] for row in fetch_results(cls.conn, """
+                SELECT file_id
+                FROM s3_repo.deletable_files
+                WHERE date_expired <= %(cutoff)s
+                    OR date_archived IS NOT NULL
+                ORDER BY file_id
+                LIMIT %(batch_size)s
+            """, cutoff = archive_time - seconds(min_age), batch_size = batch_size))
+
+            if not file_ids:
+                break
+
+            # Columns are listed, so that the tables need not keep the same column order
+            execute(cls.conn, """
+                WITH moved AS (
+                    DELETE FROM s3_repo.file_tags
+                    WHERE file_id IN %(file_ids)s
+                    RETURNING file_id, tag_id, date_tagged
+                )
+                INSERT INTO s3_repo.archived_file_tags (file_id, tag_id, date_tagged)
+                SELECT file_id, tag_id, date_tagged
+                FROM moved
+            """, file_ids = file_ids)
+
+            # Only downloads by inactive hosts remain
+            execute(cls.conn, """
+                DELETE FROM s3_repo.downloads
+                WHERE file_id IN %(file_ids)s
+            """, file_ids = file_ids)
+
+            execute(cls.conn, """
+                WITH moved AS (
+                    DELETE FROM s3_repo.files
+                    WHERE file_id IN %(file_ids)s
+                    RETURNING {columns}
+                )
+                INSERT INTO s3_repo.archived_files ({columns})
+                SELECT {columns}
+                FROM moved
+            """.format(columns = ', '.join(s3repo.file.RepoFile.fields)), file_ids = file_ids)
+
+            execute(cls.conn, """
+                UPDATE s3_repo.archived_files
+                SET date_archived = %(now)s
+                WHERE file_id IN %(file_ids)s
+                    AND date_archived IS NULL
+            """, now = archive_time, file_ids = file_ids)
+
+            cls.conn.commit()
+            stats['archived'] += len(file_ids)
+            stats['elapsed'] = time.time() - start_time
+            if progress:
+                progress(dict(stats))
+
+        stats['elapsed'] = time.time() - start_time
+        return stats
+
+    @classmethod
+    @s3repo.stats.timed('repo.tier_files')
+    def tier_files(cls, tier = None, idle_days = None, batch_size = 1000, progress = None):
+        """
+        Moves uploaded files into the cheaper storage tier (default
+        config['tiering.tier']) in batches of batch_size, recording the tier in
+        storage_tier.  Expired and archived files are moved, and so are files
+        no host has read for idle_days (default config['tiering.idle_days'],
+        never if unset).  Files already in tier or a colder one are left alone,
+        as are files maintain_database would purge, which would only incur the
+        tier's minimum storage duration charge.  Reads of files in cold tiers
+        restore them first (see RepoFile.restore).
+
+        Files whose keys the backend could not move are skipped, keeping their
+        old storage_tier, and retried by the next run.
+
+        progress, if given, is called with the running stats after every batch.
+        Returns the final stats: tiered, skipped and elapsed.
+        """
+        if tier is None:
+            tier = cls.config.get('tiering.tier', 'infrequent')
+        if idle_days is None:
+            idle_days = cls.config.get('tiering.idle_days')
+
+        tiers = s3repo.storage.StorageBackend.tiers
+        stats = {
+            'tiered'  : 0,
+            'skipped' : 0,
+            'elapsed' : 0.0,
+        }
+        start_time = time.time()
+        if not is_online():
+            return stats
+
+        idle_filter = 'false'
+        if idle_days is not None:
+            idle_filter = """
+                coalesce((
+                    SELECT max(dl.last_access)
+                    FROM s3_repo.downloads dl
+                    WHERE dl.file_id = rf.file_id
+                ), rf.date_uploaded) < %(idle_cutoff)s
+            """
+
+        # As purged by maintain_database, which keeps expired files to archive
+        purgeable_filter = 'df.date_expired IS NULL' if cls.config.get('archive.enabled', False) else 'true'
+        files_filter = """
+            (rf.date_expired IS NOT NULL OR {})
+            AND NOT EXISTS (
+                SELECT 1
+                FROM s3_repo.deletable_files df
+                WHERE df.file_id = rf.file_id
+                    AND {}
+            )
+        """.format(idle_filter, purgeable_filter)
+
+        for table_name, candidate_filter in [
+            ('s3_repo.files',          files_filter),
+            ('s3_repo.archived_files', 'true'),
+        ]:
+            last_file_id = 0
+            while True:
+                files_to_tier = fetch_results(cls.conn, """
+                    SELECT rf.file_id, rf.s3_key, b.s3_bucket
+                    FROM {table_name} rf
+                        INNER JOIN s3_repo.s3_buckets b
+                            USING (s3_bucket_id)
+                    WHERE rf.file_id > %(last_file_id)s
+                        AND rf.date_uploaded IS NOT NULL
+                        AND rf.storage_tier IN %(warmer_tiers)s
+                        AND ({candidate_filter})
+                    ORDER BY rf.file_id
+                    LIMIT %(batch_size)s
+                """.format(table_name = table_name, candidate_filter = candidate_filter),
+                    last_file_id = last_file_id,
+                    warmer_tiers = tuple(tiers[:tiers.index(tier)]) or ('',),
+                    idle_cutoff  = now() - seconds((idle_days or 0) * 86400),
+                    batch_size   = batch_size,
+                )
+
+                if not files_to_tier:
+                    break
+
+                file_ids_by_key = {}
+                for row in files_to_tier:
+                    file_ids_by_key.setdefault(row['s3_bucket'], {}).setdefault(row['s3_key'], []).append(row['file_id'])
+
+                # Only files whose keys were moved are recorded in the new tier
+                file_ids = []
+                for s3_bucket, file_ids_for_key in file_ids_by_key.iteritems():
+                    moved = s3repo.storage.backend(s3_bucket).transition(s3_bucket, list(file_ids_for_key), tier)
+                    for s3_key in moved:
+                        file_ids.extend(file_ids_for_key[s3_key])
+
+                if file_ids:
+                    execute(cls.conn, """
+                        UPDATE {}
+                        SET storage_tier = %(tier)s,
+                            date_tiered  = %(now)s
+                        WHERE file_id IN %(file_ids)s
+                    """.format(table_name), tier = tier, now = now(), file_ids = tuple(file_ids))
+                    cls.conn.commit()
+
+                # Skipped files are passed over, so that they cannot stall the run
+                last_file_id = files_to_tier[-1]['file_id']
+                stats['tiered'] += len(file_ids)
+                stats['skipped'] += len(files_to_tier) - len(file_ids)
+                stats['elapsed'] = time.time() - start_time
+                if progress:
+                    progress(dict(stats))
+
+        stats['elapsed'] = time.time() - start_time
+        return stats
+
+    @classmethod
+    def history(cls, path, archived = False):
+        """
+        Returns every version of path still in the repo, oldest first.  Archived
+        versions (as ArchivedFiles) are only included if archived is set.
+        """
+        local_path = s3repo.file.LocalPath.find(path)
+        if not local_path:
+            return []
+
+        files = s3repo.file.RepoFile.find_by_sql("""
+            SELECT rf.*, {}
+            FROM s3_repo.files rf
+                {}
+            WHERE path_id = %(path_id)s
+        """.format(s3repo.file.PRELOAD_COLUMNS, s3repo.file.PRELOAD_JOINS), preload = True, path_id = local_path.path_id)
+
+        if archived:
+            files += s3repo.file.ArchivedFile.find_by_sql("""
+                SELECT rf.*, {}
+                FROM s3_repo.archived_files rf
+                    {}
+                WHERE path_id = %(path_id)s
+            """.format(s3repo.file.PRELOAD_COLUMNS, s3repo.file.PRELOAD_JOINS), preload = True, path_id = local_path.path_id)
+
+        return sorted(files, key = lambda rf: (rf.date_created, rf.file_id))
+
+    @classmethod
+    def find_orphans(cls, s3_bucket, prefix = '', min_age = None, fetch_size = 10000, path = None):
+        """
+        Generates keys in s3_bucket which no s3_repo.files or archived_files row
+        references.  With path, only keys which the bucket's key layout (see
+        s3repo.keys) would give versions of that local path are checked.
+
+        The bucket listing is streamed a page at a time and merge joined against a
+        server side cursor over the bucket's keys, so memory use is constant regardless
+        of bucket size.  Keys modified within the last min_age seconds (default
+        config['s3.orphan_min_age_seconds']) are skipped, as they may belong to uploads
+        whose rows have not been committed yet.
+        """
+        if min_age is None:
+            min_age = cls.config.get('s3.orphan_min_age_seconds', 86400)
+        cutoff = now() - seconds(min_age)
+
+        layout = s3repo.keys.layout(s3_bucket)
+        if path is not None:
+            prefix = layout.prefix(path)
+
+        bucket = s3repo.file.S3Bucket.find(s3_bucket)
+        cur = cls.conn.cursor('s3repo_find_orphans')
+        cur.itersize = fetch_size
+        cur.execute("""
+            SELECT s3_key COLLATE "C" AS s3_key
+            FROM (
+                SELECT s3_bucket_id, s3_key FROM s3_repo.files
+                UNION ALL
+                SELECT s3_bucket_id, s3_key FROM s3_repo.archived_files
+            ) f
+            WHERE s3_bucket_id = %(s3_bucket_id)s
+                AND s3_key COLLATE "C" >= %(prefix)s
+            ORDER BY 1
+        """, {
+            's3_bucket_id' : bucket.s3_bucket_id if bucket else None,
+            'prefix'       : prefix,
+        })
+
+        try:
+            db_keys = (_utf8(row[0]) for row in cur)
+            db_key = next(db_keys, None)
+
+            for remote_key in s3repo.storage.backend(s3_bucket).list(s3_bucket, prefix):
+                name = _utf8(remote_key.name)
+                while db_key is not None and db_key < name:
+                    db_key = next(db_keys, None)
+
+                if db_key == name:
+                    continue
+
+                if path is not None and not layout.owns(remote_key.name, path):
+                    continue
+
+                if remote_key.last_modified < cutoff:
+                    yield remote_key.name
+        finally:
+            cur.close()
+
+    @classmethod
+    def sweep_orphans(cls, s3_bucket, prefix = '', delete = False, batch_size = 1000, progress = None, **kwargs):
+        """
+        Finds orphaned keys in s3_bucket (see find_orphans) and, if delete is set,
+        removes them in batches of batch_size.  progress is called with the running
+        stats after every batch.  Returns the final stats: orphans and deleted.
+        """
+        stats = {
+            'orphans' : 0,
+            'deleted' : 0,
+        }
+
+        def flush(batch):
+            stats['orphans'] += len(batch)
+            if delete:
+                stats['deleted'] += s3repo.file.RepoFile.purge_keys(s3_bucket, batch)
+            if progress:
+                progress(dict(stats, keys = list(batch)))
+
+        batch = []
+        for s3_key in cls.find_orphans(s3_bucket, prefix, **kwargs):
+            batch.append(s3_key)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+
+        if batch:
+            flush(batch)
+
+        return stats
+
+    @classmethod
+    def wait_for(cls, path = None, tags = None, timeout = None, since = None, prefetch = False):
+        """
+        Returns the current file matching path and/or tags, waiting up to timeout
+        seconds (forever if None) for one to be published.  If since is given, only
+        files published after it count.  Returns None on timeout.
+        """
+        subscription = cls.subscribe(path, tags,
+            timeout         = timeout,
+            since           = since,
+            prefetch        = prefetch,
+            include_current = True,
+        )
+
+        try:
+            return next(subscription, None)
+        finally:
+            subscription.close()
+
+    @classmethod
+    def subscribe(cls, path = None, tags = None, timeout = None, since = None, prefetch = False, include_current = False):
+        """
+        Generates files matching path and/or tags (all of them) as they become current
+        or gain matching tags, blocking on LISTEN in between rather than polling.  Stops
+        after timeout seconds without a match, or never if timeout is None.  If
+        prefetch is set, each file starts downloading before it is yielded.
+        """
+        pending = collections.deque()
+        listener = s3repo.notify.Listener()
+        listener.add_handler(s3repo.notify.PUBLISH_CHANNEL, pending.append)
+        listener.connect()
+
+        recent_ids = collections.deque(maxlen = 1000)
+        def matched(rf):
+            recent_ids.append(rf.file_id)
+            if prefetch and rf.date_uploaded:
+                rf.prefetch()
+            return rf
+
+        try:
+            if include_current:
+                rf = cls.find_current_matching(path, tags, since)
+                if rf:
+                    yield matched(rf)
+
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                if not pending:
+                    remaining = 60 if deadline is None else deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    listener.poll(remaining)
+                    continue
+
+                file_id, _, path_id = pending.popleft().partition(':')
+                if file_id:
+                    rf = s3repo.file.RepoFile.find_by_id(int(file_id))
+                else:
+                    # The path may have been deleted since it was tagged
+                    local_path = s3repo.file.LocalPath.find_by_id(int(path_id))
+                    rf = local_path.find_current() if local_path else None
+
+                if rf and rf.file_id not in recent_ids and cls.file_matches(rf, path, tags, since):
+                    yield matched(rf)
+                    if timeout is not None:
+                        deadline = time.time() + timeout
+        finally:
+            listener.close()
+
+    @classmethod
+    def find_current_matching(cls, path = None, tags = None, since = None):
+        """
+        Returns the most recently published current file matching path, tags and since.
+        """
+        if path:
+            candidates = [ cls.get_file(path) ]
+        elif tags:
+            candidates = cls.find_tagged(all = list(tags))
+        else:
+            return None
+
+        candidates = [ rf for rf in candidates if rf and cls.file_matches(rf, path, tags, since) ]
+        if not candidates:
+            return None
+
+        return max(candidates, key = lambda rf: rf.date_published)
+
+    @classmethod
+    def file_matches(cls, rf, path = None, tags = None, since = None):
+        if not rf.published or rf.date_expired:
+            return False
+
+        if path and rf.local_path() != path:
+            return False
+
+        if since and not (rf.date_published and rf.date_published > since):
+            return False
+
+        if tags:
+            file_tags = { row['tag_name'] for row in fetch_results(cls.conn, """
+                SELECT tag_name
+                FROM s3_repo.all_file_tags
+                WHERE file_id = %(file_id)s
+            """, file_id = rf.file_id) }
+
+            if not set(tags) <= file_tags:
+                return False
+
+        return True
 
-        for rf in files_to_expire:
-            rf.expire()
+    find_tagged_cache = collections.OrderedDict()
+    find_tagged_lock  = threading.Lock()
 
-        files_to_purge = s3repo.file.RepoFile.find_by_sql("""
-            SELECT *
-            FROM s3_repo.deletable_files
+    @classmethod
+    def repo_version(cls):
+        """
+        Returns the repo version, which is advanced by every transaction that
+        publishes, expires or deletes files or changes tags.
+        """
+        return cls.check_repo_version()[0]
+
+    @classmethod
+    def check_repo_version(cls):
+        """
+        Returns the repo version, and whether results read after it may be
+        cached under it.  They may not while this session has uncommitted
+        writes, or while another transaction which advanced the version (and so
+        holds the repo_version advisory lock) has yet to commit, since either
+        could leave the version unchanged for results that were never committed.
+        The version is read before the lock is tried, so a writer which takes
+        the lock after that advances the version past the one returned.
+        """
+        row = fetch_one(cls.conn, """
+            SELECT
+                CASE WHEN is_called THEN last_value ELSE 0 END AS version,
+                CASE
+                    WHEN txid_current_if_assigned() IS NOT NULL THEN FALSE
+                    WHEN pg_try_advisory_lock(hashtext('s3_repo.repo_version')) THEN pg_advisory_unlock(hashtext('s3_repo.repo_version'))
+                    ELSE FALSE
+                END AS settled
+            FROM s3_repo.repo_version
         """)
 
-        for rf in files_to_purge:
-            rf.delete()
+        return row['version'], row['settled']
 
     @classmethod
-    def find_tagged(cls, any = None, all = None, exclude = None, published = True):
+    def clear_find_tagged_cache(cls):
+        with cls.find_tagged_lock:
+            cls.find_tagged_cache.clear()
+
+    @classmethod
+    @s3repo.stats.timed('repo.find_tagged')
+    def find_tagged(cls, any = None, all = None, exclude = None, published = True, cache = True, archived = False, columns = None, as_arrays = False):
         """
+        Returns the files tagged with every tag in all, at least one tag in any,
+        and none of the tags in exclude.  If archived is set, the archived files
+        matching are returned instead, uncached.
+
+        If columns are given, compact records of just those columns (see
+        s3repo.records) are returned instead of RepoFiles, uncached, or with
+        as_arrays a single column oriented FileColumns.
+
+        Results for published files are cached per query and reused until the repo
+        version changes, so a repeated query costs one version check.  Within
+        config['find_tagged.cache_seconds'] of that check it costs nothing, at the
+        price of results that may be that stale.  Cached RepoFile objects are
+        shared between callers.
+        """
+        if not cache or not published or archived or columns:
+            s3repo.stats.incr('find_tagged_cache.bypass')
+            return cls.query_tagged(any, all, exclude, published, archived, columns, as_arrays)
+
+        cache_key = (
+            frozenset(any or []),
+            frozenset(all or []),
+            frozenset(exclude or []),
+        )
+        cache_seconds = cls.config.get('find_tagged.cache_seconds', 0)
+
+        with cls.find_tagged_lock:
+            entry = cls.find_tagged_cache.get(cache_key)
+
+        if entry and time.time() - entry['checked'] < cache_seconds:
+            s3repo.stats.incr('find_tagged_cache.hit')
+            return list(entry['results'])
+
+        version, settled = cls.check_repo_version()
+        if entry and entry['version'] == version:
+            entry['checked'] = time.time()
+            s3repo.stats.incr('find_tagged_cache.hit')
+            return list(entry['results'])
+
+        s3repo.stats.incr('find_tagged_cache.miss')
+        results = cls.query_tagged(any, all, exclude, published)
+        if not settled:
+            s3repo.stats.incr('find_tagged_cache.unsettled')
+            return results
+
+        with cls.find_tagged_lock:
+            cls.find_tagged_cache.pop(cache_key, None)
+            cls.find_tagged_cache[cache_key] = {
+                'version' : version,
+                'checked' : time.time(),
+                'results' : list(results),
+            }
+            while len(cls.find_tagged_cache) > cls.config.get('find_tagged.cache_size', 1000):
+                cls.find_tagged_cache.popitem(last = False)
+
+        return results
+
+    @classmethod
+    def query_tagged(cls, any = None, all = None, exclude = None, published = True, archived = False, columns = None, as_arrays = False):
+        """
+        Uncached implementation of find_tagged
         """
         all_tags     = s3repo.tag.Tag.find_tag_ids(all or [])
         any_tags     = s3repo.tag.Tag.find_tag_ids(any or [])
@@ -215,9 +1264,23 @@ class S3Repo(object):
         if hint_tags:
             where_filters.append("tag_id IN %(hint_tags)s")
 
+        if archived:
+            file_cls, source_view = s3repo.file.ArchivedFile, 's3_repo.all_archived_file_tags'
+        elif published:
+            file_cls, source_view = s3repo.file.RepoFile, 's3_repo.current_file_tags'
+        else:
+            file_cls, source_view = s3repo.file.RepoFile, 's3_repo.all_file_tags'
+
+        if columns:
+            columns = s3repo.records.normalize_columns(file_cls, columns)
+            select_list = s3repo.records.select_list(columns)
+        else:
+            select_list = 'rf.*, ' + s3repo.file.PRELOAD_COLUMNS
+
         query = """
-            SELECT *
-            FROM s3_repo.files
+            SELECT {select_list}
+            FROM {table_name} rf
+                {preload_joins}
             WHERE file_id in (
                     SELECT file_id
                     FROM {source_view}
@@ -226,15 +1289,32 @@ class S3Repo(object):
                     HAVING {having_filter}
                 )
         """.format(
-            source_view   = 's3_repo.current_file_tags' if published else 's3_repo.all_file_tags',
+            select_list   = select_list,
+            table_name    = file_cls.table_name,
+            preload_joins = s3repo.file.PRELOAD_JOINS,
+            source_view   = source_view,
             where_filter  = '\n    AND '.join(where_filters),
             having_filter = '\n    AND '.join(having_filters),
         )
 
-        return s3repo.file.RepoFile.find_by_sql(query,
+        bind_params = dict(
             num_all_tags = len(all_tags),
             all_tags     = tuple(all_tags),
             any_tags     = tuple(any_tags),
             exclude_tags = tuple(exclude_tags),
             hint_tags    = tuple(hint_tags),
         )
+
+        if columns:
+            return s3repo.records.fetch(cls.conn, query, columns, file_cls, as_arrays, **bind_params)
+
+        return file_cls.find_by_sql(query, preload = True, **bind_params)
+
+
+def _utf8(value):
+    """
+    S3 lists keys in UTF-8 byte order, so merge comparisons must be done on bytes.
+    """
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value
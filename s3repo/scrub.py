@@ -0,0 +1,74 @@
+"""
+Background integrity checks of the local cache.  S3Repo.scrub_cache re-hashes
+cached files against RepoFile.md5, most frequently accessed first, and
+re-downloads any which no longer match.  Each file's last_verified time is kept
+in s3_repo.downloads, so every pass only checks files not verified within
+"scrub.interval_seconds".  Reads are limited to "scrub.bytes_per_second" across
+all of the scrubber's threads, so that it does not compete with foreground reads:
+
+    "scrub.bytes_per_second" : 20000000,
+    "scrub.threads"          : 2,
+    "scrub.interval_seconds" : 604800
+
+start_scrubber() runs scrub passes from a daemon thread.
+"""
+import os, sys, time, ctypes, logging, threading
+import s3repo.common
+import s3repo.file
+
+__all__ = [
+    'drop_cache',
+    'hash_file',
+    'start_scrubber',
+]
+
+logger = logging.getLogger('s3repo.scrub')
+
+POSIX_FADV_DONTNEED = 4 # On Linux
+
+def drop_cache(fd):
+    """
+    Asks the kernel to drop fd's pages from the page cache, where it can: with
+    os.posix_fadvise on Python 3, or by calling libc's posix_fadvise through
+    ctypes on Linux.  Elsewhere, does nothing.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    elif sys.platform.startswith('linux'):
+        fadvise = getattr(ctypes.CDLL(None), 'posix_fadvise', None)
+        if fadvise is not None:
+            fadvise(fd, ctypes.c_int64(0), ctypes.c_int64(0), POSIX_FADV_DONTNEED)
+
+def hash_file(filename, limiter = None):
+    """
+    Returns the md5 hexdigest of filename, reading within the limiter's budget.
+    The pages read are then dropped from the page cache, so that scrubbing does
+    not evict files in foreground use.
+    """
+    with open(filename, 'rb') as fp:
+        hexdigest = s3repo.file.compute_md5(fp, limiter = limiter)[0]
+        drop_cache(fp.fileno())
+
+    return hexdigest
+
+
+def start_scrubber(pause_seconds = 3600):
+    """
+    Starts a daemon thread which runs S3Repo.scrub_cache, pausing pause_seconds
+    between passes.
+    """
+    import s3repo.repo
+
+    def scrub():
+        while True:
+            try:
+                with s3repo.common.pooled_conns():
+                    s3repo.repo.S3Repo.scrub_cache()
+            except Exception:
+                logger.exception("scrub pass failed")
+            time.sleep(pause_seconds)
+
+    thread = threading.Thread(target = scrub, name = 's3repo-scrub')
+    thread.daemon = True
+    thread.start()
+    return thread
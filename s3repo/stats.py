@@ -0,0 +1,361 @@
+"""
+Instrumentation for S3 operations, SQL statements, transfer sizes and local
+cache hit rates.  Collection is disabled by default and costs a single check per
+call until enabled:
+
+    s3repo.stats.enable()
+    s3repo.stats.add_exporter(s3repo.stats.PrometheusFileExporter('/var/lib/node_exporter/s3repo.prom'))
+    s3repo.stats.start_reporter(60)
+
+    s3repo.stats.snapshot()['timers']['s3.get']['p99']
+"""
+import os, re, time, bisect, socket, logging, threading, functools
+import psycopg2.extensions
+
+__all__ = [
+    'enable',
+    'disable',
+    'enabled',
+    'reset',
+    'incr',
+    'observe',
+    'timer',
+    'timed',
+    'snapshot',
+    'add_exporter',
+    'flush',
+    'start_reporter',
+    'LoggingExporter',
+    'StatsdExporter',
+    'PrometheusFileExporter',
+    'InstrumentedConnection',
+]
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [ 0 ] * (len(BUCKETS) + 1)
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max    = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket containing the q quantile.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def summary(self):
+        return {
+            'count'   : self.count,
+            'total'   : self.total,
+            'mean'    : self.total / self.count if self.count else 0.0,
+            'p50'     : self.quantile(0.50),
+            'p90'     : self.quantile(0.90),
+            'p99'     : self.quantile(0.99),
+            'max'     : self.max,
+            'buckets' : list(zip(BUCKETS + (float('inf'),), self.counts)),
+        }
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.counters = {}
+        self.timers   = {}
+
+    def incr(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.timers:
+                self.timers[name] = Histogram()
+            self.timers[name].observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters' : dict(self.counters),
+                'timers'   : dict((name, hist.summary()) for name, hist in self.timers.items()),
+            }
+
+
+_stats     = None
+_exporters = []
+
+def enable():
+    global _stats
+    if _stats is None:
+        _stats = Stats()
+
+def disable():
+    global _stats
+    _stats = None
+
+def enabled():
+    return _stats is not None
+
+def reset():
+    global _stats
+    if _stats is not None:
+        _stats = Stats()
+
+def incr(name, value = 1):
+    if _stats is not None:
+        _stats.incr(name, value)
+
+def observe(name, seconds):
+    if _stats is not None:
+        _stats.observe(name, seconds)
+
+def snapshot():
+    if _stats is None:
+        return { 'counters' : {}, 'timers' : {} }
+    return _stats.snapshot()
+
+
+class _Timer(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.time() - self.start)
+        if exc_info[0] is not None:
+            incr(self.name + '.errors')
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_timer = _NullTimer()
+
+def timer(name):
+    """
+    Context manager which records the latency of its body under name.
+    """
+    if _stats is None:
+        return _null_timer
+    return _Timer(name)
+
+def timed(name):
+    """
+    Decorator which records the latency of every call under name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _stats is None:
+                return func(*args, **kwargs)
+            with _Timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_exporter(exporter):
+    _exporters.append(exporter)
+
+def flush():
+    """
+    Sends the current snapshot to every registered exporter.
+    """
+    data = snapshot()
+    for exporter in _exporters:
+        exporter.export(data)
+
+def start_reporter(interval):
+    """
+    Starts a daemon thread which calls flush() every interval seconds.
+    """
+    def report():
+        while True:
+            time.sleep(interval)
+            flush()
+
+    thread = threading.Thread(target = report, name = 's3repo-stats')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class LoggingExporter(object):
+    def __init__(self, logger = None, level = logging.INFO):
+        self.logger = logger or logging.getLogger('s3repo.stats')
+        self.level  = level
+
+    def export(self, data):
+        for name, value in sorted(data['counters'].items()):
+            self.logger.log(self.level, "%s count=%s", name, value)
+        for name, summary in sorted(data['timers'].items()):
+            self.logger.log(self.level, "%s count=%d mean=%.4f p50=%.4f p99=%.4f max=%.4f",
+                name, summary['count'], summary['mean'], summary['p50'], summary['p99'], summary['max'])
+
+
+class StatsdExporter(object):
+    """
+    Sends counter deltas as StatsD counters and timer quantiles (in ms) as gauges.
+    """
+    def __init__(self, host = 'localhost', port = 8125, prefix = 's3repo'):
+        self.addr   = (host, port)
+        self.prefix = prefix
+        self.sock   = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.last   = {}
+
+    def export(self, data):
+        lines = []
+        for name, value in data['counters'].items():
+            delta = value - self.last.get(name, 0)
+            self.last[name] = value
+            if delta:
+                lines.append("{}.{}:{}|c".format(self.prefix, name, delta))
+
+        for name, summary in data['timers'].items():
+            for quantile in [ 'p50', 'p99', 'max' ]:
+                lines.append("{}.{}.{}:{:.3f}|g".format(self.prefix, name, quantile, summary[quantile] * 1000))
+
+        for line in lines:
+            self.sock.sendto(line.encode('utf-8'), self.addr)
+
+
+class PrometheusFileExporter(object):
+    """
+    Writes the Prometheus text format to filename (for the node_exporter textfile
+    collector), replacing it atomically.
+    """
+    def __init__(self, filename, prefix = 's3repo'):
+        self.filename = filename
+        self.prefix   = prefix
+
+    def metric_name(self, name):
+        return self.prefix + '_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+    def export(self, data):
+        lines = []
+        for name, value in sorted(data['counters'].items()):
+            metric = self.metric_name(name) + '_total'
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+
+        for name, summary in sorted(data['timers'].items()):
+            metric = self.metric_name(name) + '_seconds'
+            lines.append("# TYPE {} histogram".format(metric))
+            cumulative = 0
+            for bound, count in summary['buckets']:
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, le, cumulative))
+            lines.append("{}_sum {}".format(metric, summary['total']))
+            lines.append("{}_count {}".format(metric, summary['count']))
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.rename(tmp_filename, self.filename)
+
+
+def statement_name(query):
+    """
+    Names a SQL statement by its leading keyword, eg sql.select or sql.update.
+    Prepared statements are named individually, eg sql.execute.s3repo_find_tag_ids
+    """
+    words = query[:64].split(None, 2)
+    if not words:
+        return 'sql.unknown'
+
+    keyword = words[0].lower()
+    if keyword == 'execute' and len(words) > 1:
+        return 'sql.execute.' + words[1].split('(', 1)[0]
+
+    return 'sql.' + keyword
+
+
+_cursor_classes = {}
+def instrumented_cursor(base):
+    """
+    Returns a subclass of the cursor class base which times every statement.
+    """
+    if base not in _cursor_classes:
+        def execute(self, query, vars = None):
+            if _stats is None:
+                return base.execute(self, query, vars)
+            with _Timer(statement_name(query)):
+                return base.execute(self, query, vars)
+
+        def executemany(self, query, vars_list):
+            if _stats is None:
+                return base.executemany(self, query, vars_list)
+            with _Timer(statement_name(query)):
+                return base.executemany(self, query, vars_list)
+
+        def copy_expert(self, sql, file, *args, **kwargs):
+            if _stats is None:
+                return base.copy_expert(self, sql, file, *args, **kwargs)
+            with _Timer('sql.copy'):
+                return base.copy_expert(self, sql, file, *args, **kwargs)
+
+        def copy_to(self, *args, **kwargs):
+            if _stats is None:
+                return base.copy_to(self, *args, **kwargs)
+            with _Timer('sql.copy'):
+                return base.copy_to(self, *args, **kwargs)
+
+        def copy_from(self, *args, **kwargs):
+            if _stats is None:
+                return base.copy_from(self, *args, **kwargs)
+            with _Timer('sql.copy'):
+                return base.copy_from(self, *args, **kwargs)
+
+        _cursor_classes[base] = type('Instrumented' + base.__name__, (base,), {
+            'execute'     : execute,
+            'executemany' : executemany,
+            'copy_expert' : copy_expert,
+            'copy_to'     : copy_to,
+            'copy_from'   : copy_from,
+        })
+
+    return _cursor_classes[base]
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection whose cursors, whatever their cursor_factory, time every
+    statement they execute.
+    """
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = instrumented_cursor(base)
+        return super(InstrumentedConnection, self).cursor(*args, **kwargs)
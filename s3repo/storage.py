@@ -0,0 +1,600 @@
+"""
+Storage backends for repo file contents.  Each bucket is served by one backend,
+chosen by the "storage.backends" configuration; buckets without an entry use
+"storage.default", which is S3 unless configured otherwise:
+
+    "storage.backends" : {
+        "onprem-bucket" : { "type" : "fs", "root" : "/mnt/nfs/repo", "link" : "auto" }
+    }
+
+Objects can be moved between storage tiers, from warmest to coldest: standard,
+infrequent and glacier.  Objects in a cold tier must be restored before reading.
+"""
+import io, os, re, json, time, errno, shutil, logging, datetime, subprocess, collections
+import s3repo.common
+import s3repo.stats
+import s3repo.throttle
+import s3repo.transfers
+import s3repo.exceptions
+from pyutil.util import mkdirp
+
+__all__ = [
+    'backend',
+    'reset',
+    'StorageKey',
+    'StorageBackend',
+    'S3Backend',
+    'FileSystemBackend',
+    'S3Upload',
+    'FileSystemUpload',
+]
+
+logger = logging.getLogger('s3repo.storage')
+
+StorageKey = collections.namedtuple('StorageKey', [ 'name', 'size', 'last_modified' ])
+
+class StorageBackend(object):
+    """
+    Interface for storage backends.  Keys are listed in byte order.
+    """
+    tiers         = [ 'standard', 'infrequent', 'glacier' ]
+    cold_tiers    = frozenset([ 'glacier' ])
+    min_part_size = 0
+
+    def put(self, bucket, key, filename, md5 = None):
+        """
+        Stores filename as key.  md5 is the (hexdigest, b64digest, size) of the file.
+        """
+        raise NotImplementedError()
+
+    def get(self, bucket, key, filename):
+        raise NotImplementedError()
+
+    def get_range(self, bucket, key, start, end):
+        """
+        Returns bytes start through end (inclusive) of key
+        """
+        raise NotImplementedError()
+
+    def delete(self, bucket, keys):
+        """
+        Removes keys, which need not exist.  Returns the number of keys submitted.
+        """
+        raise NotImplementedError()
+
+    def list(self, bucket, prefix = ''):
+        """
+        Generates StorageKeys for every key starting with prefix, in byte order.
+        """
+        raise NotImplementedError()
+
+    def copy(self, src_bucket, src_key, dst_bucket, dst_key):
+        raise NotImplementedError()
+
+    def start_upload(self, bucket, key):
+        """
+        Returns an upload of key from a stream, which is sent with put_part(data)
+        for each but the last part, then complete(data) with the rest, or
+        abort().  Parts must be at least min_part_size bytes (5MB for S3).  The
+        key does not exist until the upload completes.
+        """
+        raise NotImplementedError()
+
+    def transition(self, bucket, keys, tier):
+        """
+        Moves keys to tier.  Returns the list of keys moved; keys which cannot be
+        moved (such as missing keys) are logged and skipped, so that one bad key
+        does not hold back the rest.
+        """
+        raise NotImplementedError()
+
+    def restore(self, bucket, key, days = 1):
+        """
+        Requests that key, in a cold tier, be made readable for days.  Restores
+        complete asynchronously; see is_restored.
+        """
+        raise NotImplementedError()
+
+    def is_restored(self, bucket, key):
+        """
+        Returns whether key can be read now.
+        """
+        raise NotImplementedError()
+
+
+class S3Backend(StorageBackend):
+    """
+    Stores keys in S3.  Every request runs through the shared s3repo.throttle
+    scheduler, and uploads and downloads wait their turn in the s3repo.transfers
+    scheduler.  Files over multipart_threshold bytes are uploaded in parts of
+    part_size bytes, so that a failed part is retried alone.
+    """
+    max_delete_keys = 1000 # S3 multi-object delete accepts at most 1000 keys
+    min_part_size   = 5 * 1024 * 1024 # Of every part but the last
+    max_copy_size   = 5 * 1024 * 1024 * 1024 # Largest object a single copy can write
+    copy_part_size  = 512 * 1024 * 1024
+
+    def __init__(self, multipart_threshold = 64 * 1024 * 1024, part_size = 16 * 1024 * 1024):
+        self.multipart_threshold = multipart_threshold
+        self.part_size           = part_size
+
+    def bucket(self, bucket):
+        return s3repo.common.s3_conn().get_bucket(bucket, validate = False)
+
+    def key(self, bucket, key):
+        from boto.s3.key import Key
+        return Key(self.bucket(bucket), key)
+
+    def call(self, bucket, key, name, func):
+        return s3repo.throttle.scheduler().call(bucket, key, name, func)
+
+    def transfer(self, bucket, key, name, func):
+        """
+        A call which moves data, and so waits its turn in the s3repo.transfers
+        scheduler.  func should pass s3repo.transfers.progress() to boto as cb,
+        with num_cb = -1, so that each chunk is charged as it moves.
+        """
+        return s3repo.throttle.scheduler().call(bucket, key, name, func, transfer = True)
+
+    def put(self, bucket, key, filename, md5 = None):
+        size = os.path.getsize(filename)
+        if size > self.multipart_threshold:
+            self.put_multipart(bucket, key, filename, size)
+        else:
+            self.transfer(bucket, key, 's3.put', lambda: self.key(bucket, key).set_contents_from_filename(filename, md5 = md5,
+                cb     = s3repo.transfers.progress(),
+                num_cb = -1,
+            ))
+        s3repo.stats.incr('s3.bytes_uploaded', size)
+
+    def put_multipart(self, bucket, key, filename, size):
+        upload = self.call(bucket, key, 's3.initiate_multipart', lambda: self.bucket(bucket).initiate_multipart_upload(key))
+        completed = False
+        try:
+            with open(filename, 'rb') as fp:
+                for part_num, offset in enumerate(range(0, size, self.part_size), 1):
+                    def put_part():
+                        fp.seek(offset)
+                        upload.upload_part_from_file(fp, part_num, size = min(self.part_size, size - offset),
+                            cb     = s3repo.transfers.progress(),
+                            num_cb = -1,
+                        )
+                    self.transfer(bucket, key, 's3.put_part', put_part)
+
+            self.call(bucket, key, 's3.complete_multipart', upload.complete_upload)
+            completed = True
+        finally:
+            if not completed:
+                try:
+                    self.call(bucket, key, 's3.cancel_multipart', upload.cancel_upload)
+                except Exception:
+                    pass # The upload's parts are left for the bucket's lifecycle rules
+
+    def get(self, bucket, key, filename):
+        with open(filename, 'wb') as fp:
+            def get_rest():
+                # Retries continue from the last byte received
+                fp.flush()
+                headers = { 'Range' : 'bytes={}-'.format(fp.tell()) } if fp.tell() else None
+                self.key(bucket, key).get_contents_to_file(fp, headers = headers, cb = s3repo.transfers.progress(), num_cb = -1)
+            self.transfer(bucket, key, 's3.get', get_rest)
+        s3repo.stats.incr('s3.bytes_downloaded', os.path.getsize(filename))
+
+    def get_range(self, bucket, key, start, end):
+        data = self.transfer(bucket, key, 's3.get_range', lambda: self.key(bucket, key).get_contents_as_string(
+            headers = { 'Range' : 'bytes={}-{}'.format(start, end) },
+            cb      = s3repo.transfers.progress(),
+            num_cb  = -1,
+        ))
+        s3repo.stats.incr('s3.bytes_downloaded', len(data))
+        return data
+
+    def delete(self, bucket, keys):
+        keys = list(keys)
+        remote_bucket = self.bucket(bucket)
+        for i in range(0, len(keys), self.max_delete_keys):
+            batch = keys[i:i + self.max_delete_keys]
+            result = self.call(bucket, batch[0], 's3.delete_keys', lambda: remote_bucket.delete_keys(batch, quiet = True))
+            if result.errors:
+                raise s3repo.exceptions.RepoPurgeError([ (x.key, x.code) for x in result.errors ])
+
+        return len(keys)
+
+    def list(self, bucket, prefix = ''):
+        import boto.utils
+        for remote_key in self.bucket(bucket).list(prefix):
+            s3repo.stats.incr('s3.keys_listed')
+            yield StorageKey(remote_key.name, remote_key.size, boto.utils.parse_ts(remote_key.last_modified))
+
+    def copy(self, src_bucket, src_key, dst_bucket, dst_key):
+        self.call(dst_bucket, dst_key, 's3.copy', lambda: self.bucket(dst_bucket).copy_key(dst_key, src_bucket, src_key))
+
+    def start_upload(self, bucket, key):
+        return S3Upload(self, bucket, key)
+
+    storage_classes = {
+        'standard'   : 'STANDARD',
+        'infrequent' : 'STANDARD_IA',
+        'glacier'    : 'GLACIER',
+    }
+
+    def transition(self, bucket, keys, tier):
+        """
+        Changes storage class by copying each key onto itself.  Keys over
+        max_copy_size, which S3 will not copy in one request, are copied in
+        parts.
+        """
+        remote_bucket = self.bucket(bucket)
+        moved = []
+        for key in keys:
+            try:
+                remote_key = self.call(bucket, key, 's3.head', lambda: remote_bucket.get_key(key))
+                if remote_key is None:
+                    logger.warning("not moving s3://%s/%s to %s, it does not exist", bucket, key, tier)
+                    continue
+
+                if remote_key.size > self.max_copy_size:
+                    self.transition_multipart(bucket, remote_key, tier)
+                else:
+                    self.call(bucket, key, 's3.transition', lambda: remote_bucket.copy_key(key, bucket, key,
+                        storage_class = self.storage_classes[tier],
+                    ))
+            except Exception as e:
+                logger.warning("failed to move s3://%s/%s to %s (%s), skipping it", bucket, key, tier, e)
+                continue
+
+            moved.append(key)
+
+        return moved
+
+    def transition_multipart(self, bucket, remote_key, tier):
+        """
+        Copies remote_key onto itself in parts of copy_part_size, keeping its
+        content type and metadata as copy_key does.
+        """
+        key = remote_key.name
+        headers = { 'x-amz-storage-class' : self.storage_classes[tier] }
+        if remote_key.content_type:
+            headers['Content-Type'] = remote_key.content_type
+
+        upload = self.call(bucket, key, 's3.initiate_multipart', lambda: self.bucket(bucket).initiate_multipart_upload(key,
+            headers  = headers,
+            metadata = remote_key.metadata,
+        ))
+        completed = False
+        try:
+            for part_num, offset in enumerate(range(0, remote_key.size, self.copy_part_size), 1):
+                end = min(offset + self.copy_part_size, remote_key.size) - 1
+                self.call(bucket, key, 's3.copy_part', lambda: upload.copy_part_from_key(bucket, key, part_num, offset, end))
+
+            self.call(bucket, key, 's3.complete_multipart', upload.complete_upload)
+            completed = True
+        finally:
+            if not completed:
+                try:
+                    self.call(bucket, key, 's3.cancel_multipart', upload.cancel_upload)
+                except Exception:
+                    pass # The upload's parts are left for the bucket's lifecycle rules
+
+    def restore(self, bucket, key, days = 1):
+        import boto.exception
+        try:
+            self.call(bucket, key, 's3.restore', lambda: self.key(bucket, key).restore(days))
+        except boto.exception.S3ResponseError as e:
+            if e.error_code != 'RestoreAlreadyInProgress':
+                raise
+
+    def is_restored(self, bucket, key):
+        remote_key = self.call(bucket, key, 's3.head', lambda: self.bucket(bucket).get_key(key))
+        if remote_key.storage_class != self.storage_classes['glacier']:
+            return True
+        return remote_key.ongoing_restore is False
+
+
+class S3Upload(object):
+    """
+    Streaming upload to S3.  The multipart upload is only started with the first
+    part; a stream which fits in one part is sent with a single put.
+    """
+    def __init__(self, backend, bucket, key):
+        self.backend = backend
+        self.bucket  = bucket
+        self.key     = key
+        self.upload  = None
+        self.parts   = 0
+
+    def put_part(self, data):
+        if self.upload is None:
+            self.upload = self.backend.call(self.bucket, self.key, 's3.initiate_multipart', lambda: self.backend.bucket(self.bucket).initiate_multipart_upload(self.key))
+
+        self.parts += 1
+        part_num = self.parts
+        self.backend.transfer(self.bucket, self.key, 's3.put_part', lambda: self.upload.upload_part_from_file(io.BytesIO(data), part_num, size = len(data),
+            cb     = s3repo.transfers.progress(),
+            num_cb = -1,
+        ))
+        s3repo.stats.incr('s3.bytes_uploaded', len(data))
+
+    def complete(self, data = b''):
+        if self.upload is None:
+            self.backend.transfer(self.bucket, self.key, 's3.put', lambda: self.backend.key(self.bucket, self.key).set_contents_from_string(data,
+                cb     = s3repo.transfers.progress(),
+                num_cb = -1,
+            ))
+            s3repo.stats.incr('s3.bytes_uploaded', len(data))
+            return
+
+        if data:
+            self.put_part(data)
+        self.backend.call(self.bucket, self.key, 's3.complete_multipart', self.upload.complete_upload)
+
+    def abort(self):
+        if self.upload is not None:
+            self.backend.call(self.bucket, self.key, 's3.cancel_multipart', self.upload.cancel_upload)
+
+
+class FileSystemBackend(StorageBackend):
+    """
+    Stores keys as files under root/bucket/key, on local disk or NFS.  Files are
+    placed with a reflink where the filesystem allows it, so "uploads" and
+    "downloads" need not copy any data.  link may be 'reflink', 'hardlink',
+    'copy', or 'auto' to try a reflink and fall back to a copy.  The method that
+    works is remembered per pair of filesystems, so a failing reflink is only
+    tried once.
+
+    Hardlinks share the inode with the local cache, where rewriting a file in
+    place (with RepoFile.touch or open('w')) would change the stored copy every
+    other host reads.  Hardlinked files are therefore made read only, so such
+    writes fail rather than corrupt the store, and 'auto' never hardlinks.
+
+    Key segments which cannot be file names ('', '.' and '..', as in the keys
+    "/abs/path" or "a//b") are escaped, as is '%'.
+
+    Tiers are simulated, so that tiering can be exercised without S3: a key's
+    tier and restore state are kept in a sidecar file, and a restore completes
+    restore_seconds after it is requested.
+    """
+    tmp_suffix  = '.s3repo-tmp'
+    tier_suffix = '.s3repo-tier'
+
+    def __init__(self, root, link = 'auto', restore_seconds = 0):
+        self.root = root
+        self.link = link
+        self.restore_seconds = restore_seconds
+        self.link_methods = {}
+
+    def path(self, bucket, key):
+        return os.path.join(self.root, bucket, *[ encode_segment(x) for x in key.split('/') ])
+
+    def place(self, src, dst):
+        """
+        Atomically places a copy of src at dst.  Returns the method used.
+        """
+        mkdirp(os.path.dirname(dst))
+        tmp = dst + self.tmp_suffix
+        devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+
+        methods = [ 'reflink', 'copy' ] if self.link == 'auto' else [ self.link ]
+        if devices in self.link_methods:
+            methods = methods[methods.index(self.link_methods[devices]):]
+
+        for method in methods:
+            swallow_missing(os.unlink, tmp)
+            try:
+                if method == 'reflink':
+                    with open(os.devnull, 'w') as devnull:
+                        subprocess.check_call([ 'cp', '--reflink=always', src, tmp ], stderr = devnull)
+                elif method == 'hardlink':
+                    os.link(src, tmp)
+                    os.chmod(tmp, os.stat(tmp).st_mode & ~0o222)
+                else:
+                    shutil.copyfile(src, tmp)
+            except (OSError, subprocess.CalledProcessError):
+                if method == methods[-1]:
+                    raise
+                continue
+
+            self.link_methods[devices] = method
+            os.rename(tmp, dst)
+            return method
+
+    def put(self, bucket, key, filename, md5 = None):
+        with s3repo.stats.timer('fs.put'):
+            self.place(filename, self.path(bucket, key))
+        s3repo.stats.incr('fs.bytes_uploaded', os.path.getsize(filename))
+
+    def start_upload(self, bucket, key):
+        return FileSystemUpload(self.path(bucket, key), self.tmp_suffix)
+
+    def get(self, bucket, key, filename):
+        self.assert_restored(bucket, key)
+        with s3repo.stats.timer('fs.get'):
+            self.place(self.path(bucket, key), filename)
+        s3repo.stats.incr('fs.bytes_downloaded', os.path.getsize(filename))
+
+    def get_range(self, bucket, key, start, end):
+        self.assert_restored(bucket, key)
+        with s3repo.stats.timer('fs.get_range'), open(self.path(bucket, key), 'rb') as fp:
+            fp.seek(start)
+            data = fp.read(end - start + 1)
+        s3repo.stats.incr('fs.bytes_downloaded', len(data))
+        return data
+
+    def delete(self, bucket, keys):
+        count = 0
+        with s3repo.stats.timer('fs.delete_keys'):
+            for key in keys:
+                swallow_missing(os.unlink, self.path(bucket, key))
+                swallow_missing(os.unlink, self.path(bucket, key) + self.tier_suffix)
+                count += 1
+        return count
+
+    def list(self, bucket, prefix = ''):
+        bucket_root = os.path.join(self.root, bucket)
+        segments = prefix.split('/')[:-1]
+        rel_dir = os.path.join('', *[ encode_segment(x) for x in segments ])
+        key_dir = ''.join(x + '/' for x in segments)
+
+        for key in self.walk(bucket_root, rel_dir, key_dir):
+            if key.name.startswith(prefix):
+                yield key
+
+    def walk(self, bucket_root, rel_dir, key_dir):
+        """
+        Walks rel_dir (holding keys starting with key_dir) in S3 key order.  Sorting
+        siblings by their key segment, plus '/' for directories, makes the depth
+        first walk emit keys in global byte order.
+        """
+        abs_dir = os.path.join(bucket_root, rel_dir)
+        try:
+            names = os.listdir(abs_dir)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise
+
+        entries = []
+        for name in names:
+            if name.endswith(self.tmp_suffix) or name.endswith(self.tier_suffix):
+                continue
+            is_dir = os.path.isdir(os.path.join(abs_dir, name))
+            key = key_dir + decode_segment(name) + ('/' if is_dir else '')
+            entries.append((key, name, is_dir))
+
+        for key, name, is_dir in sorted(entries):
+            rel_path = os.path.join(rel_dir, name)
+            if is_dir:
+                for storage_key in self.walk(bucket_root, rel_path, key):
+                    yield storage_key
+            else:
+                st = os.stat(os.path.join(bucket_root, rel_path))
+                yield StorageKey(key, st.st_size, datetime.datetime.utcfromtimestamp(st.st_mtime))
+
+    def copy(self, src_bucket, src_key, dst_bucket, dst_key):
+        self.assert_restored(src_bucket, src_key)
+        with s3repo.stats.timer('fs.copy'):
+            self.place(self.path(src_bucket, src_key), self.path(dst_bucket, dst_key))
+
+    def tier_state(self, bucket, key):
+        try:
+            with open(self.path(bucket, key) + self.tier_suffix) as fp:
+                return json.load(fp)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return { 'tier' : 'standard' }
+
+    def write_tier_state(self, bucket, key, state):
+        filename = self.path(bucket, key) + self.tier_suffix
+        if state['tier'] == 'standard':
+            swallow_missing(os.unlink, filename)
+            return
+
+        with open(filename + self.tmp_suffix, 'w') as fp:
+            json.dump(state, fp)
+        os.rename(filename + self.tmp_suffix, filename)
+
+    def tier(self, bucket, key):
+        return self.tier_state(bucket, key)['tier']
+
+    def transition(self, bucket, keys, tier):
+        moved = []
+        for key in keys:
+            if not os.path.exists(self.path(bucket, key)):
+                logger.warning("not moving %s to %s, it does not exist", self.path(bucket, key), tier)
+                continue
+            self.write_tier_state(bucket, key, { 'tier' : tier })
+            moved.append(key)
+
+        return moved
+
+    def restore(self, bucket, key, days = 1):
+        state = self.tier_state(bucket, key)
+        if state['tier'] not in self.cold_tiers or state.get('restore_requested'):
+            return
+
+        state['restore_requested'] = time.time()
+        state['restore_expires'] = time.time() + self.restore_seconds + days * 86400
+        self.write_tier_state(bucket, key, state)
+
+    def is_restored(self, bucket, key):
+        state = self.tier_state(bucket, key)
+        if state['tier'] not in self.cold_tiers:
+            return True
+        if not state.get('restore_requested'):
+            return False
+        return state['restore_requested'] + self.restore_seconds <= time.time() < state['restore_expires']
+
+    def assert_restored(self, bucket, key):
+        if not self.is_restored(bucket, key):
+            raise s3repo.exceptions.RepoRestoreRequiredError((bucket, key))
+
+
+class FileSystemUpload(object):
+    """
+    Streaming upload to a file, which is written aside and renamed into place
+    when complete.
+    """
+    def __init__(self, path, tmp_suffix):
+        mkdirp(os.path.dirname(path))
+        self.path  = path
+        self.tmp   = path + tmp_suffix
+        self.fp    = open(self.tmp, 'wb')
+        self.parts = 0
+
+    def put_part(self, data):
+        self.parts += 1
+        self.fp.write(data)
+        s3repo.stats.incr('fs.bytes_uploaded', len(data))
+
+    def complete(self, data = b''):
+        self.put_part(data)
+        self.fp.close()
+        os.rename(self.tmp, self.path)
+
+    def abort(self):
+        self.fp.close()
+        swallow_missing(os.unlink, self.tmp)
+
+
+def encode_segment(segment):
+    if segment in ('', '.', '..'):
+        return '%' + '2E' * len(segment) + '_'
+    return segment.replace('%', '%25')
+
+def decode_segment(name):
+    if name.endswith('_') and re.match(r'^%(2E)*_$', name):
+        return '.' * ((len(name) - 2) // 2)
+    return name.replace('%25', '%')
+
+def swallow_missing(func, path):
+    try:
+        func(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+backend_types = {
+    's3' : S3Backend,
+    'fs' : FileSystemBackend,
+}
+
+_backends = {}
+def backend(bucket):
+    """
+    Returns the storage backend for bucket.
+    """
+    if bucket not in _backends:
+        app_cfg = s3repo.common.load_cfg()
+        info = app_cfg.get('storage.backends', {}).get(bucket) or app_cfg.get('storage.default') or { 'type' : 's3' }
+        info = dict(info)
+        _backends[bucket] = backend_types[info.pop('type')](**info)
+
+    return _backends[bucket]
+
+def reset():
+    """
+    Forgets configured backends so that they are rebuilt from the configuration.
+    """
+    _backends.clear()
@@ -1,4 +1,6 @@
 import s3repo.common
+import s3repo.stats
+import s3repo.prepared
 import pyutil.pghelper
 import pyutil.dbtable
 from pyutil.pghelper import fetch_results, execute
@@ -7,7 +9,7 @@ from pyutil.dateutil import *
 class Tag(pyutil.dbtable.DBTable):
     table_name = 's3_repo.tags'
     memoize    = True
-    conn       = s3repo.common.db_conn()
+    conn       = s3repo.common.ThreadConn()
 
     id_field   = 'tag_id'
     key_fields = [
@@ -22,16 +24,27 @@ class Tag(pyutil.dbtable.DBTable):
     def __repr__(self):
         return "Tag({tag_id}, {tag_name})".format(**self.get_dict())
 
+    find_tag_ids_sql = s3repo.prepared.register('find_tag_ids', """
+        SELECT tag_id
+        FROM s3_repo.tags
+        WHERE tag_name = ANY(%(tag_names)s)
+    """, [ ('tag_names', 'TEXT[]') ])
+
     @classmethod
+    @s3repo.stats.timed('tag.find_tag_ids')
     def find_tag_ids(cls, tag_names):
         assert isinstance(tag_names, (list, tuple))
-        existing_tags = cls.find_by(
-            tag_name = tuple(tag_names),
+        if not tag_names:
+            return []
+
+        existing_tags = fetch_results(cls.conn, cls.find_tag_ids_sql.sql(cls.conn),
+            tag_names = list(tag_names),
         )
 
-        return [ x.tag_id for x in existing_tags ]
+        return [ x['tag_id'] for x in existing_tags ]
 
     @classmethod
+    @s3repo.stats.timed('tag.find_or_create_tag_ids')
     def find_or_create_tag_ids(cls, tag_names):
         assert isinstance(tag_names, (list, tuple))
 
@@ -53,7 +66,7 @@ class Tag(pyutil.dbtable.DBTable):
 
 class RepoFileTag(pyutil.dbtable.DBTable):
     table_name = 's3_repo.file_tags'
-    conn = s3repo.common.db_conn()
+    conn = s3repo.common.ThreadConn()
 
     key_fields = [
         'file_id',
@@ -67,6 +80,7 @@ class RepoFileTag(pyutil.dbtable.DBTable):
     ]
 
     @classmethod
+    @s3repo.stats.timed('tag.tag_file')
     def tag_file(cls, file_id, *tag_names):
         tag_ids = Tag.find_or_create_tag_ids(tag_names)
 
@@ -95,6 +109,7 @@ class RepoFileTag(pyutil.dbtable.DBTable):
         )
 
     @classmethod
+    @s3repo.stats.timed('tag.untag_file')
     def untag_file(cls, file_id, *tag_names):
         tag_ids = Tag.find_tag_ids(tag_names)
 
@@ -111,7 +126,7 @@ class RepoFileTag(pyutil.dbtable.DBTable):
 
 class RepoPathTag(pyutil.dbtable.DBTable):
     table_name = 's3_repo.path_tags'
-    conn       = s3repo.common.db_conn()
+    conn       = s3repo.common.ThreadConn()
 
     key_fields = [
         'path_id',
@@ -125,6 +140,7 @@ class RepoPathTag(pyutil.dbtable.DBTable):
     ]
 
     @classmethod
+    @s3repo.stats.timed('tag.tag_path')
     def tag_path(cls, path_id, *tag_names):
         tag_ids = Tag.find_or_create_tag_ids(tag_names)
 
@@ -153,6 +169,7 @@ class RepoPathTag(pyutil.dbtable.DBTable):
             )
 
     @classmethod
+    @s3repo.stats.timed('tag.untag_path')
     def untag_path(cls, path_id, *tag_names):
         tag_ids = Tag.find_tag_ids(tag_names)
 
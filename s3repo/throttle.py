@@ -0,0 +1,176 @@
+"""
+Shared scheduler for S3 requests.  Every request made by S3Backend runs through
+scheduler().call(), which:
+
+- Limits concurrent requests per bucket and key prefix with an AIMD limit: it
+  grows by one request per window of successes, and halves when S3 answers
+  503 SlowDown, so each prefix runs at the highest concurrency S3 will allow.
+- Retries transient errors (throttling, 5xx, timeouts and dropped connections)
+  after a jittered exponential backoff.  boto's own retries are turned off (see
+  s3repo.common.connect_s3), so that every SlowDown reaches the limit.
+
+Requests resume rather than restart where they can: downloads continue from the
+last byte received, and multipart uploads retry only the failed part.
+
+    "s3.concurrency.initial"  : 8,
+    "s3.concurrency.max"      : 64,
+    "s3.throttle.prefix_depth": 1,
+    "s3.retry.attempts"       : 6,
+    "s3.retry.base_seconds"   : 0.1,
+    "s3.retry.max_seconds"    : 20
+"""
+import time, random, socket, httplib, logging, threading
+import s3repo.common
+import s3repo.stats
+import s3repo.transfers
+
+__all__ = [
+    'AdaptiveLimit',
+    'Scheduler',
+    'scheduler',
+    'reset',
+]
+
+logger = logging.getLogger('s3repo.throttle')
+
+THROTTLE_CODES  = frozenset([ 'SlowDown', 'Throttling', 'RequestLimitExceeded', 'ServiceUnavailable' ])
+TRANSIENT_CODES = frozenset([ 'RequestTimeout', 'InternalError', 'OperationAborted' ])
+
+def is_throttle(e):
+    return getattr(e, 'status', None) == 503 or getattr(e, 'error_code', None) in THROTTLE_CODES
+
+def is_transient(e):
+    """
+    Returns whether e might succeed on retry: throttling, server errors, and
+    network failures.
+    """
+    if is_throttle(e) or getattr(e, 'error_code', None) in TRANSIENT_CODES:
+        return True
+    if isinstance(getattr(e, 'status', None), int) and e.status >= 500:
+        return True
+    return isinstance(e, (socket.error, socket.timeout, httplib.HTTPException))
+
+
+class AdaptiveLimit(object):
+    """
+    Concurrency limit with additive increase and multiplicative decrease.
+    acquire() returns the current epoch, which each decrease advances, and
+    release() is given it back.  A request that started before the last
+    decrease was already in flight when it was made, so its throttling does not
+    halve the limit again: a burst of SlowDowns halves it once.
+    """
+    def __init__(self, initial = 8, maximum = 64, minimum = 1):
+        self.limit    = float(initial)
+        self.maximum  = maximum
+        self.minimum  = minimum
+        self.active   = 0
+        self.epoch    = 0
+        self.cond     = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+            return self.epoch
+
+    def release(self, epoch, throttled = False):
+        with self.cond:
+            self.active -= 1
+            if not throttled:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif epoch == self.epoch:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.epoch += 1
+            self.cond.notify_all()
+
+
+class Scheduler(object):
+    def __init__(self, initial = 8, maximum = 64, prefix_depth = 1, attempts = 6, base_seconds = 0.1, max_seconds = 20):
+        self.initial      = initial
+        self.maximum      = maximum
+        self.prefix_depth = prefix_depth
+        self.attempts     = attempts
+        self.base_seconds = base_seconds
+        self.max_seconds  = max_seconds
+        self.limits       = {}
+        self.lock         = threading.Lock()
+
+    def limit_for(self, bucket, key):
+        """
+        Returns the AdaptiveLimit for the first prefix_depth segments of key in bucket.
+        """
+        prefix = '/'.join(key.lstrip('/').split('/')[:self.prefix_depth]) if self.prefix_depth else ''
+        with self.lock:
+            if (bucket, prefix) not in self.limits:
+                self.limits[(bucket, prefix)] = AdaptiveLimit(self.initial, self.maximum)
+            return self.limits[(bucket, prefix)]
+
+    def backoff(self, attempt):
+        """
+        Seconds to wait before retry number attempt, with full jitter.
+        """
+        return random.uniform(0, min(self.max_seconds, self.base_seconds * 2 ** attempt))
+
+    def call(self, bucket, key, name, func, transfer = False):
+        """
+        Runs func() as the request name (timed as a stat) on key, within the
+        limit of its prefix, retrying transient failures.  func is called again
+        on each retry, so it should resume from wherever the previous attempt
+        stopped.
+
+        A transfer (a request which moves data) also takes a slot in the
+        s3repo.transfers scheduler for each attempt, so that no slot is held
+        while backing off.
+        """
+        limit = self.limit_for(bucket, key)
+        for attempt in range(self.attempts):
+            try:
+                if transfer:
+                    result = s3repo.transfers.run(lambda: self.attempt(limit, name, func))
+                else:
+                    result = self.attempt(limit, name, func)
+            except Exception as e:
+                if not is_transient(e) or attempt + 1 == self.attempts:
+                    raise
+
+                s3repo.stats.incr('s3.throttled' if is_throttle(e) else 's3.retries')
+                logger.warning("%s of s3://%s/%s failed (%s), retrying", name, bucket, key, e)
+                time.sleep(self.backoff(attempt))
+            else:
+                return result
+
+    def attempt(self, limit, name, func):
+        epoch = limit.acquire()
+        try:
+            with s3repo.stats.timer(name):
+                result = func()
+        except Exception as e:
+            limit.release(epoch, throttled = is_throttle(e))
+            raise
+
+        limit.release(epoch)
+        return result
+
+_scheduler = (None, None)
+def scheduler():
+    """
+    Returns the process wide Scheduler, which is rebuilt when the configuration changes.
+    """
+    global _scheduler
+    app_cfg = s3repo.common.load_cfg()
+    if _scheduler[0] is not app_cfg:
+        _scheduler = (app_cfg, Scheduler(
+            initial      = app_cfg.get('s3.concurrency.initial', 8),
+            maximum      = app_cfg.get('s3.concurrency.max', 64),
+            prefix_depth = app_cfg.get('s3.throttle.prefix_depth', 1),
+            attempts     = app_cfg.get('s3.retry.attempts', 6),
+            base_seconds = app_cfg.get('s3.retry.base_seconds', 0.1),
+            max_seconds  = app_cfg.get('s3.retry.max_seconds', 20),
+        ))
+
+    return _scheduler[1]
+
+def reset():
+    global _scheduler
+    _scheduler = (None, None)
@@ -0,0 +1,191 @@
+"""
+Per process scheduling of data transfers.  Every S3 upload and download the
+library makes waits for one of "transfers.max_active" slots.  Waiting transfers
+are served by priority class, and round robin between the flows of a class, so
+that no one bulk job can hold up the others:
+
+- foreground: reads by RepoFile.open, which jump ahead of everything else
+- normal:     everything not marked otherwise, such as publish() uploads
+- background: prefetches, cache scrubbing and backups
+
+Slots are taken for each attempt of a request, and given back while it backs
+off before a retry.  "transfers.reserved_foreground" of the slots are kept for
+foreground reads, so that they never wait behind a full set of bulk transfers.
+Each class can also be capped in bytes per second, charged as data moves:
+
+    "transfers.max_active"          : 16,
+    "transfers.reserved_foreground" : 2,
+    "transfers.bytes_per_second"    : { "background" : 50000000 }
+
+Code marks its transfers with the priority() context manager.  The flow of a
+transfer defaults to the name of its thread, so each cache root's workers form
+a flow of their own.
+"""
+import time, contextlib, threading, collections
+import s3repo.common
+import s3repo.stats
+
+__all__ = [
+    'classes',
+    'priority',
+    'current',
+    'RateLimiter',
+    'TransferScheduler',
+    'scheduler',
+    'run',
+    'charge',
+    'progress',
+]
+
+# In priority order
+classes = [ 'foreground', 'normal', 'background' ]
+
+_context = threading.local()
+
+@contextlib.contextmanager
+def priority(name, flow = None):
+    """
+    Runs the transfers made within the block, on this thread, as priority class
+    name, in flow (by default, the thread's name).
+    """
+    if name not in classes:
+        raise ValueError("unknown priority class: {}".format(name))
+
+    previous = getattr(_context, 'current', None)
+    _context.current = (name, flow)
+    try:
+        yield
+    finally:
+        _context.current = previous
+
+def current():
+    """
+    Returns the (priority class, flow) of transfers made on this thread.
+    """
+    name, flow = getattr(_context, 'current', None) or ('normal', None)
+    return name, flow or threading.current_thread().name
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared between threads.  consume(n) blocks until n more bytes
+    fit within bytes_per_second.  A rate of None is unlimited.
+    """
+    def __init__(self, bytes_per_second = None, burst_seconds = 1.0):
+        self.bytes_per_second = bytes_per_second
+        self.capacity         = (bytes_per_second or 0) * burst_seconds
+        self.tokens           = self.capacity
+        self.updated          = time.time()
+        self.lock             = threading.Lock()
+
+    def consume(self, num_bytes):
+        if not self.bytes_per_second:
+            return
+
+        with self.lock:
+            current = time.time()
+            self.tokens = min(self.capacity, self.tokens + (current - self.updated) * self.bytes_per_second)
+            self.updated = current
+            self.tokens -= num_bytes
+            wait = -self.tokens / self.bytes_per_second if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TransferScheduler(object):
+    """
+    Hands out max_active slots.  All but reserved_foreground of them are shared
+    by every class; at least one always is.
+    """
+    def __init__(self, max_active = 16, reserved_foreground = 2, bytes_per_second = None):
+        self.max_active = max_active
+        self.shared     = max(1, max_active - reserved_foreground)
+        self.active     = 0
+        self.cond       = threading.Condition()
+        self.waiting    = dict((x, collections.OrderedDict()) for x in classes)
+        self.limiters   = dict((x, RateLimiter((bytes_per_second or {}).get(x))) for x in classes)
+
+    def next_ticket(self):
+        for name in classes:
+            for queue in self.waiting[name].values():
+                return queue[0]
+        return None
+
+    def acquire(self, name, flow):
+        ticket = object()
+        with self.cond:
+            flows = self.waiting[name]
+            flows.setdefault(flow, collections.deque()).append(ticket)
+            available = self.max_active if name == 'foreground' else self.shared
+            while self.active >= available or self.next_ticket() is not ticket:
+                self.cond.wait()
+
+            # Served flows go to the back of their class
+            queue = flows.pop(flow)
+            queue.popleft()
+            if queue:
+                flows[flow] = queue
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def run(self, func):
+        """
+        Runs func() once a slot is free for this thread's priority class and flow.
+        """
+        name, flow = current()
+        with s3repo.stats.timer('transfers.wait.' + name):
+            self.acquire(name, flow)
+        try:
+            return func()
+        finally:
+            self.release()
+
+    def charge(self, num_bytes):
+        """
+        Counts num_bytes transferred against this thread's priority class,
+        waiting if that exceeds the class's bandwidth cap.
+        """
+        self.limiters[current()[0]].consume(num_bytes)
+
+    def progress(self):
+        """
+        Returns a boto progress callback, cb(bytes_so_far, total), which charges
+        each chunk as it is sent or received.  Use a new one for every attempt.
+        """
+        charged = [ 0 ]
+        def cb(bytes_so_far, total):
+            if bytes_so_far > charged[0]:
+                self.charge(bytes_so_far - charged[0])
+                charged[0] = bytes_so_far
+        return cb
+
+
+_scheduler = (None, None)
+def scheduler():
+    """
+    Returns the process wide TransferScheduler, which is rebuilt when the configuration changes.
+    """
+    global _scheduler
+    app_cfg = s3repo.common.load_cfg()
+    if _scheduler[0] is not app_cfg:
+        _scheduler = (app_cfg, TransferScheduler(
+            max_active          = app_cfg.get('transfers.max_active', 16),
+            reserved_foreground = app_cfg.get('transfers.reserved_foreground', 2),
+            bytes_per_second    = app_cfg.get('transfers.bytes_per_second'),
+        ))
+
+    return _scheduler[1]
+
+def run(func):
+    return scheduler().run(func)
+
+def charge(num_bytes):
+    scheduler().charge(num_bytes)
+
+def progress():
+    return scheduler().progress()
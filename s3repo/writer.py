@@ -0,0 +1,178 @@
+"""
+Streaming writes of new repo files.  RepoFile.writer() returns a RepoFileWriter,
+which hashes data as it is written and uploads it in parts from a background
+thread, so the upload overlaps with writing rather than following it:
+
+    rf = S3Repo.add_file('/data/events.log')
+    with rf.writer() as fp:
+        for chunk in produce():
+            fp.write(chunk)
+    rf.publish()   # already uploaded
+
+The data is also written to the local cache unless cache = False.  While
+offline, it is only written to the local cache, and publish() uploads it as usual.
+"""
+import os, Queue, base64, hashlib, logging, threading
+import s3repo.common
+import s3repo.disks
+import s3repo.host
+import s3repo.transfers
+import s3repo.exceptions
+from pyutil.dateutil import now
+from pyutil.util import mkdirp, is_online
+
+__all__ = [
+    'RepoFileWriter',
+]
+
+logger = logging.getLogger('s3repo.writer')
+
+class RepoFileWriter(object):
+    """
+    Write only stream of a repo file's contents.  Every part_size bytes are
+    queued for upload, with at most max_pending parts buffered at once.  close()
+    sends the rest, finishes the upload, and records the file's md5, size and
+    upload time.  Leaving a with block on an exception aborts the upload.
+    part_size may not be below the storage backend's minimum.
+    """
+    def __init__(self, rf, cache = True, part_size = 16 * 1024 * 1024, max_pending = 2):
+        if rf.date_uploaded:
+            raise s3repo.exceptions.RepoFileAlreadyExistsError(rf.s3_path())
+
+        self.rf          = rf
+        self.part_size   = part_size
+        self.md5         = hashlib.md5()
+        self.size        = 0
+        self.buf         = []
+        self.buf_size    = 0
+        self.error       = None
+        self.closed      = False
+        self.thread      = None
+        self.parts       = Queue.Queue(max_pending)
+        self.priority    = s3repo.transfers.current()
+
+        self.upload = None
+        if is_online():
+            storage = rf.storage()
+            if part_size < storage.min_part_size:
+                raise ValueError("part_size must be at least {} bytes".format(storage.min_part_size))
+            self.upload = storage.start_upload(rf.s3_bucket(), rf.s3_key)
+        elif not cache:
+            raise s3repo.exceptions.RepoUploadError("offline, and not writing to the local cache")
+
+        self.local = None
+        if cache:
+            self.filename = rf.cache_path()
+            mkdirp(os.path.dirname(self.filename))
+            self.local = open(s3repo.disks.partial_path(self.filename), 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed RepoFileWriter")
+        if self.error is not None:
+            raise self.error
+
+        self.md5.update(data)
+        self.size += len(data)
+        if self.local is not None:
+            self.local.write(data)
+
+        if self.upload is not None:
+            self.buf.append(data)
+            self.buf_size += len(data)
+            if self.buf_size >= self.part_size:
+                data = b''.join(self.buf)
+                end = len(data) - len(data) % self.part_size
+                for start in range(0, end, self.part_size):
+                    self.send(data[start:start + self.part_size])
+                self.buf = [ data[end:] ]
+                self.buf_size = len(data) - end
+
+    def send(self, part):
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.upload_parts, name = 's3repo-writer')
+            self.thread.daemon = True
+            self.thread.start()
+        self.parts.put(part)
+
+    def upload_parts(self):
+        with s3repo.common.pooled_conns(), s3repo.transfers.priority(*self.priority):
+            while True:
+                part = self.parts.get()
+                if part is None:
+                    return
+                if self.error is not None:
+                    continue # Drain, so that write() does not block
+
+                try:
+                    self.upload.put_part(part)
+                except Exception as e:
+                    logger.exception("upload of %s failed", self.rf.s3_path())
+                    self.error = e
+
+    def finish_parts(self):
+        if self.thread is not None:
+            self.parts.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            self.finish_parts()
+            if self.error is not None:
+                raise self.error
+            if self.upload is not None:
+                self.upload.complete(b''.join(self.buf))
+            if self.local is not None:
+                self.local.close()
+                os.rename(s3repo.disks.partial_path(self.filename), self.filename)
+        except Exception:
+            self.discard()
+            raise
+
+        rf = self.rf
+        rf.md5, rf.b64, rf.file_size = self.md5.hexdigest(), base64.b64encode(self.md5.digest()), self.size
+        if self.upload is not None:
+            rf.date_uploaded = now()
+        rf.update()
+
+        if self.local is not None:
+            s3repo.host.RepoFileDownload.update_access_time(rf)
+        else:
+            # Inserting the file flagged it as downloaded here, but there is no local copy
+            s3repo.host.RepoFileDownload.remove_download(rf)
+
+    def abort(self):
+        """
+        Abandons the upload and the local copy.
+        """
+        if not self.closed:
+            self.closed = True
+            self.finish_parts()
+            self.discard()
+
+    def discard(self):
+        if self.upload is not None:
+            try:
+                self.upload.abort()
+            except Exception:
+                logger.exception("unable to abort upload of %s", self.rf.s3_path())
+
+        if self.local is not None:
+            self.local.close()
+            partial = s3repo.disks.partial_path(self.filename)
+            if os.path.exists(partial):
+                os.unlink(partial)
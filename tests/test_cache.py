@@ -0,0 +1,39 @@
+import unittest
+import s3repo.cache
+
+class RowCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.cache = s3repo.cache.RowCache('test_rows', self.load, max_size = 2)
+
+    def tearDown(self):
+        s3repo.cache.RowCache.registry.pop('test_rows', None)
+
+    def load(self, row_id):
+        self.loaded.append(row_id)
+        return 'row {}'.format(row_id)
+
+    def test_least_recently_used_rows_are_dropped(self):
+        self.assertEqual(self.cache.get(1), 'row 1')
+        self.cache.get(2)
+        self.cache.get(1)
+        self.cache.get(3)
+
+        self.assertEqual(list(self.cache.values), [ 1, 3 ])
+        self.cache.get(1)
+        self.cache.get(2)
+        self.assertEqual(self.loaded, [ 1, 2, 3, 2 ])
+
+    def test_rows_evicted_while_loading_are_not_cached(self):
+        def load(row_id):
+            self.cache.evict(row_id)
+            return 'stale'
+        self.cache.loader = load
+
+        self.assertEqual(self.cache.get(1), 'stale')
+        self.assertEqual(list(self.cache.values), [])
+
+        generation = self.cache.generation
+        self.cache.evict(2)
+        self.cache.prime(2, 'stale', generation)
+        self.assertEqual(list(self.cache.values), [])
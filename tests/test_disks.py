@@ -0,0 +1,44 @@
+import unittest
+import s3repo.common
+import s3repo.disks
+import s3repo.exceptions
+
+class DisksTest(unittest.TestCase):
+    def setUp(self):
+        self.app_cfg = {}
+        self.load_cfg = s3repo.common.load_cfg
+        s3repo.common.load_cfg = lambda: self.app_cfg
+
+    def tearDown(self):
+        s3repo.common.load_cfg = self.load_cfg
+
+    def configure(self, *roots):
+        self.app_cfg = { 'cache.roots' : [ { 'path' : path, 'max_size' : max_size } for path, max_size in roots ] }
+
+    def test_cache_path_without_roots(self):
+        self.assertEqual(s3repo.disks.root_for('/data/a'), None)
+        self.assertEqual(s3repo.disks.cache_path('/data/a'), '/data/a')
+
+    def test_cache_path_under_root(self):
+        self.configure(('/mnt/a', 100))
+        self.assertEqual(s3repo.disks.cache_path('/data/a'), '/mnt/a/data/a')
+
+    def test_adding_a_root_only_moves_files_to_it(self):
+        paths = [ '/data/{}'.format(i) for i in range(3000) ]
+
+        self.configure(('/mnt/a', 100), ('/mnt/b', 100))
+        before = dict((x, s3repo.disks.root_for(x).path) for x in paths)
+
+        self.configure(('/mnt/a', 100), ('/mnt/b', 100), ('/mnt/c', 200))
+        after = dict((x, s3repo.disks.root_for(x).path) for x in paths)
+
+        moved = [ x for x in paths if before[x] != after[x] ]
+        self.assertTrue(all(after[x] == '/mnt/c' for x in moved))
+
+        # The new root has half of the capacity, and takes about half of the files
+        self.assertTrue(0.4 < len(moved) / float(len(paths)) < 0.6)
+
+    def test_task_wait_times_out(self):
+        task = s3repo.disks.Task(lambda: 1)
+        with self.assertRaises(s3repo.exceptions.RepoTaskTimeoutError):
+            task.wait(0.01)
@@ -0,0 +1,46 @@
+import unittest, struct
+import s3repo.export
+
+def field(data):
+    if data is None:
+        return struct.pack('>i', -1)
+    return struct.pack('>i', len(data)) + data
+
+class CopyDecoderTest(unittest.TestCase):
+    columns = [
+        ('file_id',      'int4'),
+        ('s3_key',       'text'),
+        ('published',    'bool'),
+        ('date_created', 'timestamp'),
+    ]
+
+    def copy_stream(self, rows):
+        stream = s3repo.export.COPY_SIGNATURE + struct.pack('>ii', 0, 0)
+        for row in rows:
+            stream += struct.pack('>h', len(row)) + b''.join(field(x) for x in row)
+        return stream + struct.pack('>h', -1)
+
+    def test_decodes_in_batches_across_chunk_boundaries(self):
+        stream = self.copy_stream([
+            [ struct.pack('>i', 1), b'a/b', b'\x01', struct.pack('>q', 0) ],
+            [ struct.pack('>i', 2), None,   b'\x00', struct.pack('>q', 1000000) ],
+            [ struct.pack('>i', 3), b'c',   b'\x01', None ],
+        ])
+
+        batches = []
+        decoder = s3repo.export.CopyDecoder(self.columns, batches.append, batch_rows = 2)
+        for i in range(0, len(stream), 3):
+            decoder.write(stream[i:i + 3])
+        decoder.close()
+
+        epoch = s3repo.export.PG_EPOCH_MICROS
+        self.assertEqual(decoder.rows, 3)
+        self.assertEqual(batches, [
+            [ [ 1, 2 ], [ u'a/b', None ], [ True, False ], [ epoch, epoch + 1000000 ] ],
+            [ [ 3 ], [ u'c' ], [ True ], [ None ] ],
+        ])
+
+    def test_rejects_text_copy(self):
+        decoder = s3repo.export.CopyDecoder(self.columns, None)
+        with self.assertRaises(ValueError):
+            decoder.write(b'1\ta/b\tt\t2014-01-01 00:00:00\n')
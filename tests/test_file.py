@@ -64,6 +64,26 @@ class FileTest(DBTestCase):
             [ filename,      'f2',       True,         from_epoch(124),   ],
         )
 
+    def test_get_files(self):
+        filename1 = self.random_filename()
+        filename2 = self.random_filename()
+        filename3 = self.random_filename()
+
+        set_now(123)
+        S3Repo.add_file(filename1, s3_key = 'f1').publish()
+        S3Repo.add_file(filename3, s3_key = 'f3')
+
+        set_now(124)
+        rf2 = S3Repo.add_file(filename1, s3_key = 'f2')
+        rf2.publish()
+        S3Repo.commit()
+
+        files = S3Repo.get_files([ filename1, filename2, filename3 ])
+        self.assertEqual(sorted(files), sorted([ filename1, filename2, filename3 ]))
+        self.assertEqual(files[filename1].file_id, rf2.file_id)
+        self.assertEqual(files[filename1].local_path(), filename1)
+        self.assertEqual(files[filename2], None)
+        self.assertEqual(files[filename3], None)
 
     def test_publish_file_flags_repo_record(self):
         rf1 = S3Repo.add_file(self.random_filename(), s3_key = '1')
@@ -103,6 +123,29 @@ class FileTest(DBTestCase):
             [ '2',       True,         now(),             hashlib.md5(f2_contents).hexdigest(),  len(f2_contents),  ],
         )
 
+    def test_writer_uploads_as_it_writes(self):
+        rf = S3Repo.add_file(self.random_filename(), s3_key = 'streamed')
+        with rf.writer() as fp:
+            fp.write("yakkety yak, ")
+            fp.write("don't talk back")
+        rf.publish()
+        S3Repo.commit()
+
+        contents = "yakkety yak, don't talk back"
+        with open(rf.local_path()) as fp:
+            self.assertEqual(fp.read(), contents)
+
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM s3_repo.files
+        """,
+            [ 's3_key',    'published',  'md5',                              'file_size',    ],
+            [ 'streamed',  True,         hashlib.md5(contents).hexdigest(),  len(contents),  ],
+        )
+
+        with self.assertRaises(RepoFileAlreadyExistsError):
+            rf.writer()
+
     def test_expire_flags_record(self):
         rf1 = S3Repo.add_file(self.random_filename(), s3_key = 'unpublished')
         rf2 = S3Repo.add_file(self.random_filename(), s3_key = 'published')
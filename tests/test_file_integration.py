@@ -1,5 +1,7 @@
-import tempfile, zlib, base64, hashlib
+import tempfile, shutil, zlib, base64, hashlib
 import pyutil.pghelper
+import s3repo.storage
+import s3repo.writer
 from s3repo.exceptions import *
 from s3repo import *
 from pyutil.testutil import *
@@ -42,3 +44,44 @@ class FileIntegrationTest(DBTestCase):
 
         bucket = self.s3_conn.get_bucket(self.config['s3.default_bucket'])
         self.assertEqual(self.s3_list_bucket(rf1.s3_bucket()), [])
+
+    def test_writer_streams_parts(self):
+        root = tempfile.mkdtemp()
+        s3repo.storage._backends[self.config['s3.default_bucket']] = s3repo.storage.FileSystemBackend(root)
+        try:
+            rf = S3Repo.add_file(self.random_filename(), s3_key = 'streamed')
+            with s3repo.writer.RepoFileWriter(rf, part_size = 4) as fp:
+                for chunk in [ 'ab', 'cdefghij', 'k', 'lmn' ]:
+                    fp.write(chunk)
+                upload = fp.upload
+
+            # Three full parts sent while writing, and the rest on close
+            self.assertEqual(upload.parts, 4)
+            with open(rf.storage().path(rf.s3_bucket(), rf.s3_key)) as fp:
+                self.assertEqual(fp.read(), 'abcdefghijklmn')
+            with open(rf.cache_path()) as fp:
+                self.assertEqual(fp.read(), 'abcdefghijklmn')
+            self.assertEqual(rf.md5, hashlib.md5('abcdefghijklmn').hexdigest())
+            self.assertTrue(rf.date_uploaded)
+        finally:
+            s3repo.storage.reset()
+            shutil.rmtree(root)
+
+    def test_writer_without_cache_leaves_no_download(self):
+        rf = S3Repo.add_file(self.random_filename(), s3_key = 'uncached')
+        with rf.writer(cache = False) as fp:
+            fp.write('not kept locally')
+        S3Repo.commit()
+
+        self.assertSqlResults(self.conn(), """
+            SELECT count(*) AS num_downloads
+            FROM s3_repo.downloads
+        """,
+            [ 'num_downloads', ],
+            [ 0,               ],
+        )
+
+    def test_writer_rejects_small_s3_parts(self):
+        rf = S3Repo.add_file(self.random_filename(), s3_key = 'small_parts')
+        with self.assertRaises(ValueError):
+            s3repo.writer.RepoFileWriter(rf, part_size = 1024)
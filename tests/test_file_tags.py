@@ -1,3 +1,5 @@
+import s3repo.cache
+import s3repo.stats
 from s3repo import S3Repo
 from s3repo.exceptions import *
 from pyutil.testutil import *
@@ -163,6 +165,63 @@ class FileTagsTest(DBTestCase):
         tagged_files = S3Repo.find_tagged(any = [ 'restored', 'archived' ], all = [ 'imported' ])
         self.assertEqual({ x.file_id for x in tagged_files }, { rfs[0].file_id })
 
+    def test_find_tagged__cache_is_invalidated_by_tagging(self):
+        rfs = self.setup_default_tag_files()
+
+        tagged_files = S3Repo.find_tagged(all = [ 'archived' ])
+        self.assertEqual({ x.file_id for x in tagged_files }, { rfs[0].file_id })
+
+        version = S3Repo.repo_version()
+        self.assertEqual(S3Repo.find_tagged(all = [ 'archived' ]), tagged_files)
+        self.assertEqual(S3Repo.repo_version(), version)
+
+        rfs[3].tag_file('archived')
+        S3Repo.commit()
+
+        self.assertGreater(S3Repo.repo_version(), version)
+        tagged_files = S3Repo.find_tagged(all = [ 'archived' ])
+        self.assertEqual({ x.file_id for x in tagged_files }, { rfs[0].file_id, rfs[3].file_id })
+
+    def test_find_tagged__uncommitted_results_are_not_cached(self):
+        rfs = self.setup_default_tag_files()
+
+        rfs[3].tag_file('archived')
+        tagged_files = S3Repo.find_tagged(all = [ 'archived' ])
+        self.assertEqual({ x.file_id for x in tagged_files }, { rfs[0].file_id, rfs[3].file_id })
+        S3Repo.rollback()
+
+        tagged_files = S3Repo.find_tagged(all = [ 'archived' ])
+        self.assertEqual({ x.file_id for x in tagged_files }, { rfs[0].file_id })
+
+    def test_find_tagged__preloads_names(self):
+        rfs = self.setup_default_tag_files()
+        local_paths = { x.local_path() for x in rfs[:2] }
+        s3repo.cache.clear_all()
+
+        tagged_files = S3Repo.find_tagged(any = [ 'imported' ], cache = False)
+        s3repo.stats.enable()
+        s3repo.stats.reset()
+        try:
+            self.assertEqual({ x.local_path() for x in tagged_files }, local_paths)
+            self.assertEqual({ x.s3_bucket() for x in tagged_files }, { self.config['s3.default_bucket'] })
+            self.assertEqual(s3repo.stats.snapshot()['timers'], {})
+        finally:
+            s3repo.stats.disable()
+
+    def test_find_tagged__columns(self):
+        rfs = self.setup_default_tag_files()
+
+        records = S3Repo.find_tagged(all = [ 'imported' ], columns = [ 'local_path', 'file_size' ])
+        self.assertEqual(
+            sorted((x.file_id, x.local_path) for x in records),
+            sorted((x.file_id, x.local_path()) for x in rfs[:2]),
+        )
+        self.assertEqual(records[0].repo_file().file_id, records[0].file_id)
+
+        batch = S3Repo.find_tagged(all = [ 'imported' ], columns = [ 'file_size' ], as_arrays = True)
+        self.assertEqual(sorted(batch['file_id']), sorted(x.file_id for x in rfs[:2]))
+        self.assertEqual(sorted(x.file_id for x in batch.repo_files()), sorted(batch['file_id']))
+
     def test_find_tagged__exclude(self):
         with self.assertRaises(RepoAPIError):
             S3Repo.find_tagged(exclude = [ 'imported' ])
@@ -0,0 +1,60 @@
+import os, unittest, datetime
+import s3repo.keys
+
+class CustomLayout(s3repo.keys.KeyLayout):
+    def key(self, local_path, version, when):
+        return 'custom' + os.path.join(local_path, version)
+
+    def prefix(self, local_path):
+        return 'custom' + os.path.join(local_path, '')
+
+    def owns(self, key, local_path):
+        return key.rpartition('/')[0] == 'custom' + local_path
+
+def custom_key(local_path, version, when):
+    return 'custom/' + version
+
+class KeysTest(unittest.TestCase):
+    when = datetime.datetime(2014, 1, 2, 3, 4, 5)
+
+    def test_layouts(self):
+        flat = s3repo.keys.load_layout('flat')
+        self.assertEqual(flat.key('/data/a.gz', '123', self.when), '/data/a.gz/123')
+        self.assertEqual(flat.prefix('/data/a.gz'), '/data/a.gz/')
+
+        hashed = s3repo.keys.load_layout({ 'type' : 'hash_prefix', 'chars' : 2 })
+        key = hashed.key('/data/a.gz', '123', self.when)
+        self.assertEqual(len(key.split('/')[0]), 2)
+        self.assertTrue(key.startswith(hashed.prefix('/data/a.gz')))
+        self.assertTrue(key.endswith('/data/a.gz/123'))
+
+        dated = s3repo.keys.load_layout('date_first')
+        self.assertEqual(dated.key('/data/a.gz', '123', self.when), '2014/01/02/03/data/a.gz/123')
+        self.assertEqual(dated.prefix('/data/a.gz'), '')
+
+    def test_owns(self):
+        for name in [ 'flat', 'hash_prefix', 'date_first' ]:
+            layout = s3repo.keys.load_layout(name)
+            key = layout.key('/data/a.gz', '123', self.when)
+            self.assertTrue(layout.owns(key, '/data/a.gz'))
+            self.assertFalse(layout.owns(key, '/data/b.gz'))
+            self.assertFalse(layout.owns(key, '/data'))
+            self.assertFalse(layout.owns(key, '/a.gz'))
+            self.assertFalse(layout.owns('mnt/' + key, '/data/a.gz'))
+
+        dated = s3repo.keys.load_layout('date_first')
+        self.assertFalse(dated.owns('2014/01/02/03/mnt/data/a.gz/123', '/data/a.gz'))
+
+    def test_custom_layout(self):
+        layout = s3repo.keys.load_layout('test_keys.CustomLayout')
+        self.assertEqual(layout.key('/data/a.gz', '123', self.when), 'custom/data/a.gz/123')
+        self.assertTrue(layout.owns('custom/data/a.gz/123', '/data/a.gz'))
+
+        with self.assertRaises(ValueError):
+            s3repo.keys.load_layout('test_keys.custom_key')
+
+    def test_versions_are_unique_and_ordered(self):
+        versions = [ s3repo.keys.version(7, 'f47ac10b-58cc-4372-a567-0e02b2c3d479') for i in range(1000) ]
+        self.assertEqual(len(set(versions)), 1000)
+        self.assertEqual(sorted(versions), versions)
+        self.assertTrue(versions[0].endswith('-7-f47ac10b'))
@@ -0,0 +1,66 @@
+import time, threading
+import s3repo.file
+import s3repo.common
+import s3repo.notify
+from s3repo import S3Repo
+from pyutil.pghelper import *
+from testcase import DBTestCase
+
+class NotifyTest(DBTestCase):
+    def setUp(self):
+        super(NotifyTest, self).setUp()
+        self.listener = s3repo.notify.Listener()
+        self.listener.add_handler(s3repo.notify.CHANGES_CHANNEL, s3repo.notify.handle_change)
+        self.listener.connect()
+
+    def tearDown(self):
+        self.listener.close()
+        super(NotifyTest, self).tearDown()
+
+    def test_path_change_evicts_only_that_path(self):
+        rf1 = S3Repo.add_file(self.random_filename(), s3_key = 'abc')
+        rf2 = S3Repo.add_file(self.random_filename(), s3_key = 'def')
+        S3Repo.commit()
+        old_path = rf1.local_path()
+        rf2.local_path()
+
+        execute(self.conn(), """
+            UPDATE s3_repo.paths
+            SET local_path = '/some/other/path'
+            WHERE path_id = %(path_id)s
+        """, path_id = rf1.path_id)
+
+        self.assertEqual(rf1.local_path(), old_path)
+        self.assertEqual(self.listener.poll(5), 1)
+
+        self.assertNotIn(rf1.path_id, s3repo.file.LocalPath.local_paths.values)
+        self.assertIn(rf2.path_id, s3repo.file.LocalPath.local_paths.values)
+        self.assertEqual(rf1.local_path(), '/some/other/path')
+
+    def test_wait_for_times_out(self):
+        self.assertIsNone(S3Repo.wait_for(path = self.random_filename(), timeout = 0.1))
+
+    def test_wait_for_returns_current_file(self):
+        rf1 = S3Repo.add_file(self.random_filename(), s3_key = 'abc')
+        rf1.publish()
+        S3Repo.commit()
+
+        self.assertEqual(S3Repo.wait_for(path = rf1.local_path(), timeout = 0.1).file_id, rf1.file_id)
+
+    def test_subscribe_wakes_on_publish(self):
+        filename = self.random_filename()
+
+        def publish():
+            time.sleep(0.5)
+            with s3repo.common.pooled_conns():
+                rf = S3Repo.add_file(filename, s3_key = 'abc')
+                rf.publish()
+                rf.tag_file('imported')
+                S3Repo.commit()
+
+        thread = threading.Thread(target = publish)
+        thread.start()
+        published = list(S3Repo.subscribe(tags = [ 'imported' ], timeout = 5))
+        thread.join()
+
+        self.assertEqual([ x.local_path() for x in published ], [ filename ])
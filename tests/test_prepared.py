@@ -0,0 +1,35 @@
+import unittest
+import s3repo.prepared
+
+class FakeCursor(object):
+    def __init__(self, executed):
+        self.executed = executed
+
+    def execute(self, query, vars = None):
+        self.executed.append(query)
+
+class FakeConnection(object):
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self.executed)
+
+class PreparedTest(unittest.TestCase):
+    def test_statement_is_prepared_once_per_connection(self):
+        statement = s3repo.prepared.Statement('touch', """UPDATE t SET a = %(now)s WHERE b = %(id)s OR c = %(now)s""", [
+            ('now', 'TIMESTAMP'),
+            ('id',  'INTEGER'),
+        ])
+
+        conn1, conn2 = FakeConnection(), FakeConnection()
+        for conn in [ conn1, conn1, conn2 ]:
+            self.assertEqual(statement.sql(conn), 'EXECUTE s3repo_touch(%(now)s, %(id)s)')
+
+        self.assertEqual(conn1.executed, [ 'PREPARE s3repo_touch(TIMESTAMP, INTEGER) AS UPDATE t SET a = $1 WHERE b = $2 OR c = $1' ])
+        self.assertEqual(conn2.executed, conn1.executed)
+
+    def test_statement_without_params(self):
+        statement = s3repo.prepared.Statement('version', "SELECT version FROM v")
+        self.assertEqual(statement.prepare_sql, 'PREPARE s3repo_version AS SELECT version FROM v')
+        self.assertEqual(statement.execute_sql, 'EXECUTE s3repo_version')
@@ -0,0 +1,40 @@
+import unittest, array
+import s3repo.records
+from s3repo.exceptions import RepoAPIError
+
+class FakeFile(object):
+    table_name = 's3_repo.files'
+    fields = [ 'file_id', 'path_id', 'file_size', 's3_key' ]
+
+    @classmethod
+    def find_by_id(cls, file_id):
+        return ('file', file_id)
+
+class RecordsTest(unittest.TestCase):
+    def test_columns_are_checked_and_file_id_comes_first(self):
+        self.assertEqual(s3repo.records.normalize_columns(FakeFile, [ 'file_size', 'file_id', 'local_path' ]), [ 'file_id', 'file_size', 'local_path' ])
+        self.assertEqual(s3repo.records.select_list([ 'file_id', 'local_path' ]), 'rf.file_id, p.local_path AS local_path')
+
+        with self.assertRaises(RepoAPIError):
+            s3repo.records.normalize_columns(FakeFile, [ 'password' ])
+
+    def test_records_are_slotted(self):
+        record_cls = s3repo.records.record_type([ 'file_id', 'file_size' ], FakeFile)
+        record = record_cls(1, 100)
+
+        self.assertEqual((record.file_id, record.file_size), (1, 100))
+        self.assertEqual(type(record).__slots__, ())
+        with self.assertRaises(AttributeError):
+            record.extra = 1
+        self.assertEqual(record.repo_file(), ('file', 1))
+
+    def test_file_columns(self):
+        batch = s3repo.records.FileColumns([ 'file_id', 'path_id', 'file_size', 's3_key' ], FakeFile)
+        batch.append((1, 10, 100, 'a'))
+        batch.append((2, 20, None, 'b'))
+
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch['path_id'], array.array('l', [ 10, 20 ]))
+        self.assertEqual(batch['file_size'], [ 100, None ])
+        self.assertEqual(batch['s3_key'], [ 'a', 'b' ])
+        self.assertEqual([ (x.file_id, x.s3_key) for x in batch ], [ (1, 'a'), (2, 'b') ])
@@ -1,8 +1,9 @@
-import unittest, psycopg2, json, os
+import unittest, psycopg2, json, os, threading
 import s3repo.host
 import s3repo.common
 from testcase import DBTestCase
 from s3repo import S3Repo
+from s3repo.exceptions import *
 from pyutil.pghelper import *
 from pyutil.testutil import *
 from pyutil.dateutil import *
@@ -95,3 +96,178 @@ class RepoTest(DBTestCase):
             [ rf2.file_id,  rf2.date_created,  None,          ],
             [ rf3.file_id,  rf3.date_created,  current_host,  ],
         )
+
+    def test_maintain_database_expires_superseded_files(self):
+        filename = self.random_filename()
+
+        set_now(123)
+        rf1 = S3Repo.add_file(filename, s3_key = 'f1')
+        rf1.publish()
+
+        set_now(124)
+        rf2 = S3Repo.add_file(filename, s3_key = 'f2')
+        rf2.publish()
+        S3Repo.commit()
+
+        progress = []
+        stats = S3Repo.maintain_database(batch_size = 1, progress = progress.append)
+
+        self.assertEqual(stats['expired'], 1)
+        self.assertEqual(progress[0]['expired'], 1)
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM s3_repo.files
+            ORDER BY s3_key
+        """,
+            [ 's3_key',  'published',  'date_expired',  ],
+            [ 'f1',      False,        now(),           ],
+            [ 'f2',      True,         None,            ],
+        )
+
+    def test_archive_files_moves_expired_history(self):
+        filename = self.random_filename()
+
+        set_now(123)
+        rf1 = S3Repo.add_file(filename, s3_key = 'f1')
+        rf1.publish()
+        rf1.tag_file('imported')
+
+        set_now(124)
+        rf2 = S3Repo.add_file(filename, s3_key = 'f2')
+        rf2.publish()
+        rf1.unlink()
+        S3Repo.commit()
+
+        stats = S3Repo.maintain_database(archive = True)
+        self.assertEqual(stats['expired'], 1)
+        self.assertEqual(stats['archived'], 1)
+        self.assertEqual(stats['deleted'], 0)
+
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM s3_repo.files
+        """,
+            [ 's3_key',  'published',  'date_archived',  ],
+            [ 'f2',      True,         None,             ],
+        )
+
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM s3_repo.archived_files
+        """,
+            [ 'file_id',    's3_key',  'published',  'date_archived',  ],
+            [ rf1.file_id,  'f1',      False,        now(),            ],
+        )
+
+        self.assertEqual([ rf.s3_key for rf in S3Repo.history(filename) ], [ 'f2' ])
+        self.assertEqual([ rf.s3_key for rf in S3Repo.history(filename, archived = True) ], [ 'f1', 'f2' ])
+        self.assertEqual(S3Repo.find_tagged(all = [ 'imported' ], published = False), [])
+        self.assertEqual([ rf.s3_key for rf in S3Repo.find_tagged(all = [ 'imported' ], archived = True) ], [ 'f1' ])
+
+        archived_file = S3Repo.history(filename, archived = True)[0]
+        for method in [ archived_file.update, archived_file.delete, archived_file.touch ]:
+            with self.assertRaises(RepoArchivedFileError):
+                method()
+
+    def test_reconcile_host(self):
+        current_host = s3repo.host.RepoHost.current_host_id()
+        rf1 = S3Repo.add_file(self.random_filename('abc'), s3_key = 'lost_row')
+        rf2 = S3Repo.add_file(self.random_filename('abc'), s3_key = 'lost_file')
+        rf3 = S3Repo.add_file(self.random_filename('abc'), s3_key = 'changed')
+        for rf in [ rf1, rf2, rf3 ]:
+            rf.publish()
+
+        s3repo.host.RepoFileDownload.remove_download(rf1)
+        os.unlink(rf2.local_path())
+        with open(rf3.local_path(), 'a') as fp:
+            fp.write('def')
+        partial = self.random_filename('ab', suffix = '.s3repo-partial')
+        S3Repo.commit()
+
+        self.config['local_root'] = '/tmp/s3repo'
+        try:
+            stats = S3Repo.reconcile_host(grace_seconds = 0)
+        finally:
+            del self.config['local_root']
+        S3Repo.commit()
+
+        quarantined = [ os.path.join('/tmp/s3repo/.s3repo-quarantine', os.path.basename(x)) for x in [ partial, rf3.local_path() ] ]
+        self.random_files.extend(quarantined)
+        self.assertTrue(all(os.path.exists(x) for x in quarantined))
+        self.assertFalse(os.path.exists(rf3.local_path()))
+
+        self.assertEqual((stats['inserted'], stats['deleted'], stats['quarantined']), (1, 2, 2))
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM s3_repo.downloads
+        """,
+            [ 'file_id',    'host_id',     ],
+            [ rf1.file_id,  current_host,  ],
+        )
+
+    def test_scrub_cache(self):
+        rf1 = S3Repo.add_file(self.random_filename('abc'), s3_key = 'intact')
+        rf2 = S3Repo.add_file(self.random_filename('abc'), s3_key = 'corrupt')
+        for rf in [ rf1, rf2 ]:
+            rf.publish()
+
+        with open(rf2.local_path(), 'w') as fp:
+            fp.write('abd')
+        S3Repo.commit()
+
+        stats = S3Repo.scrub_cache(bytes_per_second = 1000)
+        self.assertEqual((stats['verified'], stats['corrupt'], stats['bytes']), (1, 1, 6))
+
+        # Corrupt files are downloaded again, or dropped from the cache while offline
+        self.assertEqual(os.path.exists(rf2.local_path()), is_online())
+
+        # Verified files are skipped until config['scrub.interval_seconds'] passes
+        self.assertEqual(S3Repo.scrub_cache()['bytes'], 0)
+
+    def test_add_files(self):
+        current_host = s3repo.host.RepoHost.current_host_id()
+        filename = self.random_filename()
+        rfs = S3Repo.add_files([ filename, filename, '/data/other' ])
+        S3Repo.commit()
+
+        self.assertEqual([ rf.local_path() for rf in rfs ], [ filename, filename, '/data/other' ])
+        self.assertEqual(len({ rf.s3_key for rf in rfs }), 3)
+        self.assertTrue(rfs[0].s3_key < rfs[1].s3_key)
+
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM s3_repo.files
+                INNER JOIN s3_repo.downloads
+                    USING (file_id)
+            ORDER BY file_id
+        """,
+            [ 'file_id',       'host_id',     ],
+            [ rfs[0].file_id,  current_host,  ],
+            [ rfs[1].file_id,  current_host,  ],
+            [ rfs[2].file_id,  current_host,  ],
+        )
+
+    def test_add_file_from_many_threads(self):
+        errors = []
+        def worker(i):
+            with s3repo.common.pooled_conns():
+                try:
+                    S3Repo.add_file(self.random_filename(), s3_key = str(i))
+                    S3Repo.commit()
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [ threading.Thread(target = worker, args = (i,)) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertSqlResults(self.conn(), """
+            SELECT count(*) AS num_files
+            FROM s3_repo.files
+        """,
+            [ 'num_files', ],
+            [ 4,           ],
+        )
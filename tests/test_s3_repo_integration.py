@@ -1,4 +1,5 @@
-import unittest, psycopg2, json, os, time
+import unittest, psycopg2, json, os, time, shutil, tempfile
+import s3repo.storage
 from testcase import DBTestCase
 from s3repo import S3Repo
 from pyutil.pghelper import *
@@ -67,3 +68,72 @@ class S3RepoIntegrationTest(DBTestCase):
             [ rf3.file_no,  rf3.s3_bucket,  rf3.s3_key,  rf3.published,  rf3.date_published,  rf3.file_size,  ],
             [ rf4.file_no,  rf4.s3_bucket,  rf4.s3_key,  True,           now(),               -1,             ],
         )
+
+    def test_sweep_orphans(self):
+        bucket = self.config['s3.default_bucket']
+        rf1 = S3Repo.add_file(self.random_filename('some contents'), s3_key = 'abc')
+        rf1.upload()
+        S3Repo.commit()
+        self.s3_put_string(bucket, 'orphan', 'orphaned contents')
+
+        stats = S3Repo.sweep_orphans(bucket, min_age = -60)
+        self.assertEqual(stats, { 'orphans' : 1, 'deleted' : 0 })
+
+        S3Repo.sweep_orphans(bucket, delete = True, min_age = -60)
+        self.assertEqual(self.s3_list_bucket(bucket), [ 'abc' ])
+
+    def test_tier_files_skips_files_about_to_be_purged(self):
+        root = tempfile.mkdtemp()
+        s3repo.storage._backends[self.config['s3.default_bucket']] = s3repo.storage.FileSystemBackend(root)
+        try:
+            rf1 = S3Repo.add_file(self.random_filename('kept'), s3_key = 'kept')
+            rf2 = S3Repo.add_file(self.random_filename('purged'), s3_key = 'purged')
+            for rf in [ rf1, rf2 ]:
+                rf.publish()
+                rf.expire()
+
+            # No host holds rf2, so maintain_database will purge it
+            rf2.unlink()
+            S3Repo.commit()
+
+            stats = S3Repo.tier_files(tier = 'infrequent')
+            self.assertEqual(stats['tiered'], 1)
+            self.assertSqlResults(self.conn(), """
+                SELECT *
+                FROM s3_repo.files
+                ORDER BY s3_key
+            """,
+                [ 's3_key',  'storage_tier',  ],
+                [ 'kept',    'infrequent',    ],
+                [ 'purged',  'standard',      ],
+            )
+        finally:
+            s3repo.storage.reset()
+            shutil.rmtree(root)
+
+    def test_tier_files_skips_keys_which_cannot_be_moved(self):
+        root = tempfile.mkdtemp()
+        storage = s3repo.storage.FileSystemBackend(root)
+        s3repo.storage._backends[self.config['s3.default_bucket']] = storage
+        try:
+            for s3_key in [ 'lost', 'moved' ]:
+                rf = S3Repo.add_file(self.random_filename(s3_key), s3_key = s3_key)
+                rf.publish()
+                rf.expire()
+            S3Repo.commit()
+            storage.delete(self.config['s3.default_bucket'], [ 'lost' ])
+
+            stats = S3Repo.tier_files(tier = 'infrequent', batch_size = 1)
+            self.assertEqual((stats['tiered'], stats['skipped']), (1, 1))
+            self.assertSqlResults(self.conn(), """
+                SELECT *
+                FROM s3_repo.files
+                ORDER BY s3_key
+            """,
+                [ 's3_key',  'storage_tier',  ],
+                [ 'lost',    'standard',      ],
+                [ 'moved',   'infrequent',    ],
+            )
+        finally:
+            s3repo.storage.reset()
+            shutil.rmtree(root)
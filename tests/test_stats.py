@@ -0,0 +1,60 @@
+import unittest, tempfile, os
+import s3repo.stats
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        s3repo.stats.enable()
+        s3repo.stats.reset()
+
+    def tearDown(self):
+        s3repo.stats.disable()
+
+    def test_disabled_stats_record_nothing(self):
+        s3repo.stats.disable()
+        s3repo.stats.incr('cache.hit')
+        with s3repo.stats.timer('s3.get'):
+            pass
+
+        self.assertEqual(s3repo.stats.snapshot(), { 'counters' : {}, 'timers' : {} })
+
+    def test_counters_and_timers(self):
+        s3repo.stats.incr('cache.hit')
+        s3repo.stats.incr('cache.hit')
+        s3repo.stats.incr('s3.bytes_downloaded', 100)
+        for value in [ 0.001, 0.002, 0.003, 2.0 ]:
+            s3repo.stats.observe('s3.get', value)
+
+        data = s3repo.stats.snapshot()
+        self.assertEqual(data['counters'], { 'cache.hit' : 2, 's3.bytes_downloaded' : 100 })
+        self.assertEqual(data['timers']['s3.get']['count'], 4)
+        self.assertEqual(data['timers']['s3.get']['p50'], 0.0025)
+        self.assertEqual(data['timers']['s3.get']['p99'], 2.0)
+
+    def test_timer_counts_errors(self):
+        with self.assertRaises(ValueError):
+            with s3repo.stats.timer('s3.put'):
+                raise ValueError()
+
+        data = s3repo.stats.snapshot()
+        self.assertEqual(data['counters'], { 's3.put.errors' : 1 })
+        self.assertEqual(data['timers']['s3.put']['count'], 1)
+
+    def test_prometheus_file_exporter(self):
+        filename = tempfile.mktemp()
+        s3repo.stats.incr('cache.miss')
+        s3repo.stats.observe('sql.select', 0.004)
+        s3repo.stats.PrometheusFileExporter(filename).export(s3repo.stats.snapshot())
+
+        with open(filename) as fp:
+            lines = fp.read().splitlines()
+        os.unlink(filename)
+
+        self.assertIn('s3repo_cache_miss_total 1', lines)
+        self.assertIn('s3repo_sql_select_seconds_bucket{le="0.005"} 1', lines)
+        self.assertIn('s3repo_sql_select_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('s3repo_sql_select_seconds_count 1', lines)
+
+    def test_statement_name(self):
+        self.assertEqual(s3repo.stats.statement_name("\n    SELECT * FROM s3_repo.files"), 'sql.select')
+        self.assertEqual(s3repo.stats.statement_name("UPDATE s3_repo.files SET published = true"), 'sql.update')
+        self.assertEqual(s3repo.stats.statement_name("EXECUTE s3repo_find_tag_ids(%(tag_names)s)"), 'sql.execute.s3repo_find_tag_ids')
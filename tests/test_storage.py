@@ -0,0 +1,94 @@
+import unittest, tempfile, shutil, os
+import s3repo.storage
+import s3repo.exceptions
+from s3repo.storage import FileSystemBackend
+
+class FileSystemBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = FileSystemBackend(os.path.join(self.root, 'store'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def local_file(self, contents):
+        fp = tempfile.NamedTemporaryFile(dir = self.root, delete = False)
+        fp.write(contents)
+        fp.close()
+        return fp.name
+
+    def read(self, filename):
+        with open(filename, 'rb') as fp:
+            return fp.read()
+
+    def test_put_get_round_trip(self):
+        self.storage.put('bucket', 'a/b/c', self.local_file(b'abcdef'))
+        self.storage.get('bucket', 'a/b/c', os.path.join(self.root, 'out'))
+
+        self.assertEqual(self.read(os.path.join(self.root, 'out')), b'abcdef')
+        self.assertEqual(self.storage.get_range('bucket', 'a/b/c', 1, 3), b'bcd')
+
+    def test_hardlink_uploads_do_not_copy(self):
+        storage = FileSystemBackend(os.path.join(self.root, 'store'), link = 'hardlink')
+        filename = self.local_file(b'abc')
+        storage.put('bucket', 'key', filename)
+
+        self.assertEqual(os.stat(filename).st_ino, os.stat(storage.path('bucket', 'key')).st_ino)
+        self.assertFalse(os.stat(filename).st_mode & 0o222)
+
+    def test_auto_never_hardlinks(self):
+        filename = self.local_file(b'abc')
+        method = self.storage.place(filename, os.path.join(self.root, 'placed'))
+
+        self.assertIn(method, [ 'reflink', 'copy' ])
+        self.assertNotEqual(os.stat(filename).st_ino, os.stat(os.path.join(self.root, 'placed')).st_ino)
+        self.assertEqual(list(self.storage.link_methods.values()), [ method ])
+
+    def test_list_is_in_key_order(self):
+        keys = [ '/abs/path/1', 'a-b', 'a/b/c', 'a//d', 'a%b', 'b', 'b.', '..' ]
+        for key in keys:
+            self.storage.put('bucket', key, self.local_file(b'x'))
+
+        self.assertEqual([ x.name for x in self.storage.list('bucket') ], sorted(keys))
+        self.assertEqual([ x.name for x in self.storage.list('bucket', 'a/') ], [ 'a//d', 'a/b/c' ])
+        self.assertEqual([ x.name for x in self.storage.list('bucket', '/abs') ], [ '/abs/path/1' ])
+
+    def test_delete_and_copy(self):
+        self.storage.put('bucket', 'a', self.local_file(b'abc'))
+        self.storage.copy('bucket', 'a', 'other', 'b')
+        self.assertEqual(self.storage.delete('bucket', [ 'a', 'missing' ]), 2)
+
+        self.assertEqual([ x.name for x in self.storage.list('bucket') ], [])
+        self.assertEqual([ x.name for x in self.storage.list('other') ], [ 'b' ])
+
+    def test_streaming_upload(self):
+        upload = self.storage.start_upload('bucket', 'a/b')
+        upload.put_part(b'abc')
+        self.assertEqual([ x.name for x in self.storage.list('bucket') ], [])
+
+        upload.complete(b'def')
+        self.assertEqual(self.read(self.storage.path('bucket', 'a/b')), b'abcdef')
+
+        upload = self.storage.start_upload('bucket', 'c')
+        upload.put_part(b'abc')
+        upload.abort()
+        self.assertEqual([ x.name for x in self.storage.list('bucket') ], [ 'a/b' ])
+
+    def test_cold_tiers_must_be_restored(self):
+        storage = FileSystemBackend(os.path.join(self.root, 'store'), restore_seconds = 60)
+        storage.put('bucket', 'a', self.local_file(b'abc'))
+        self.assertEqual(storage.transition('bucket', [ 'a', 'missing' ], 'glacier'), [ 'a' ])
+
+        self.assertEqual(storage.tier('bucket', 'a'), 'glacier')
+        self.assertEqual([ x.name for x in storage.list('bucket') ], [ 'a' ])
+        self.assertRaises(s3repo.exceptions.RepoRestoreRequiredError, storage.get_range, 'bucket', 'a', 0, 0)
+
+        storage.restore('bucket', 'a')
+        self.assertFalse(storage.is_restored('bucket', 'a'))
+
+        storage.restore_seconds = 0
+        self.assertTrue(storage.is_restored('bucket', 'a'))
+        self.assertEqual(storage.get_range('bucket', 'a', 0, 2), b'abc')
+
+        storage.transition('bucket', [ 'a' ], 'standard')
+        self.assertEqual(os.listdir(os.path.join(self.root, 'store', 'bucket')), [ 'a' ])
@@ -0,0 +1,64 @@
+import unittest
+import s3repo.throttle
+
+class FakeS3Error(Exception):
+    def __init__(self, status, error_code):
+        super(FakeS3Error, self).__init__(error_code)
+        self.status     = status
+        self.error_code = error_code
+
+class ThrottleTest(unittest.TestCase):
+    def test_adaptive_limit(self):
+        limit = s3repo.throttle.AdaptiveLimit(initial = 4, maximum = 6)
+        for i in range(4):
+            limit.release(limit.acquire())
+        self.assertEqual(int(limit.limit), 4)
+        self.assertTrue(limit.limit > 4.9)
+
+        limit.release(limit.acquire(), throttled = True)
+        self.assertTrue(2 < limit.limit < 3)
+
+        for i in range(100):
+            limit.release(limit.acquire())
+        self.assertEqual(limit.limit, 6)
+
+    def test_burst_of_throttles_halves_once(self):
+        limit = s3repo.throttle.AdaptiveLimit(initial = 8)
+        epochs = [ limit.acquire() for i in range(4) ]
+        for epoch in epochs:
+            limit.release(epoch, throttled = True)
+        self.assertEqual(limit.limit, 4)
+
+        limit.release(limit.acquire(), throttled = True)
+        self.assertEqual(limit.limit, 2)
+
+    def test_limits_are_per_prefix(self):
+        scheduler = s3repo.throttle.Scheduler(prefix_depth = 1)
+        self.assertIs(scheduler.limit_for('b', '/data/a'), scheduler.limit_for('b', 'data/b'))
+        self.assertIsNot(scheduler.limit_for('b', 'data/a'), scheduler.limit_for('b', 'logs/a'))
+        self.assertIsNot(scheduler.limit_for('b', 'data/a'), scheduler.limit_for('c', 'data/a'))
+
+    def test_transient_errors_are_retried(self):
+        scheduler = s3repo.throttle.Scheduler(initial = 8, attempts = 3, base_seconds = 0)
+        attempts = []
+        def request():
+            attempts.append(len(attempts))
+            if len(attempts) < 3:
+                raise FakeS3Error(503, 'SlowDown')
+            return attempts
+
+        self.assertEqual(scheduler.call('b', 'k', 's3.get', request), [ 0, 1, 2 ])
+
+        # Halved twice, then increased by a half
+        self.assertEqual(scheduler.limit_for('b', 'k').limit, 2.5)
+
+    def test_other_errors_are_not_retried(self):
+        scheduler = s3repo.throttle.Scheduler(attempts = 3, base_seconds = 0)
+        attempts = []
+        def request():
+            attempts.append(1)
+            raise FakeS3Error(403, 'AccessDenied')
+
+        with self.assertRaises(FakeS3Error):
+            scheduler.call('b', 'k', 's3.get', request)
+        self.assertEqual(len(attempts), 1)
@@ -0,0 +1,83 @@
+import unittest, threading, time
+import s3repo.transfers
+
+class TransfersTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = s3repo.transfers.TransferScheduler(max_active = 1)
+        self.served = []
+        self.threads = []
+
+    def queued(self):
+        with self.scheduler.cond:
+            return sum(len(queue) for flows in self.scheduler.waiting.values() for queue in flows.values())
+
+    def enqueue(self, name, flow, label):
+        def transfer():
+            with s3repo.transfers.priority(name, flow):
+                self.scheduler.run(lambda: self.served.append(label))
+
+        expected = self.queued() + 1
+        thread = threading.Thread(target = transfer)
+        thread.start()
+        self.threads.append(thread)
+        while self.queued() < expected:
+            time.sleep(0.001)
+
+    def serve_all(self):
+        self.scheduler.release()
+        for thread in self.threads:
+            thread.join()
+        return self.served
+
+    def test_priority_context(self):
+        self.assertEqual(s3repo.transfers.current(), ('normal', threading.current_thread().name))
+        with s3repo.transfers.priority('background', 'scrub'):
+            self.assertEqual(s3repo.transfers.current(), ('background', 'scrub'))
+        self.assertEqual(s3repo.transfers.current()[0], 'normal')
+
+        with self.assertRaises(ValueError):
+            with s3repo.transfers.priority('urgent'):
+                pass
+
+    def test_higher_priorities_go_first(self):
+        self.scheduler.acquire('normal', 'holder')
+        self.enqueue('background', 'prefetch', 'background')
+        self.enqueue('normal', 'publish', 'normal')
+        self.enqueue('foreground', 'open', 'foreground')
+
+        self.assertEqual(self.serve_all(), [ 'foreground', 'normal', 'background' ])
+
+    def test_flows_are_served_round_robin(self):
+        self.scheduler.acquire('normal', 'holder')
+        for label in [ 'a1', 'a2', 'a3' ]:
+            self.enqueue('background', 'a', label)
+        self.enqueue('background', 'b', 'b1')
+
+        self.assertEqual(self.serve_all(), [ 'a1', 'b1', 'a2', 'a3' ])
+
+    def test_slots_are_reserved_for_foreground(self):
+        scheduler = s3repo.transfers.TransferScheduler(max_active = 2, reserved_foreground = 1)
+        scheduler.acquire('background', 'a')
+
+        waiting = threading.Thread(target = scheduler.acquire, args = ('normal', 'b'))
+        waiting.daemon = True
+        waiting.start()
+        waiting.join(0.05)
+        self.assertTrue(waiting.is_alive())
+
+        scheduler.acquire('foreground', 'open')
+        self.assertEqual(scheduler.active, 2)
+
+        scheduler.release()
+        scheduler.release()
+        waiting.join()
+        self.assertEqual(scheduler.active, 1)
+
+    def test_progress_charges_each_chunk(self):
+        charged = []
+        self.scheduler.charge = charged.append
+        cb = self.scheduler.progress()
+        for so_far in [ 0, 10, 25, 25 ]:
+            cb(so_far, 25)
+
+        self.assertEqual(charged, [ 10, 15 ])
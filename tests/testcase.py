@@ -1,6 +1,7 @@
 import unittest, shutil, tempfile, os
 import s3repo
 import s3repo.common
+import s3repo.cache
 import pyutil.testutil
 import pyutil.dbtable
 from pyutil.pghelper import *
@@ -35,6 +36,8 @@ class DBTestCase(pyutil.testutil.TestCase):
             's3_repo.file_tags',
             's3_repo.path_tags',
             's3_repo.downloads',
+            's3_repo.archived_files',
+            's3_repo.archived_file_tags',
         ]
 
         execute(self.conn(), 'TRUNCATE TABLE {} CASCADE'.format(','.join(tables)))
@@ -42,6 +45,8 @@ class DBTestCase(pyutil.testutil.TestCase):
     def teardown_connections(self):
         s3repo.common.db_mgr.rollback()
         MemoizeResults.clear()
+        s3repo.S3Repo.clear_find_tagged_cache()
+        s3repo.cache.clear_all()
 
         for cache_obj in pyutil.dbtable.DBTable.__subclasses__():
             cache_obj.clear_cache()